@@ -18,13 +18,15 @@ from androidkit import (
 
 import time
 import threading
+import traceback
+import multiprocessing
 from multiprocessing.sharedctypes import Value
+from concurrent.futures import ProcessPoolExecutor
 from mt_run import Connections, kill_mtserver, WrongConnectionState
 from ape_runner import fetch_result
 
-# compress files with thread
+# compress files with worker processes
 from consumer import collapse_per_message_binary
-import threading
 from logcat_catcher import generate_catcher_thread, kill_generated_logcat_processes
 
 ART_APE_MT_READY_SS = "ART_APE_MT" # snapshot name
@@ -96,11 +98,17 @@ def install_art_ape_mt(avd_name, libart_path, ape_jar_path, mtserver_path, force
     return avd
 
 class ConnectionsWithValue(Connections):
-    def __init__(self, *args):
+    def __init__(self, *args, executor=None, method_db=None, topk=None, compress=None):
         value = args[-1]
         self._value = args[-1]
-        self._threads = []
-        super(ConnectionsWithValue, self).__init__(*(args[:-1]))
+        # bounded pool for collapsing, made before the threads of run_ape_with_mt()
+        self._executor = executor
+        # sqlite3 file of global method ids shared by every run, or None
+        self._method_db = method_db
+        # methods kept per message in bounded memory, None for exact counts
+        self._topk = topk
+        self._futures = []
+        super(ConnectionsWithValue, self).__init__(*(args[:-1]), compress=compress)
 
     def stdout_callback(self, line):
         if line.startswith('Server with uid'):
@@ -109,20 +117,27 @@ class ConnectionsWithValue(Connections):
 
     def close_connection(self, socketfd, prefix):
         prefix_local = super(ConnectionsWithValue, self).close_connection(socketfd, prefix)
-        if prefix_local != '':
-            thread = threading.Thread(target=collapse_per_message_binary,
-                args=(prefix_local, ))
-            thread.start()
-            self._threads.append(thread)
+        if prefix_local != '' and self._executor is not None:
+            self._futures.append((prefix_local,
+                self._executor.submit(collapse_per_message_binary, prefix_local,
+                    self._method_db, self._topk)))
+        return prefix_local
 
     def clean_up(self, reason):
-        print('Waiting for collapsing threads')
+        print('Waiting for collapsing processes')
         if super(ConnectionsWithValue, self).clean_up(reason):
-            for thread in self._threads:
-                thread.join()
-
-def mt_task(package_name, output_folder, serial, logging_flag, mt_is_running):
-    connections = ConnectionsWithValue(package_name, serial, output_folder, mt_is_running)
+            for prefix_local, future in self._futures:
+                try:
+                    future.result()
+                except Exception:
+                    print('Failure on collapsing {}'.format(prefix_local), file=sys.stderr)
+                    traceback.print_exc()
+            self._futures = []
+
+def mt_task(package_name, output_folder, serial, logging_flag, mt_is_running, executor=None,
+        method_db=None, topk=None, compress=None):
+    connections = ConnectionsWithValue(package_name, serial, output_folder, mt_is_running,
+        executor=executor, method_db=method_db, topk=topk, compress=compress)
 
     try:
         print('Start mtserver...')
@@ -173,7 +188,8 @@ def ape_task(avd_name, serial, package_name, output_dir, running_minutes, mt_is_
     fetch_result(output_dir, serial)
 
 def run_ape_with_mt(apk_path, avd_name, libart_path, ape_jar_path, mtserver_path,
-        ape_output_folder, mt_output_folder, running_minutes, force_clear):
+        ape_output_folder, mt_output_folder, running_minutes, force_clear, collapse_workers=None,
+        method_db=None, topk=None, compress=None):
     package_name = get_package_name(apk_path)
     print('run_ape_with_mt(): given apk_path {} avd_name {}'.format(apk_path, avd_name))
 
@@ -190,9 +206,14 @@ def run_ape_with_mt(apk_path, avd_name, libart_path, ape_jar_path, mtserver_path
         return True
 
     kill_mtserver(serial = avd.serial)
+    # Collapsing processes are forked from a fork server, not from this process
+    # whose ape, logcat and compression threads may hold locks at that time
+    executor = ProcessPoolExecutor(max_workers=collapse_workers,
+        mp_context=multiprocessing.get_context('forkserver'))
     mt_is_running = Value('i', 0)
     mtserver_thread = threading.Thread(target=mt_task,
-        args=(package_name, mt_output_folder, avd.serial, "20010107", mt_is_running))
+        args=(package_name, mt_output_folder, avd.serial, "20010107", mt_is_running, executor, method_db, topk,
+            compress))
     apetask_thread = threading.Thread(target=ape_task,
         args=(avd_name, avd.serial, package_name, ape_output_folder, running_minutes, mt_is_running))
 
@@ -205,6 +226,7 @@ def run_ape_with_mt(apk_path, avd_name, libart_path, ape_jar_path, mtserver_path
 
     kill_mtserver(serial = avd.serial)
     mtserver_thread.join()
+    executor.shutdown()
     kill_generated_logcat_processes()
     unset_multiprocessing_mode()
 
@@ -226,6 +248,14 @@ if __name__ == "__main__":
     parser.add_argument('--running_minutes', default='20')
     parser.add_argument('--ape_output_folder', default='{dirname}/ape_output')
     parser.add_argument('--mt_output_folder', default='{dirname}/mt_output')
+    parser.add_argument('--collapse_workers', default='0',
+        help='Number of processes collapsing MiniTrace outputs, 0 for number of CPUs')
+    parser.add_argument('--method_db', default=None,
+        help='sqlite3 file of global method ids, to save method_gid.npz of each output')
+    parser.add_argument('--topk', default=None,
+        help='Keep only given number of methods per message while collapsing, in bounded memory')
+    parser.add_argument('--compress', default=None, choices=['gz', 'xz', 'zst'],
+        help='Keep pulled traces compressed with given codec, see mt_storage.py report')
 
     apk_files = []
     args = parser.parse_args()
@@ -251,6 +281,8 @@ if __name__ == "__main__":
             print("Creating folder ", mt_output_folder)
             os.makedirs(mt_output_folder)
         if run_ape_with_mt(apk_path, args.avd_name, args.libart_path, args.ape_jar_path, args.mtserver_path,
-                ape_output_folder, mt_output_folder, args.running_minutes, force_clear):
+                ape_output_folder, mt_output_folder, args.running_minutes, force_clear,
+                int(args.collapse_workers) or None, args.method_db,
+                None if args.topk is None else int(args.topk), args.compress):
             i += 1
             force_clear = False
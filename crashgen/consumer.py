@@ -4,6 +4,11 @@ import sys
 import pickle
 import argparse
 import datetime
+import mmap
+import struct
+import functools
+import bisect
+from array import array
 
 kMiniTraceMethodEnter = 0x00
 kMiniTraceMethodExit = 0x01
@@ -35,121 +40,292 @@ def b2u8(buf, idx = 0):
         + (buf[idx + 6] << 48) \
         + (buf[idx + 7] << 56)
 
-class Threads:
-    def __init__(self, threadinfo_fname):
-        threads = dict()
-        main_tid = -1
-        with open(threadinfo_fname, 'rt') as f:
-            for line in f:
-                if line[-1] != '\n':
-                    break
-                tid, name = line.rstrip().split('\t')
-                tid = int(tid)
-                assert tid not in threads, (prefix, tid, thread[tid], name)
-                if main_tid == -1:
-                    assert name == 'main', name
-                    main_tid = tid
-                threads[tid] = name
-        self.threads = threads
-        self.main_tid = main_tid
-
-    def items(self, *args):
-        return self.threads.items()
+# Parsed info logs are cached next to them, keyed by size and mtime
+INFO_CACHE_VERSION = 1
+INFO_CACHE_SUFFIX = '.cache'
 
-    def values(self, *args):
-        return self.threads.values()
+def _parse_info_rows(info_fname, num_tokens, num_key_tokens, parse_key):
+    '''
+    Returns (keys, strings, columns, pairs, pair_rows, chain)
+        - keys: keys in the order of the log
+        - strings: sorted distinct strings, string id being the position
+        - columns: array of string ids for each token after the key
+        - pairs: sorted (id of 1st column << 32) | id of 2nd column
+        - pair_rows: first row of each of pairs
+        - chain: row -> next row with the same pair, -1 for the last one
+    '''
+    keys = []
+    string_ids = dict()
+    tokens_per_column = [[] for _ in range(num_tokens - num_key_tokens)]
+    with open(info_fname, 'rt') as f:
+        for line in f:
+            if line[-1] != '\n':
+                break
+            tokens = line.rstrip().split('\t')
+            assert len(tokens) == num_tokens, (info_fname, line)
+            keys.append(parse_key(tokens))
+            for column, token in zip(tokens_per_column, tokens[num_key_tokens:]):
+                column.append(string_ids.setdefault(token, token))
+    assert len(set(keys)) == len(keys), info_fname
+
+    strings = sorted(string_ids)
+    string_ids = {string:i for i, string in enumerate(strings)}
+    columns = [array('i', map(string_ids.__getitem__, column)) for column in tokens_per_column]
+    return (keys, strings, columns) + _pair_index(columns, len(keys))
+
+def _pair_index(columns, num_rows):
+    # pairs, pair_rows, chain of _parse_info_rows()
+    chain = array('i', [-1]) * num_rows
+    first_rows = dict()
+    if len(columns) >= 2:
+        first, second = columns[0], columns[1]
+        for row in range(num_rows - 1, -1, -1):
+            pair = (first[row] << 32) | second[row]
+            chain[row] = first_rows.get(pair, -1)
+            first_rows[pair] = row
+    pairs = sorted(first_rows)
+    return array('q', pairs), array('i', map(first_rows.__getitem__, pairs)), chain
+
+def _read_info_rows(info_fname, num_tokens, num_key_tokens, parse_key):
+    # _parse_info_rows() through the cache file
+    stat = os.stat(info_fname)
+    stamp = (INFO_CACHE_VERSION, num_tokens, num_key_tokens, stat.st_size, stat.st_mtime_ns)
+    cache_fname = info_fname + INFO_CACHE_SUFFIX
+    try:
+        with open(cache_fname, 'rb') as f:
+            cached = pickle.load(f)
+        if cached[0] == stamp:
+            keys, strings = cached[1:3]
+            # one string is much faster to unpickle than a list of them
+            strings = strings.split('\0') if strings else []
+            return (keys, strings) + cached[3:]
+    except (OSError, EOFError, ValueError, TypeError, IndexError, pickle.PickleError):
+        pass
+
+    rows = _parse_info_rows(info_fname, num_tokens, num_key_tokens, parse_key)
+    keys, strings = rows[:2]
+    tmp_fname = cache_fname + '.tmp'
+    try:
+        with open(tmp_fname, 'wb') as f:
+            pickle.dump((stamp, keys, '\0'.join(strings)) + rows[2:], f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fname, cache_fname)
+    except OSError:
+        # read-only outputs are still readable without the cache
+        pass
+    return rows
+
+class InfoTable:
+    '''
+    Rows of an info log, as arrays of ids of the sorted distinct strings
+    per column, with an index by key and a reverse index by the first two
+    columns. The log is read on the first access.
+    '''
+    __slots__ = ('fname', 'use_cache', '_index', '_keys', '_strings', '_columns',
+        '_pairs', '_pair_rows', '_chain')
+    NUM_TOKENS = None       # tokens of a line
+    NUM_KEY_TOKENS = 1      # tokens of the key, the others are the columns
+
+    def __init__(self, info_fname, use_cache=True):
+        self.fname = info_fname
+        self.use_cache = use_cache
+        self._index = None # key -> row
+
+    def _load(self):
+        read = _read_info_rows if self.use_cache else _parse_info_rows
+        self._keys, self._strings, self._columns, self._pairs, self._pair_rows, self._chain = read(
+            self.fname, self.NUM_TOKENS, self.NUM_KEY_TOKENS, self.parse_key)
+        self._index = dict(zip(self._keys, range(len(self._keys))))
+
+    def _string_id(self, string):
+        # id of string, -1 if no row has it
+        i = bisect.bisect_left(self._strings, string)
+        if i < len(self._strings) and self._strings[i] == string:
+            return i
+        return -1
+
+    def row(self, row):
+        strings = self._strings
+        return [strings[column[row]] for column in self._columns]
+
+    def rows_of(self, *strings):
+        # rows with given strings of the first columns (None for any), in the order of the log
+        if self._index is None:
+            self._load()
+        first, second = self._string_id(strings[0]), self._string_id(strings[1])
+        rows = []
+        if first >= 0 and second >= 0:
+            pair = (first << 32) | second
+            i = bisect.bisect_left(self._pairs, pair)
+            row = self._pair_rows[i] if i < len(self._pairs) and self._pairs[i] == pair else -1
+            while row >= 0:
+                rows.append(row)
+                row = self._chain[row]
+        for column, string in zip(self._columns[2:], strings[2:]):
+            if string is not None:
+                string_id = self._string_id(string)
+                rows = [row for row in rows if column[row] == string_id]
+        return rows
 
-    def __getitem__(self, *args):
-        return self.threads.__getitem__(*args)
+    def items(self, *args):
+        if self._index is None:
+            self._load()
+        return [(key, self.row(row)) for row, key in enumerate(self._keys)]
 
-    def __setitem__(self, *args):
-        self.threads.__setitem__(*args)
+    def keys(self, *args):
+        if self._index is None:
+            self._load()
+        return self._index.keys()
 
-    def __contains__(self, *args):
-        return self.threads.__contains__(*args)
+    def values(self, *args):
+        if self._index is None:
+            self._load()
+        return [self.row(row) for row in range(len(self._keys))]
+
+    def __getitem__(self, key):
+        if self._index is None:
+            self._load()
+        return self.row(self._index[key])
+
+    def __setitem__(self, key, tokens):
+        # Rare, so the string ids and the reverse index are made again
+        if self._index is None:
+            self._load()
+        assert len(tokens) == len(self._columns), tokens
+        rows = [InfoTable.row(self, row) for row in range(len(self._keys))]
+        if key in self._index:
+            rows[self._index[key]] = list(tokens)
+        else:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            rows.append(list(tokens))
+        self._strings = sorted(set(sys.intern(token) for row in rows for token in row))
+        string_ids = {string:i for i, string in enumerate(self._strings)}
+        self._columns = [array('i', (string_ids[row[i]] for row in rows)) for i in range(len(self._columns))]
+        self._pairs, self._pair_rows, self._chain = _pair_index(self._columns, len(self._keys))
+
+    def __contains__(self, key):
+        if self._index is None:
+            self._load()
+        return key in self._index
 
     def __iter__(self, *args):
-        return self.threads.__iter__(*args)
+        if self._index is None:
+            self._load()
+        return iter(self._keys)
 
     def __len__(self, *args):
-        return self.threads.__len__(*args)
+        if self._index is None:
+            self._load()
+        return len(self._keys)
 
-    def get_main_tid(self):
-        return self.main_tid
-
-def parse_threadinfo(threadinfo_fname):
-    return Threads(threadinfo_fname)
-
-class Methods:
-    def __init__(self, methodinfo_fname):
-        # ptr -> [classname, methodname, signature, sourcefile]
-        methods = dict()
-        with open(methodinfo_fname, 'rt') as f:
-            for line in f:
-                if line[-1] != '\n':
-                    break
-                tokens = line.rstrip().split('\t')
-                assert len(tokens) == 5, (methodinfo_fname, line)
+class Threads(InfoTable):
+    __slots__ = ('main_tid', )
+    NUM_TOKENS = 2
 
-                method_ptr = int(tokens[0], 16)
-                assert method_ptr not in methods, (methodinfo_fname, line)
+    def __init__(self, threadinfo_fname, use_cache=False):
+        # tid -> name, the first thread is main
+        InfoTable.__init__(self, threadinfo_fname, use_cache)
+        self._load()
+        self.main_tid = -1
+        if self._keys:
+            self.main_tid = self._keys[0]
+            assert self[self.main_tid] == 'main', (threadinfo_fname, self[self.main_tid])
 
-                methods[method_ptr] = tokens[1:]
+    def parse_key(self, tokens):
+        return int(tokens[0])
 
-        self.methods = methods
+    def row(self, row):
+        return self._strings[self._columns[0][row]]
 
-    def items(self, *args):
-        return self.methods.items()
-
-    def values(self, *args):
-        return self.methods.values()
+    def __setitem__(self, key, name):
+        InfoTable.__setitem__(self, key, [name])
 
-    def __getitem__(self, *args):
-        return self.methods.__getitem__(*args)
+    def get_main_tid(self):
+        return self.main_tid
 
-    def __setitem__(self, *args):
-        self.methods.__setitem__(*args)
+def parse_threadinfo(threadinfo_fname):
+    return Threads(threadinfo_fname)
 
-    def __contains__(self, *args):
-        return self.methods.__contains__(*args)
+class Methods(InfoTable):
+    __slots__ = ()
+    NUM_TOKENS = 5
 
-    def __iter__(self, *args):
-        return self.methods.__iter__(*args)
+    def __init__(self, methodinfo_fname, use_cache=True):
+        # ptr -> [classname, methodname, signature, sourcefile]
+        InfoTable.__init__(self, methodinfo_fname, use_cache)
 
-    def __len__(self, *args):
-        return self.methods.__len__(*args)
+    def parse_key(self, tokens):
+        return int(tokens[0], 16)
 
     def find_method_ptr(self, classname, methodname, signature=None):
-        for ptr in self.methods:
-            c, m, sig, sf = self.methods[ptr]
-            if c == classname and m == methodname and (signature == None or sig == signature):
-                return ptr
+        for row in self.rows_of(classname, methodname, signature):
+            return self._keys[row]
 
         raise KeyError
 
 def parse_methodinfo(methodinfo_fname):
     return Methods(methodinfo_fname)
 
-def parse_fieldinfo(fieldinfo_fname):
-    fields = dict()
-    with open(fieldinfo_fname, 'rt') as f:
-        for line in f:
-            if line[-1] != '\n':
-                break
-            tokens = line.rstrip().split('\t')
-            assert len(tokens) == 5, (fieldinfo_fname, line)
+class Fields(InfoTable):
+    __slots__ = ()
+    NUM_TOKENS = 5
+    NUM_KEY_TOKENS = 2
+
+    def __init__(self, fieldinfo_fname, use_cache=True):
+        # (ptr, detail_idx) -> [classname, fieldname, type]
+        InfoTable.__init__(self, fieldinfo_fname, use_cache)
 
-            field_ptr = int(tokens[0], 16)
-            field_det_idx = int(tokens[1])
+    def parse_key(self, tokens):
+        return (int(tokens[0], 16), int(tokens[1]))
 
-            fields[(field_ptr, field_det_idx)] = tokens[2:]
+    def find_fields(self, classname, fieldname):
+        # keys of the field, one for each detail_idx
+        return [self._keys[row] for row in self.rows_of(classname, fieldname)]
 
-    return fields
+def parse_fieldinfo(fieldinfo_fname):
+    return Fields(fieldinfo_fname)
 
 class StopParsingData(Exception):
     pass
 
-def parse_data(data_fname, callbacks=[], verbose=True):
+HEADER_SIZE = 20
+
+def parse_header(buf):
+    # Header format:
+    # u4  magic ('MiTr')
+    # u2  version
+    # u2  offset to data
+    # u4  log_flag
+    # u8  starting timestamp in milliseconds
+    #     in C:
+    #       gettimeofday(&now, NULL); int64_t timestamp = now.tv_sec * 1000LL + now.tv_usec / 1000;
+    #     in JAVA:
+    #       System.currentTimeMillis();
+    #     interpret in Python:
+    #       datetime.datetime.fromtimestamp(timestamp/1000.0)
+    buf = bytes(buf)
+    assert buf[:4] == b'MiTr'
+    version = b2u2(buf, 4)
+    offset = b2u2(buf, 6)
+    log_flag = b2u4(buf, 8)
+    timestamp = b2u8(buf, 12)
+
+    assert offset == HEADER_SIZE
+    return version, log_flag, timestamp
+
+NUM_CALLBACKS = 16
+
+def callback_list(callbacks):
+    if isinstance(callbacks, dict):
+        callbacks = [callbacks.get(i, None) for i in range(NUM_CALLBACKS)]
+    elif isinstance(callbacks, list):
+        for _ in range(NUM_CALLBACKS-len(callbacks)):
+            callbacks.append(None)
+    else:
+        raise RuntimeError
+    return callbacks
+
+def parse_data(data_fname, callbacks=[], verbose=True, start=None, stop=None):
     '''
     Callback for method events 0, 1, 2
         - argument [tid, ptr]
@@ -167,45 +343,29 @@ def parse_data(data_fname, callbacks=[], verbose=True):
         - argument [method_id]
     Callback for target entring/exiting/unwinding 13/14/15 with MiniTrace version 4
         - argument [tid, method_id]
+
+    start, stop: byte offsets of the window to parse (see mt_index.py).
+        start must be at a record boundary, records starting before stop are parsed.
+    Returns the offset of the first record which was not parsed.
     '''
-    NUM_CALLBACKS = 16
-    if isinstance(callbacks, dict):
-        callbacks = [callbacks.get(i, None) for i in range(NUM_CALLBACKS)]
-    elif isinstance(callbacks, list):
-        for _ in range(NUM_CALLBACKS-len(callbacks)):
-            callbacks.append(None)
-    else:
-        raise RuntimeError
-    with open(data_fname, 'rb') as f:
-        # read header
-        # Header format:
-        # u4  magic ('MiTr')
-        # u2  version
-        # u2  offset to data
-        # u4  log_flag
-        # u8  starting timestamp in milliseconds
-        #     in C:
-        #       gettimeofday(&now, NULL); int64_t timestamp = now.tv_sec * 1000LL + now.tv_usec / 1000;
-        #     in JAVA:
-        #       System.currentTimeMillis();
-        #     interpret in Python:
-        #       datetime.datetime.fromtimestamp(timestamp/1000.0)
-        magic = f.read(4)
-        assert magic == b'MiTr'
-        version = b2u2(f.read(2))
-        offset = b2u2(f.read(2))
-        log_flag = b2u4(f.read(4))
-        timestamp = b2u8(f.read(8))
-
-        assert offset == 20
+    callbacks = callback_list(callbacks)
+    if not any(callbacks[:5]):
+        # nothing to do with method / field records, which are skipped there
+        return parse_data_mmap(data_fname, callbacks, verbose, start, stop)
+    from mt_storage import open_trace, is_compressed, trace_size
+    with open_trace(data_fname) as f:
+        version, log_flag, timestamp = parse_header(f.read(HEADER_SIZE))
         if verbose:
             print("MiniTrace Log Version {}".format(version))
             print("Log with flag {}, timestamp {}".format(
                 hex(log_flag),
                 datetime.datetime.fromtimestamp(timestamp//1000).strftime("%Y/%m/%d %H:%M:%S")))
 
+        if start is not None:
+            f.seek(start)
+        pos = f.tell()
         try:
-            while True:
+            while stop is None or pos < stop:
                 tid = f.read(2)
                 if len(tid) < 2:
                     break
@@ -218,6 +378,7 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                     if callbacks[7]:
                         timestamp = b2u8(value)
                         callbacks[7](timestamp)
+                    pos += 10
                     continue
                 elif tid == 1:
                     # Pinging event
@@ -227,6 +388,7 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                     if callbacks[8]:
                         timestamp = b2u8(value)
                         callbacks[8](timestamp)
+                    pos += 10
                     continue
                 elif tid == 2:
                     value = f.read(4)
@@ -235,6 +397,7 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                     if callbacks[9]:
                         tid = b2u4(value)
                         callbacks[9](tid)
+                    pos += 6
                     continue
                 elif tid in [3, 4, 5]:
                     if version >= 4:
@@ -248,6 +411,7 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                             real_tid = b2u4(real_tid)
                             value = b2u4(value)
                             callbacks[13-3+tid](real_tid, value)
+                        pos += 10
                     else:
                         value = f.read(4)
                         if len(value) < 4:
@@ -255,6 +419,7 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                         if callbacks[10-3+tid]:
                             value = b2u4(value)
                             callbacks[10-3+tid](value)
+                        pos += 6
                     continue
 
                 value = f.read(4)
@@ -267,6 +432,7 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                 if action <= 2: # method event
                     if callbacks[action]:
                         callbacks[action](tid, value)
+                    pos += 6
                 elif action <= 4: # field event
                     extra_data = f.read(10)
                     if len(extra_data) != 10:
@@ -276,6 +442,7 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                         dex = b2u4(extra_data, 4)
                         detail_idx = b2u2(extra_data, 8)
                         callbacks[action](tid, value, obj, dex, detail_idx)
+                    pos += 16
                 elif action <= 6: # exception / message
                     length = (value >> 3) - 6
                     buf = f.read(length)
@@ -288,11 +455,236 @@ def parse_data(data_fname, callbacks=[], verbose=True):
                         except UnicodeDecodeError:
                             print("Failed to decode ->", buf[:min(len(buf)-1, 100)], file=sys.stderr)
                             raise
+                    pos += 6 + length
                 else:
                     raise RuntimeError
 
         except StopParsingData:
-            pass
+            return pos
+        if is_compressed(data_fname):
+            # the size is unknown, but a record cut by the end of the stream was partly read
+            end = f.tell()
+        else:
+            end = trace_size(data_fname)
+        if (stop is None or pos < stop) and pos < end:
+            warn_unparsed(data_fname, pos, end)
+    return pos
+
+_head = struct.Struct('<HI')     # tid, value
+_field = struct.Struct('<IIH')   # obj, dex, detail_idx
+_u8 = struct.Struct('<Q')
+_u4 = struct.Struct('<I')
+_u4u4 = struct.Struct('<II')
+
+def parse_data_mmap(data_fname, callbacks=[], verbose=True, start=None, stop=None):
+    '''
+    Same callback contract as parse_data(), but every record is decoded
+    with struct.unpack_from directly on the memory-mapped file, so no
+    intermediate bytes object is made except for exception / message strings.
+    '''
+    callbacks = callback_list(callbacks)
+    from mt_storage import is_compressed
+    if is_compressed(data_fname):
+        return parse_data_stream(data_fname, callbacks, verbose, start, stop)
+    with open(data_fname, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        version, log_flag, timestamp = parse_header(buf[:HEADER_SIZE])
+        if verbose:
+            print("MiniTrace Log Version {}".format(version))
+            print("Log with flag {}, timestamp {}".format(
+                hex(log_flag),
+                datetime.datetime.fromtimestamp(timestamp//1000).strftime("%Y/%m/%d %H:%M:%S")))
+
+        end = len(buf)
+        pos = HEADER_SIZE if start is None else start
+        limit = end if stop is None else min(stop, end)
+        pos, stopped = parse_buffer(buf, version, callbacks, pos, limit)
+        if not stopped and pos < limit:
+            warn_unparsed(data_fname, pos, end)
+    return pos
+
+def parse_data_stream(data_fname, callbacks=[], verbose=True, start=None, stop=None,
+        read_size=1 << 22):
+    '''
+    parse_data_mmap() over chunks read from data_fname, for traces which
+    cannot be mapped such as the compressed ones of mt_storage.py
+    '''
+    from mt_storage import open_trace
+    callbacks = callback_list(callbacks)
+    with open_trace(data_fname) as f:
+        version, log_flag, timestamp = parse_header(f.read(HEADER_SIZE))
+        if verbose:
+            print("MiniTrace Log Version {}".format(version))
+            print("Log with flag {}, timestamp {}".format(
+                hex(log_flag),
+                datetime.datetime.fromtimestamp(timestamp//1000).strftime("%Y/%m/%d %H:%M:%S")))
+
+        offset = HEADER_SIZE if start is None else start
+        if start is not None:
+            f.seek(start)
+        carry = b''
+        stopped = False
+        while stop is None or offset < stop:
+            chunk = f.read(read_size)
+            buf = carry + chunk
+            limit = len(buf) if stop is None else min(stop - offset, len(buf))
+            pos, stopped = parse_buffer(buf, version, callbacks, 0, limit)
+            carry = buf[pos:]
+            offset += pos
+            if stopped or not chunk:
+                break
+        if not stopped and carry and (stop is None or offset < stop):
+            warn_unparsed(data_fname, offset, offset + len(carry))
+    return offset
+
+def warn_unparsed(data_fname, pos, end):
+    # A truncated tail, or a record which parse_data() cannot go over
+    print("Warning: {} bytes of {} from offset {} are not parsed".format(
+        end - pos, data_fname, pos), file=sys.stderr)
+
+def parse_buffer(buf, version, callbacks, pos, limit):
+    '''
+    Parse records of buf from pos, which is a record boundary, until limit
+    or the first incomplete record. callbacks should be from callback_list().
+    Returns (pos, stopped)
+        - pos: offset of the first record which was not parsed
+        - stopped: whether a callback raised StopParsingData
+    '''
+    if not any(callbacks[:5]):
+        return _parse_buffer_sparse(buf, version, callbacks, pos, limit)
+
+    unpack_head = _head.unpack_from
+    unpack_field = _field.unpack_from
+    unpack_u8 = _u8.unpack_from
+    unpack_u4u4 = _u4u4.unpack_from
+    method_callbacks = callbacks[:3]
+    target_base = 13-3 if version >= 4 else 10-3
+    target_size = 10 if version >= 4 else 6
+    end = len(buf)
+    try:
+        # every record has at least 6 bytes
+        while pos < limit and pos + 6 <= end:
+            tid, value = unpack_head(buf, pos)
+            if tid > 5:
+                action = value & kMiniTraceActionMask
+                if action <= 2: # method event
+                    callback = method_callbacks[action]
+                    if callback:
+                        callback(tid, value & ~kMiniTraceActionMask)
+                    pos += 6
+                elif action <= 4: # field event
+                    if pos + 16 > end:
+                        break
+                    callback = callbacks[action]
+                    if callback:
+                        obj, dex, detail_idx = unpack_field(buf, pos + 6)
+                        callback(tid, value & ~kMiniTraceActionMask, obj, dex, detail_idx)
+                    pos += 16
+                elif action <= 6: # exception / message
+                    size = value >> 3
+                    if size < 6 or pos + size > end:
+                        break
+                    callback = callbacks[action]
+                    if callback:
+                        # ended with null character
+                        content = bytes(buf[pos + 6:pos + size - 1])
+                        try:
+                            callback(tid, content.decode())
+                        except UnicodeDecodeError:
+                            print("Failed to decode ->", content[:100], file=sys.stderr)
+                            raise
+                    pos += size
+                else:
+                    raise RuntimeError
+            elif tid <= 1:
+                # Idle / Pinging event
+                if pos + 10 > end:
+                    break
+                callback = callbacks[7 + tid]
+                if callback:
+                    callback(unpack_u8(buf, pos + 2)[0])
+                pos += 10
+            elif tid == 2:
+                if callbacks[9]:
+                    callbacks[9](value)
+                pos += 6
+            else:
+                if pos + target_size > end:
+                    break
+                callback = callbacks[target_base + tid]
+                if callback:
+                    if version >= 4:
+                        callback(*unpack_u4u4(buf, pos + 2))
+                    else:
+                        callback(value)
+                pos += target_size
+    except StopParsingData:
+        return pos, True
+    return pos, False
+
+def _parse_buffer_sparse(buf, version, callbacks, pos, limit):
+    # parse_buffer() without method / field callbacks: those records are
+    # skipped by their first bytes, without unpacking them or any call
+    unpack_u4 = _u4.unpack_from
+    unpack_u8 = _u8.unpack_from
+    unpack_u4u4 = _u4u4.unpack_from
+    target_base = 13-3 if version >= 4 else 10-3
+    target_size = 10 if version >= 4 else 6
+    end = len(buf)
+    try:
+        while pos < limit and pos + 6 <= end:
+            if buf[pos + 1] or buf[pos] > 5:
+                action = buf[pos + 2] & kMiniTraceActionMask
+                if action <= 2: # method event
+                    pos += 6
+                elif action <= 4: # field event
+                    if pos + 16 > end:
+                        break
+                    pos += 16
+                elif action <= 6: # exception / message
+                    size = unpack_u4(buf, pos + 2)[0] >> 3
+                    if size < 6 or pos + size > end:
+                        break
+                    callback = callbacks[action]
+                    if callback:
+                        # ended with null character
+                        content = bytes(buf[pos + 6:pos + size - 1])
+                        try:
+                            callback(buf[pos] | (buf[pos + 1] << 8), content.decode())
+                        except UnicodeDecodeError:
+                            print("Failed to decode ->", content[:100], file=sys.stderr)
+                            raise
+                    pos += size
+                else:
+                    raise RuntimeError
+                continue
+
+            tid = buf[pos]
+            if tid <= 1:
+                # Idle / Pinging event
+                if pos + 10 > end:
+                    break
+                callback = callbacks[7 + tid]
+                if callback:
+                    callback(unpack_u8(buf, pos + 2)[0])
+                pos += 10
+            elif tid == 2:
+                if callbacks[9]:
+                    callbacks[9](unpack_u4(buf, pos + 2)[0])
+                pos += 6
+            else:
+                if pos + target_size > end:
+                    break
+                callback = callbacks[target_base + tid]
+                if callback:
+                    if version >= 4:
+                        callback(*unpack_u4u4(buf, pos + 2))
+                    else:
+                        callback(unpack_u4(buf, pos + 2)[0])
+                pos += target_size
+    except StopParsingData:
+        return pos, True
+    return pos, False
 
 def pprint_counter(dic, methods, threads):
     # store to collapsed file
@@ -318,20 +710,9 @@ def collapse(prefix):
     methods = parse_methodinfo(method_fname)
 
     # Collapse binary log. Get count of method invocation for each thread
-    ret = dict() # DICT RET : tid -> (DICT : method_loc -> count)
-    def count_method(tid, fptr):
-        if fptr in methods:
-            if tid not in ret:
-                ret[tid] = {fptr: 1}
-            else:
-                try:
-                    ret[tid][fptr] += 1
-                except KeyError as e:
-                    ret[tid][fptr] = 1
-        else:
-            print("Warning on collapse: function %08X not found" % fptr, file=sys.stderr)
-
-    parse_data(data_fname, {kMiniTraceMethodEnter: count_method})
+    from mt_blocks import count_method_entries
+    from mt_storage import discard_trace
+    ret = count_method_entries(data_fname, methods) # DICT RET : tid -> (DICT : method_loc -> count)
 
     with open(out_fname, 'wt') as f:
         # store to collapsed file
@@ -346,10 +727,14 @@ def collapse(prefix):
                 f.write('\t'.join(methods[method_ptr]))
                 f.write('\n')
 
-    os.remove(data_fname)
+    discard_trace(data_fname)
     return 0
 
-def collapse_v2(prefix):
+def collapse_v2(prefix, workers=1, method_db=None, topk=None):
+    # workers other than 1 decode each data file with a process pool, None for CPU count
+    # method_db: sqlite3 file of global method ids, to save prefix + method_gid.npz
+    # topk: keep only given number of methods per thread in bounded memory, with their
+    #   error bounds in collapse_{idx}_topk.txt. Data files are then decoded in this process
     method_fname = prefix + "info_m.log"
     thread_fname = prefix + "info_t.log"
 
@@ -361,35 +746,47 @@ def collapse_v2(prefix):
     methods = parse_methodinfo(method_fname)
     threads = parse_threadinfo(thread_fname)
 
-
-    for data_fname in glob.glob(prefix + "data_*.bin"):
+    if topk is not None:
+        from mt_topk import count_method_entries_topk, write_report
+        count_method_entries = functools.partial(count_method_entries_topk, k=topk)
+    elif workers == 1:
+        from mt_blocks import count_method_entries
+    else:
+        from mt_parallel import count_method_entries
+        count_method_entries = functools.partial(count_method_entries, workers=workers)
+    from mt_storage import glob_traces, discard_trace
+    from mt_checkpoint import atomic_pickle
+    for data_fname in glob_traces(prefix):
         idx = re.match(r"data_(.*)\.bin", data_fname[len(prefix):]).group(1)
         out_fname = prefix + "collapse_{}.pk".format(idx)
 
         # Collapse binary log. Get count of method invocation for each thread
-        counter = dict() # DICT COUNTER : tid -> (DICT : fptr -> count)
-
-        def count_method(tid, fptr):
-            if fptr in methods:
-                if tid not in counter:
-                    counter[tid] = {fptr: 1}
-                else:
-                    try:
-                        counter[tid][fptr] += 1
-                    except KeyError as e:
-                        counter[tid][fptr] = 1
-            else:
-                print("Warning on collapse: function %08X not found" % fptr, file=sys.stderr)
-
-        parse_data(data_fname, {kMiniTraceMethodEnter: count_method})
-
-        os.remove(data_fname)
-        with open(out_fname, 'wb') as pkfile:
-            pickle.dump(counter, pkfile)
-
+        counter = count_method_entries(data_fname, methods=methods) # DICT COUNTER : tid -> (DICT : fptr -> count)
+        if topk is not None:
+            get_method_info = lambda ptr:methods[ptr] if ptr in methods else ["method_%08X" % ptr]
+            write_report(prefix + "collapse_{}_topk.txt".format(idx),
+                [('Thread {} {}'.format(tid, threads[tid] if tid in threads else "Thread-%d" % tid), summary)
+                    for tid, summary in counter.items()], get_method_info)
+            counter = {tid:summary.as_dict() for tid, summary in counter.items()}
+
+        # the trace is removed only once its counts are durable
+        atomic_pickle(out_fname, counter)
+        discard_trace(data_fname)
+
+    if method_db is not None:
+        save_method_remap(prefix, method_db)
     return 0
 
-def collapse_per_message(prefix):
+def save_method_remap(prefix, method_db):
+    # prefix + method_gid.npz : method pointers of prefix -> ids of method_db
+    from mt_methodid import MethodDictionary, build_remap
+    with MethodDictionary(method_db) as dictionary:
+        build_remap(prefix, dictionary)
+
+def collapse_per_message(prefix, checkpoint_interval=60.0):
+    # per_message.txt is written atomically, with a checkpoint every checkpoint_interval
+    # seconds (None for none) from which an interrupted run resumes. Data files are
+    # removed only once per_message.txt is complete.
     method_fname = prefix + "info_m.log"
     thread_fname = prefix + "info_t.log"
 
@@ -401,7 +798,9 @@ def collapse_per_message(prefix):
     methods = parse_methodinfo(method_fname)
     threads = parse_threadinfo(thread_fname)
 
-    data_files = glob.glob(prefix + "data_*.bin") # remaining binaries should be removed
+    from mt_storage import glob_traces, discard_trace
+    from mt_checkpoint import CollapseCheckpoint, collapse_traces
+    data_files = glob_traces(prefix) # remaining binaries should be removed
 
     class Counter:
         def __init__(self, threads, methods, outf):
@@ -423,6 +822,21 @@ def collapse_per_message(prefix):
             else:
                 print("Warning on collapse: function %08X not found" % fptr, file=sys.stderr)
 
+        def method_batch(self, records):
+            # method_callback for every method entry of records
+            from mt_blocks import add_counts
+            entered = records[records['action'] == kMiniTraceMethodEnter]
+            counts = dict()
+            add_counts(counts, (entered['tid'].astype('u8') << 32) | entered['ptr'])
+            for key, count in counts.items():
+                tid = key >> 32
+                fptr = key & 0xFFFFFFFF
+                if fptr in self.methods:
+                    m2c = self.dict.setdefault(tid, dict())
+                    m2c[fptr] = m2c.get(fptr, 0) + count
+                else:
+                    print("Warning on collapse: function %08X not found (%d times)" % (fptr, count), file=sys.stderr)
+
         def message_callback(self, tid, content):
             # store to file
             self.outf.write("[Message] {}\n".format(self.cur_message))
@@ -445,31 +859,33 @@ def collapse_per_message(prefix):
             self.dict.clear()
 
 
-    with open(prefix + "per_message.txt", 'wt') as outf:
-        # Get count of method invocation for each thread, seperate for each message called
-        # DICT COUNTER: tid -> (DICT : method_loc -> count)
-        counter = Counter(threads, methods, outf)
-        idx = 0
-        data_fname = prefix + "data_{}.bin".format(idx)
-        while os.path.isfile(data_fname):
-            parse_data(data_fname, {0: counter.method_callback, 6: counter.message_callback})
-
-            # iterate
+    # Get count of method invocation for each thread, seperate for each message called
+    # DICT COUNTER: tid -> (DICT : method_loc -> count)
+    checkpoint = CollapseCheckpoint(prefix, prefix + "per_message.txt", checkpoint_interval)
+    state, idx, offset = checkpoint.resume()
+    counter = Counter(threads, methods, checkpoint.outf)
+    if state is not None:
+        counter.cur_message, counter.dict = state
+    done_names = collapse_traces(prefix, counter.method_batch, {6: counter.message_callback},
+        checkpoint, lambda:(counter.cur_message, counter.dict), idx, offset)
+    checkpoint.commit()
+
+    # inputs are removed only after the output is durable
+    for data_fname in done_names:
+        if data_fname in data_files:
             data_files.remove(data_fname)
-            os.remove(data_fname)
-            idx += 1
-            data_fname = prefix + "data_{}.bin".format(idx)
+        discard_trace(data_fname)
 
-        # remove files for files with incomplete index
-        # if data files with index 0, 1, 3 and 4, without 2, due to some problem..(?)
-        # data files with index 3, 4 should be removed.
-        for data_fname in data_files:
-            print("Warning on collapse: data file {} was thrown".format(data_fname))
-            os.remove(data_fname)
+    # remove files for files with incomplete index
+    # if data files with index 0, 1, 3 and 4, without 2, due to some problem..(?)
+    # data files with index 3, 4 should be removed.
+    for data_fname in data_files:
+        print("Warning on collapse: data file {} was thrown".format(data_fname))
+        discard_trace(data_fname)
 
     return 0
 
-def print_data(prefix, idx = 0):
+def print_data(prefix, idx = 0, start = None, stop = None):
     threads = parse_threadinfo(prefix + "info_t.log")
     methods = parse_methodinfo(prefix + "info_m.log")
     fields = parse_fieldinfo(prefix + "info_f.log")
@@ -478,7 +894,7 @@ def print_data(prefix, idx = 0):
     get_field_info = lambda ptr, detidx:fields[ptr, detidx] if (ptr, detidx) in fields else ["field_%08X" % ptr]
     get_thread_name = lambda tid:"%s(%d)" % (threads[tid], tid) if tid in threads else "Thread-%d" % tid
 
-    parse_data(prefix + "data_{}.bin".format(idx), [
+    parse_data_mmap(prefix + "data_{}.bin".format(idx), [
         lambda tid, ptr: print('%10s Entering  method 0x%08X %s' % \
                 (get_thread_name(tid), ptr, '\t'.join(get_method_info(ptr)))),
         lambda tid, ptr: print('%10s Exiting   method 0x%08X %s' % \
@@ -506,7 +922,7 @@ def print_data(prefix, idx = 0):
         lambda tid, func_id: print('TargetMethod #%d be entered on %s' % (func_id, get_thread_name(tid))),
         lambda tid, func_id: print('TargetMethod #%d be exited on %s' % (func_id, get_thread_name(tid))),
         lambda tid, func_id: print('TargetMethod #%d be unwinded on %s' % (func_id, get_thread_name(tid))),
-    ])
+    ], start = start, stop = stop)
 
 def print_target_data(prefix, idx = 0):
     if idx == 0:
@@ -523,7 +939,7 @@ def print_target_data(prefix, idx = 0):
     get_field_info = lambda ptr, detidx:fields[ptr, detidx] if (ptr, detidx) in fields else ["field_%08X" % ptr]
     get_thread_name = lambda tid:"%s(%d)" % (threads[tid], tid) if tid in threads else "Thread-%d" % tid
 
-    parse_data(prefix + "data_{}.bin".format(idx), {
+    parse_data_mmap(prefix + "data_{}.bin".format(idx), {
         10: lambda func_id: print('TargetMethod #%d be entered' % func_id),
         11: lambda func_id: print('TargetMethod #%d be exited' % func_id),
         12: lambda func_id: print('TargetMethod #%d be unwinded' % func_id),
@@ -535,6 +951,7 @@ def print_target_data(prefix, idx = 0):
 
 def inspect_stack(prefix, idx = 0, stack_depth = -1, end_condition = None):
     # See method stack with specific moment
+    from mt_stack import ShadowStack, UNROLL, skippable_ptrs
     threads = parse_threadinfo(prefix + "info_t.log")
     methods = parse_methodinfo(prefix + "info_m.log")
 
@@ -545,106 +962,36 @@ def inspect_stack(prefix, idx = 0, stack_depth = -1, end_condition = None):
 
     def pretty_print_stack(st):
         for i in range(len(st)-1, max(-1, stack_depth_func(st)), -1):
-            content = st[i]
-            if content == 'u':
+            ptr = st[i]
+            if ptr == UNROLL:
                 print("{} : {}".format(i, 'u'))
             else:
-                ptr, finfos = content
-                print("%d : 0x%08X %s" % (i, ptr, ', '.join(finfos)))
-
-    def remove_stack_until(st, fptr, finfos):
-        for i in range(len(st)-1, -1, -1):
-            print(st[i])
-            if st[i] != (fptr, finfos) and st[i] != 'u' and st[i][1][0] == "Ljava/lang/ThreadLocal$Values;":
-                st.pop()
-            else:
-                break
-
-    class MethodStackPerThread:
-        def __init__(self, threads, methods):
-            self.stack_per_thread = {} # tid -> stack
-            self.threads = threads
-            self.methods = methods
-
-        def get_stack(self, tid):
-            try:
-                return self.stack_per_thread[tid]
-            except KeyError:
-                self.stack_per_thread[tid] = []
-                return self.stack_per_thread[tid]
-
-        def enter(self, tid, ptr):
-            stack = self.get_stack(tid)
-            old_level = len(stack)
-            finfos = get_method_info(ptr)
-            if len(stack) > 1 and stack[-1] == 'u' and stack[-2][0] == ptr:
-                stack.pop()
-                stack.pop()
-            stack.append((ptr, get_method_info(ptr)))
-
-            print('%10s %d -> %d Entering  method 0x%08X %s' % \
-                    (get_thread_name(tid), old_level, len(stack), ptr, '\t'.join(finfos)))
-            pretty_print_stack(stack)
-            print()
-
-            # To inspect stack for specific moment
-            if end_condition is not None:
-                if end_condition(finfos):
-                    for i in range(len(stack)-1, -1, -1):
-                        print("{} : {}".format(i, stack[i]))
-                    raise StopParsingData
-
-        def exit(self, tid, ptr):
-            stack = self.get_stack(tid)
-            old_level = len(stack)
-            finfos = get_method_info(ptr)
-            if len(stack) > 0:
-                top_elem = stack.pop()
-                if top_elem == 'u': # unroll
-                    top_elem = stack.pop()
-                    if top_elem != (ptr, finfos):
-                        top_elem = stack.pop()
-                        if top_elem != (ptr, finfos):
-                            remove_stack_until(stack, ptr, finfos)
-                            top_elem = stack.pop()
-                            if top_elem != (ptr, finfos):
-                                # print(action)
-                                print(top_elem)
-                                print((ptr, finfos))
-                                raise RuntimeError
-                else:
-                    if top_elem != (ptr, finfos):
-                        remove_stack_until(stack, ptr, finfos)
-                        top_elem = stack.pop()
-                        if top_elem != (ptr, finfos):
-                            # print(action)
-                            print(top_elem)
-                            print((ptr, finfos))
-                            raise RuntimeError
-
-            print('%10s %d -> %d Exiting   method 0x%08X %s' % \
-                    (get_thread_name(tid), old_level, len(stack), ptr, '\t'.join(finfos)))
-            pretty_print_stack(stack)
-            print()
-
-        def unroll(self, tid, ptr):
-            stack = self.get_stack(tid)
-            old_level = len(stack)
-            finfos = get_method_info(ptr)
-            while len(stack) > 0 and stack[-1][0] != ptr:
-                stack.pop()
-            stack.append('u')
-
-            print('%10s %d -> %d Unrolling method 0x%08X %s' % \
-                    (get_thread_name(tid), old_level, len(stack), ptr, '\t'.join(finfos)))
-            pretty_print_stack(stack)
-            print()
-
-    mstack = MethodStackPerThread(threads, methods)
-    parse_data(prefix + "data_{}.bin".format(idx), {
-        0: mstack.enter,
-        1: mstack.exit,
-        2: mstack.unroll,
+                print("%d : 0x%08X %s" % (i, ptr, ', '.join(get_method_info(ptr))))
+
+    action_names = {
+        kMiniTraceMethodEnter: 'Entering ',
+        kMiniTraceMethodExit: 'Exiting  ',
+        kMiniTraceUnroll: 'Unrolling',
+    }
+
+    def print_observer(action, tid, ptr, old_level, stack):
+        finfos = get_method_info(ptr)
+        print('%10s %d -> %d %s method 0x%08X %s' % \
+                (get_thread_name(tid), old_level, len(stack), action_names[action], ptr, '\t'.join(finfos)))
+        pretty_print_stack(stack)
+        print()
+
+        # To inspect stack for specific moment
+        if action == kMiniTraceMethodEnter and end_condition is not None:
+            if end_condition(finfos):
+                for i in range(len(stack)-1, -1, -1):
+                    print("{} : {}".format(i, 'u' if stack[i] == UNROLL else
+                        (stack[i], get_method_info(stack[i]))))
+                raise StopParsingData
+
+    mstack = ShadowStack(skippable_ptrs(methods), observers=[print_observer])
+    callbacks = mstack.callbacks()
+    callbacks.update({
         6: lambda tid, msg: print('%10s Dispatched Message %s' % \
                 (get_thread_name(tid), msg)),
         7: lambda timestamp: print('Idle Timestamp %s %d' % \
@@ -654,107 +1001,43 @@ def inspect_stack(prefix, idx = 0, stack_depth = -1, end_condition = None):
                 (datetime.datetime.fromtimestamp(timestamp//1000).strftime("%Y/%m/%d %H:%M:%S"),
                  timestamp))
     })
+    parse_data_mmap(prefix + "data_{}.bin".format(idx), callbacks)
 
-def inspect_stack2(prefix, targetmtdlist, idx = 0):
+def inspect_stack2(prefix, targetmtdlist, idx = 0, collapsed_fname = None):
     # See method stack with specific moment
+    # collapsed_fname: file to write the contexts of target methods for flamegraph.pl
+    from mt_stack import ShadowStack, skippable_ptrs
+    from mt_cct import CallingContextTree, ContextTracker, frame_name
+    from mt_blocks import parse_data_batched
     threads = parse_threadinfo(prefix + "info_t.log")
     methods = parse_methodinfo(prefix + "info_m.log")
 
     get_method_info = lambda ptr:methods[ptr] if ptr in methods else ["method_%08X" % ptr]
-    get_thread_name = lambda tid:"%s(%d)" % (threads[tid], tid) if tid in threads else "Thread-%d" % tid
-
-    stack_depth_func = lambda st:len(st) - stack_depth if stack_depth > 0 else -1
-
-    def compress_stack(st):
-        ret = []
-        for content in st:
-            if content == 'u':
-                continue
-            ret.append(content[0]) # ptr
-        return tuple(ret)
 
-    def remove_stack_until(st, fptr, finfos):
-        for i in range(len(st)-1, -1, -1):
-            if st[i] != (fptr, finfos) and st[i] != 'u' and st[i][1][0] == "Ljava/lang/ThreadLocal$Values;":
-                st.pop()
-            else:
-                break
-
-    class MethodStackPerThread:
-        def __init__(self, threads, methods):
-            self.stack_per_thread = {} # tid -> stack
-            self.threads = threads
-            self.methods = methods
-            self.targetmtdlist = targetmtdlist
-            self.mtd_to_stack = {ptr:set() for ptr in targetmtdlist}
-
-        def get_stack(self, tid):
-            try:
-                return self.stack_per_thread[tid]
-            except KeyError:
-                self.stack_per_thread[tid] = []
-                return self.stack_per_thread[tid]
-
-        def enter(self, tid, ptr):
-            stack = self.get_stack(tid)
-            old_level = len(stack)
-            finfos = get_method_info(ptr)
-            if len(stack) > 1 and stack[-1] == 'u' and stack[-2][0] == ptr:
-                stack.pop()
-                stack.pop()
-            stack.append((ptr, get_method_info(ptr)))
-
-            if ptr in self.targetmtdlist:
-                print('Entering', get_method_info(ptr))
-                self.mtd_to_stack[ptr].add(compress_stack(stack))
+    tree = CallingContextTree()
+    mstack = ShadowStack(skippable_ptrs(methods))
+    mstack.add_observer(ContextTracker(tree, targetmtdlist))
+
+    def target_observer(action, tid, ptr, old_level, stack):
+        if action == kMiniTraceMethodEnter and ptr in mtd_to_stack:
+            print('Entering', get_method_info(ptr))
+    mtd_to_stack = {ptr:[] for ptr in targetmtdlist} # ptr -> contexts as CCT nodes
+    mstack.add_observer(target_observer)
+
+    parse_data_batched(prefix + "data_{}.bin".format(idx), mstack.batch)
+
+    for node in tree.hit_nodes():
+        mtd_to_stack[tree.ptrs[node]].append(node)
+    for ptr in mtd_to_stack:
+        print('METHOD {}'.format(get_method_info(ptr)))
+        for node in mtd_to_stack[ptr]:
+            for idx, mtd in enumerate(reversed(tree.path(node))):
+                print("{}: {}".format(idx, get_method_info(mtd)))
+            print()
+        print()
 
-        def exit(self, tid, ptr):
-            stack = self.get_stack(tid)
-            old_level = len(stack)
-            finfos = get_method_info(ptr)
-            if len(stack) > 0:
-                top_elem = stack.pop()
-                if top_elem == 'u': # unroll
-                    top_elem = stack.pop()
-                    if top_elem != (ptr, finfos):
-                        top_elem = stack.pop()
-                        if top_elem != (ptr, finfos):
-                            remove_stack_until(stack, ptr, finfos)
-                            top_elem = stack.pop()
-                            if top_elem != (ptr, finfos):
-                                raise RuntimeError
-                else:
-                    if top_elem != (ptr, finfos):
-                        remove_stack_until(stack, ptr, finfos)
-                        top_elem = stack.pop()
-                        if top_elem != (ptr, finfos):
-                            raise RuntimeError
-
-        def unroll(self, tid, ptr):
-            stack = self.get_stack(tid)
-            old_level = len(stack)
-            finfos = get_method_info(ptr)
-            while len(stack) > 0 and stack[-1][0] != ptr:
-                stack.pop()
-            stack.append('u')
-
-        def print_stacks(self):
-            for ptr in self.mtd_to_stack:
-                stacks = self.mtd_to_stack[ptr]
-                print('METHOD {}'.format(get_method_info(ptr)))
-                for stack in stacks:
-                    for idx, mtd in enumerate(reversed(stack)):
-                        print("{}: {}".format(idx, get_method_info(mtd)))
-                    print()
-                print()
-
-    mstack = MethodStackPerThread(threads, methods)
-    parse_data(prefix + "data_{}.bin".format(idx), {
-        0: mstack.enter,
-        1: mstack.exit,
-        2: mstack.unroll,
-    })
-    mstack.print_stacks()
+    if collapsed_fname is not None:
+        tree.write_collapsed(collapsed_fname, lambda ptr:frame_name(get_method_info(ptr)))
 
 def collapse_reader(fname):
     global_m2c = dict()
@@ -786,100 +1069,109 @@ def sort_method_count_pair(fname):
         a, others = item
         print('{}\t{}'.format(a, '\t'.join(others)))
 
-def collapse_directory():
-    files = glob.glob('../data/apk_with_reports/00*/mt_output_check/mt_*_collapse.txt')
-    if files == []:
+# Threads counted separately by collapse_directory()
+SUMMARY_THREADS = ["main", "FinalizerWatchdogDaemon", "ReferenceQueueDaemon", "FinalizerDaemon",
+    "HeapTrimmerDaemon", "GCDaemon", "SharedPreferencesImpl-load", "CleanupReference", "JavaBridge"]
+
+def collapse_directory(prefixes = None, method_db = None, out_dir = '.'):
+    '''
+    Method entry counts summed over prefixes, written to summary.txt and
+    summary_<thread>.txt. Methods are keyed by their global ids of
+    method_db (sqlite3, in memory if None), or by name if missing in
+    info_m.log, and counted on integer arrays.
+    Default prefixes are the ones of the first experiment.
+    '''
+    from mt_methodid import MethodDictionary, GlobalCounts, load_remap, collapsed_entries, write_summary
+    if prefixes is None:
+        prefixes = []
+        for file in glob.glob('../data/apk_with_reports/00*/mt_output_check/mt_*_collapse.txt'):
+            apkf = int(re.match(r'\.\./data/apk_with_reports/([0-9]+)/mt_output_check/mt_.*_collapse.txt', file).groups()[0])
+            if apkf < 126:
+                prefixes.append(file[:-len('collapse.txt')])
+    if prefixes == []:
         return
 
-    special_threads = ["main", "FinalizerWatchdogDaemon", "ReferenceQueueDaemon", "FinalizerDaemon",
-        "HeapTrimmerDaemon", "GCDaemon", "SharedPreferencesImpl-load", "CleanupReference", "JavaBridge"]
-    total_counts = dict()
-    thread_total_counts = dict([(t, dict()) for t in special_threads])
-    for file in files:
-        apkf = int(re.match(r'\.\./data/apk_with_reports/([0-9]+)/mt_output_check/mt_.*_collapse.txt', file).groups()[0])
-        if apkf >= 126:
-            continue
-        with open(file, 'rt') as f:
-            for line in f:
-                if line == '':
-                    break
-                thread, cnt, ptr, *mtdinfos = line.rstrip().split('\t')
-                cnt = int(cnt)
-                try:
-                    total_counts[tuple(mtdinfos)] += cnt
-                except KeyError:
-                    total_counts[tuple(mtdinfos)] = cnt
+    counts = GlobalCounts(SUMMARY_THREADS)
+    with MethodDictionary(':memory:' if method_db is None else method_db) as dictionary:
+        for prefix in prefixes:
+            counts.add(collapsed_entries(prefix, load_remap(prefix, dictionary)))
 
-                if thread in special_threads:
-                    try:
-                        thread_total_counts[thread][tuple(mtdinfos)] += cnt
-                    except KeyError:
-                        thread_total_counts[thread][tuple(mtdinfos)] = cnt
+        ranked = {thread:counts.ranked(thread) for thread in SUMMARY_THREADS}
+        total = counts.ranked()
+        rows = dictionary.rows(key for key, _ in total if not isinstance(key, str))
 
     # save to file
-    with open('summary.txt', 'wt') as f:
-        for mtdkey in sorted(total_counts.keys(), key=lambda k:-total_counts[k]):
-            f.write('{}\t{}\n'.format(total_counts[mtdkey], '\t'.join(mtdkey)))
-
-    for thread in special_threads:
+    write_summary(os.path.join(out_dir, 'summary.txt'), total, rows)
+    for thread in SUMMARY_THREADS:
         # save to file
-        with open('summary_{}.txt'.format(thread), 'wt') as f:
-            for mtdkey in sorted(thread_total_counts[thread].keys(), key=lambda k:-thread_total_counts[thread][k]):
-                f.write('{}\t{}\n'.format(thread_total_counts[thread][mtdkey], '\t'.join(mtdkey)))
+        write_summary(os.path.join(out_dir, 'summary_{}.txt'.format(thread)), ranked[thread], rows)
 
-def collapse_per_message_2(prefix):
+def collapse_per_message_2(prefix, topk=None, out_name=None, checkpoint_interval=60.0):
     # See method stack with specific moment
+    # topk: keep only given number of methods per message and idle, printed with error bounds
+    # out_name: write to prefix + out_name instead of stdout, atomically and with a checkpoint
+    #   every checkpoint_interval seconds, from which an interrupted run resumes
     threads = parse_threadinfo(prefix + "info_t.log")
     methods = parse_methodinfo(prefix + "info_m.log")
 
     get_method_info = lambda ptr:methods[ptr] if ptr in methods else ["method_%08X" % ptr]
 
+    from mt_blocks import add_counts
+    from mt_checkpoint import CollapseCheckpoint, collapse_traces
+    if topk is None:
+        new_counter = dict
+        ranked = lambda counter:[(ptr, '%d' % counter[ptr])
+            for ptr in sorted(counter, key=lambda ptr:-counter[ptr])]
+    else:
+        from mt_topk import SpaceSaving
+        new_counter = lambda:SpaceSaving(topk)
+        add_counts = lambda counter, ptrs:counter.add(ptrs)
+        ranked = lambda counter:[(ptr, '%d\t%d' % (count, error)) for ptr, count, error in counter.top()]
+
     main_tid = min(threads.keys())
     dispatchMessage_ptr = methods.find_method_ptr("Landroid/os/Handler;", "dispatchMessage")
     # Assume only non-basic, non-app methods are logged
     class MsgCollapser:
         def __init__(self):
             self.cur_message_name = None
-            self.mtds_per_message = dict() # per message
+            self.mtds_per_message = new_counter() # per message
 
             self.cur_idle_idx = 0
-            self.mtds_per_idle = dict() # per idle
+            self.mtds_per_idle = new_counter() # per idle
             self.msgs_per_idle = []
 
-        def enter(self, tid, ptr):
-            if tid == main_tid:
-                if self.cur_message_name is not None:
-                    try:
-                        self.mtds_per_message[ptr] += 1
-                    except KeyError:
-                        self.mtds_per_message[ptr] = 1
-
-            try:
-                self.mtds_per_idle[ptr] += 1
-            except KeyError:
-                self.mtds_per_idle[ptr] = 1
-
         def exit(self, tid, ptr):
             if ptr == dispatchMessage_ptr:
                 # flush main functions
-                print('[Message %s]' % self.cur_message_name)
-                for ptr in sorted(self.mtds_per_message, key=lambda ptr:-self.mtds_per_message[ptr]):
-                    print('0x%08X\t%d\t%s' % (
+                print('[Message %s]' % self.cur_message_name, file=out)
+                for ptr, count in ranked(self.mtds_per_message):
+                    print('0x%08X\t%s\t%s' % (
                         ptr,
-                        self.mtds_per_message[ptr],
-                        '\t'.join(get_method_info(ptr))))
-                self.mtds_per_message.clear()
+                        count,
+                        '\t'.join(get_method_info(ptr))), file=out)
+                self.mtds_per_message = new_counter()
                 self.cur_message_name = None
 
-        def unroll(self, tid, ptr):
-            # self.exit(tid, ptr)
-            if ptr == dispatchMessage_ptr:
-                self.cur_msg_id = -1
+        def batch(self, records):
+            # enter / exit for every record, counted in bulk between exits of dispatchMessage
+            closes = ((records['action'] == kMiniTraceMethodExit)
+                & (records['ptr'] == dispatchMessage_ptr)).nonzero()[0].tolist()
+            start = 0
+            for close in closes + [len(records)]:
+                run = records[start:close]
+                entered = run['action'] == kMiniTraceMethodEnter
+                ptrs = run['ptr'][entered]
+                if self.cur_message_name is not None:
+                    add_counts(self.mtds_per_message, ptrs[run['tid'][entered] == main_tid])
+                add_counts(self.mtds_per_idle, ptrs)
+                if close < len(records):
+                    self.exit(int(records['tid'][close]), dispatchMessage_ptr)
+                start = close + 1
 
         # this is called by just below the entering dispatchMessage event
         def message_dispatched(self, tid, msg):
             # flush buffer out
-            assert self.mtds_per_message == dict() and self.cur_message_name is None
+            assert len(self.mtds_per_message) == 0 and self.cur_message_name is None
             self.cur_message_name = msg
             self.msgs_per_idle.append(msg)
 
@@ -888,128 +1180,162 @@ def collapse_per_message_2(prefix):
             print('[Idle id=%d] %s %d' % (
                 self.cur_idle_idx,
                 datetime.datetime.fromtimestamp(timestamp//1000).strftime("%Y/%m/%d %H:%M:%S"),
-                timestamp))
+                timestamp), file=out)
 
-            print('[Idle id=%d] Executed messages' % self.cur_idle_idx)
+            print('[Idle id=%d] Executed messages' % self.cur_idle_idx, file=out)
             for msg in self.msgs_per_idle:
-                print(msg)
+                print(msg, file=out)
 
-            for ptr in sorted(self.mtds_per_idle, key=lambda ptr:-self.mtds_per_idle[ptr]):
-                print('0x%08X\t%d\t%s' %
+            for ptr, count in ranked(self.mtds_per_idle):
+                print('0x%08X\t%s\t%s' %
                     (ptr,
-                     self.mtds_per_idle[ptr],
-                     '\t'.join(get_method_info(ptr))))
+                     count,
+                     '\t'.join(get_method_info(ptr))), file=out)
 
-            self.mtds_per_idle.clear()
+            self.mtds_per_idle = new_counter()
             self.msgs_per_idle.clear()
             self.cur_idle_idx += 1
 
     collapser = MsgCollapser()
-
-    idx = 0
-    bin_name = prefix + "data_{}.bin".format(idx)
-    done_names = []
-    while os.path.isfile(bin_name):
-        parse_data(bin_name, {
-            0: collapser.enter,
-            1: collapser.exit,
-            2: collapser.unroll,
-            6: collapser.message_dispatched,
-            7: collapser.idle
-        })
-        done_names.append(bin_name)
-
-        idx += 1
-        bin_name = prefix + "data_{}.bin".format(idx)
+    checkpoint = None
+    idx, offset = 0, None
+    out = sys.stdout
+    if out_name is not None:
+        checkpoint = CollapseCheckpoint(prefix, prefix + out_name, checkpoint_interval)
+        state, idx, offset = checkpoint.resume()
+        if state is not None:
+            vars(collapser).update(state)
+        out = checkpoint.outf
+
+    done_names = collapse_traces(prefix, collapser.batch, {
+        6: collapser.message_dispatched,
+        7: collapser.idle
+    }, checkpoint, lambda:vars(collapser), idx, offset)
+    if checkpoint is not None:
+        checkpoint.commit()
 
     print('Collapsing files done: ', done_names)
     # os.remove()
 
-def collapse_per_message_binary(prefix):
-    # See method stack with specific moment
-    threads = parse_threadinfo(prefix + "info_t.log")
-    methods = parse_methodinfo(prefix + "info_m.log")
-
-    main_tid = min(threads.keys())
-    dispatchMessage_ptr = methods.find_method_ptr("Landroid/os/Handler;", "dispatchMessage")
+# Assume only non-basic, non-app methods are logged
+class MessageCollapser:
     '''
-    messages.pickle = dict: msgid -> message_name
-    mtds_per_message.pickle = dict: msgid -> {invoked_methods -> entered_count}
-    idle_infos.pickle = list of tuple: (timestamp, list: messages, dict: {invoked_methods -> entered_count})
+    Counts of entered methods per message of the main thread, and per idle
     '''
-    # Assume only non-basic, non-app methods are logged
-    class MsgCollapser:
-        def __init__(self):
-            self.messages = dict()
-            self.cur_msg_id = -1
-            self.mtds_per_message = dict() # per message
-
-            self.idle_infos = []
-            self.cur_msgs_per_idle = []
-            self.cur_mtds_per_idle = dict()
+    def __init__(self, main_tid, dispatchMessage_ptr):
+        self.main_tid = main_tid
+        self.dispatchMessage_ptr = dispatchMessage_ptr
+        self.messages = dict()
+        self.cur_msg_id = -1
+        self.mtds_per_message = dict() # per message
+
+        self.idle_infos = []
+        self.cur_msgs_per_idle = []
+        self.cur_mtds_per_idle = dict()
+
+    # this is called by just below the entering dispatchMessage event
+    # msg starts with [id ##]
+    def message_dispatched(self, tid, msg):
+        assert self.cur_msg_id == -1
+        self.cur_msg_id = int(msg[4:msg.index(']')])
+        self.messages[self.cur_msg_id] = msg
+        self.cur_msgs_per_idle.append(self.cur_msg_id)
+        self.mtds_per_message[self.cur_msg_id] = dict()
+
+    def enter(self, tid, ptr):
+        if tid == self.main_tid:
+            if self.cur_msg_id != -1:
+                try:
+                    self.mtds_per_message[self.cur_msg_id][ptr] += 1
+                except KeyError:
+                    self.mtds_per_message[self.cur_msg_id][ptr] = 1
 
-        # this is called by just below the entering dispatchMessage event
-        # msg starts with [id ##]
-        def message_dispatched(self, tid, msg):
-            assert self.cur_msg_id == -1
-            self.cur_msg_id = int(msg[4:msg.index(']')])
-            self.messages[self.cur_msg_id] = msg
-            self.cur_msgs_per_idle.append(self.cur_msg_id)
-            self.mtds_per_message[self.cur_msg_id] = dict()
-
-        def enter(self, tid, ptr):
-            if tid == main_tid:
-                if self.cur_msg_id != -1:
-                    try:
-                        self.mtds_per_message[self.cur_msg_id][ptr] += 1
-                    except KeyError:
-                        self.mtds_per_message[self.cur_msg_id][ptr] = 1
+        try:
+            self.cur_mtds_per_idle[ptr] += 1
+        except KeyError:
+            self.cur_mtds_per_idle[ptr] = 1
 
-            try:
-                self.cur_mtds_per_idle[ptr] += 1
-            except KeyError:
-                self.cur_mtds_per_idle[ptr] = 1
+    def exit(self, tid, ptr):
+        if ptr == self.dispatchMessage_ptr:
+            self.cur_msg_id = -1
 
-        def exit(self, tid, ptr):
-            if ptr == dispatchMessage_ptr:
-                self.cur_msg_id = -1
+    def unroll(self, tid, ptr):
+        # self.exit(tid, ptr)
+        if ptr == self.dispatchMessage_ptr:
+            self.cur_msg_id = -1
 
-        def unroll(self, tid, ptr):
-            # self.exit(tid, ptr)
-            if ptr == dispatchMessage_ptr:
+    def batch(self, records):
+        # enter / exit / unroll for every record, counted in bulk
+        from mt_blocks import add_counts
+        action = records['action']
+        ptrs = records['ptr']
+        entered = action == kMiniTraceMethodEnter
+        add_counts(self.cur_mtds_per_idle, ptrs[entered])
+        if self.cur_msg_id != -1:
+            closes = ((action == kMiniTraceMethodExit) | (action == kMiniTraceUnroll)) \
+                & (ptrs == self.dispatchMessage_ptr)
+            end = int(closes.argmax()) if closes.any() else len(records)
+            counted = entered[:end] & (records['tid'][:end] == self.main_tid)
+            add_counts(self.mtds_per_message[self.cur_msg_id], ptrs[:end][counted])
+            if end < len(records):
                 self.cur_msg_id = -1
 
-        def idle(self, timestamp):
-            self.idle_infos.append((
-                timestamp,
-                self.cur_msgs_per_idle,
-                self.cur_mtds_per_idle
-            ))
-
-            self.cur_msgs_per_idle = []
-            self.cur_mtds_per_idle = dict()
-
-        def make_pickle(self, messages_fname, mtds_per_message_fname, idle_infos_fname):
-            with open(messages_fname, 'wb') as pkfile:
-                pickle.dump(self.messages, pkfile)
-            with open(mtds_per_message_fname, 'wb') as pkfile:
-                pickle.dump(self.mtds_per_message, pkfile)
-            with open(idle_infos_fname, 'wb') as pkfile:
-                pickle.dump(self.idle_infos, pkfile)
+    def idle(self, timestamp):
+        self.idle_infos.append((
+            timestamp,
+            self.cur_msgs_per_idle,
+            self.cur_mtds_per_idle
+        ))
+
+        self.cur_msgs_per_idle = []
+        self.cur_mtds_per_idle = dict()
+
+    def callbacks(self):
+        return {
+            0: self.enter,
+            1: self.exit,
+            2: self.unroll,
+            6: self.message_dispatched,
+            7: self.idle
+        }
+
+    def make_matrix(self, dirname):
+        # Sparse store of mt_matrix, read by analyze_collapsed_pickle()
+        from mt_matrix import write_matrix
+        return write_matrix(dirname, self.messages, self.mtds_per_message, self.idle_infos,
+            (self.cur_msgs_per_idle, self.cur_mtds_per_idle))
+
+def collapse_per_message_binary(prefix, method_db=None, topk=None, recover=True):
+    # See method stack with specific moment
+    # topk: keep only given number of methods per message and idle, see mt_topk
+    # recover: skip corrupt regions of the traces instead of stopping there, see mt_recover
+    threads = parse_threadinfo(prefix + "info_t.log")
+    methods = parse_methodinfo(prefix + "info_m.log")
 
-    collapser = MsgCollapser()
+    main_tid = min(threads.keys())
+    dispatchMessage_ptr = methods.find_method_ptr("Landroid/os/Handler;", "dispatchMessage")
+    '''
+    col_matrix/ = sparse store of mt_matrix, with
+        messages: msgid -> message_name
+        methods per message: msgid -> {invoked_methods -> entered_count}
+        idle infos: list of (timestamp, list: messages, {invoked_methods -> entered_count})
+    '''
+    if topk is None:
+        collapser = MessageCollapser(main_tid, dispatchMessage_ptr)
+    else:
+        from mt_topk import TopKMessageCollapser
+        collapser = TopKMessageCollapser(main_tid, dispatchMessage_ptr, topk)
 
     idx = 0
     bin_name = prefix + "data_{}.bin".format(idx)
     done_names = []
-    while os.path.isfile(bin_name):
-        parse_data(bin_name, {
-            0: collapser.enter,
-            1: collapser.exit,
-            2: collapser.unroll,
+    from mt_blocks import parse_data_batched
+    from mt_storage import trace_exists
+    while trace_exists(bin_name):
+        parse_data_batched(bin_name, collapser.batch, {
             6: collapser.message_dispatched,
             7: collapser.idle
-        })
+        }, recover=recover, threads=threads.keys())
         done_names.append(bin_name)
 
         idx += 1
@@ -1017,30 +1343,34 @@ def collapse_per_message_binary(prefix):
 
     print('Collapsing files done: ', done_names)
     # os.remove()
-    collapser.make_pickle(prefix + "col_msgs.pk", prefix + "col_mpm.pk", prefix + "col_idle.pk")
+    from mt_matrix import matrix_dirname_of
+    collapser.make_matrix(matrix_dirname_of(prefix))
+    if topk is not None:
+        get_method_info = lambda ptr:methods[ptr] if ptr in methods else ["method_%08X" % ptr]
+        collapser.write_report(prefix + "col_topk.txt", get_method_info)
+    if method_db is not None:
+        save_method_remap(prefix, method_db)
 
 def analyze_collapsed_pickle(prefix):
-    with open(prefix + "col_msgs.pk", 'rb') as pkfile:
-        messages = pickle.load(pkfile)
-    with open(prefix + "col_mpm.pk", 'rb') as pkfile:
-        mtds_per_message = pickle.load(pkfile)
-    with open(prefix + "col_idle.pk", 'rb') as pkfile:
-        idle_infos = pickle.load(pkfile)
+    # col_matrix/ of collapse_per_message_binary(), or col_*.pk of older outputs
+    from mt_matrix import load_collapsed
+    matrix = load_collapsed(prefix)
     methods = parse_methodinfo(prefix + "info_m.log")
     get_method_info = lambda ptr:methods[ptr] if ptr in methods else ["method_%08X" % ptr]
 
-    for msgid in sorted(messages.keys()):
-        print('[Message] {}'.format(messages[msgid]))
-        for ptr in sorted(mtds_per_message[msgid], key=lambda ptr:-mtds_per_message[msgid][ptr]):
+    for msgid in matrix.message_ids():
+        print('[Message] {}'.format(matrix.message(msgid)))
+        for ptr, count in matrix.top_methods(msgid):
             print('0x%08X\t%d\t%s' % (
                 ptr,
-                mtds_per_message[msgid][ptr],
+                count,
                 '\t'.join(get_method_info(ptr))))
 
     print('---------------------------------------------')
 
     # flush mtds_per_idle
-    for timestamp, msgs, mtds in idle_infos:
+    for i in range(matrix.num_idles()):
+        timestamp, msgs, mtds = matrix.idle(i)
         print('[Idle %d %s]' % (
             timestamp,
             datetime.datetime.fromtimestamp(timestamp//1000).strftime("%Y/%m/%d %H:%M:%S")))
@@ -1050,12 +1380,62 @@ def analyze_collapsed_pickle(prefix):
             print(msg)
 
         print('[Idle] Executed methods')
-        for ptr in sorted(mtds, key=lambda ptr:-mtds[ptr]):
+        for ptr, count in mtds:
             print('0x%08X\t%d\t%s' %
                 (ptr,
-                 mtds[ptr],
+                 count,
                  '\t'.join(get_method_info(ptr))))
 
+    # after the last idle event
+    msgs, mtds = matrix.tail()
+    if msgs or mtds:
+        print('[Tail] Dispatched messages')
+        for msg in msgs:
+            print(msg)
+
+        print('[Tail] Executed methods')
+        for ptr, count in mtds:
+            print('0x%08X\t%d\t%s' %
+                (ptr,
+                 count,
+                 '\t'.join(get_method_info(ptr))))
+
+def query_collapsed(prefix, message = None, method = None, idle = None, top = None, with_all = None):
+    # Slices of col_matrix/: methods of a message, messages of a method, or an idle window
+    # with_all: list of method pointers, messages and idle windows which entered all of them
+    from mt_matrix import load_collapsed
+    matrix = load_collapsed(prefix)
+    methods = parse_methodinfo(prefix + "info_m.log")
+    get_method_info = lambda ptr:methods[ptr] if ptr in methods else ["method_%08X" % ptr]
+
+    if message is not None:
+        print('[Message] {}'.format(matrix.message(message)))
+        for ptr, count in matrix.top_methods(message, top):
+            print('0x%08X\t%d\t%s' % (ptr, count, '\t'.join(get_method_info(ptr))))
+    if method is not None:
+        print('[Method] 0x%08X %s' % (method, '\t'.join(get_method_info(method))))
+        for msgid, count in matrix.messages_of(method)[:top]:
+            print('%d\t%s' % (count, matrix.message(msgid)))
+    if idle is not None:
+        timestamp, msgs, mtds = matrix.idle(idle, top)
+        print('[Idle %d %s]' % (
+            timestamp,
+            datetime.datetime.fromtimestamp(timestamp//1000).strftime("%Y/%m/%d %H:%M:%S")))
+        for msgid in msgs:
+            print(matrix.message(msgid))
+        for ptr, count in mtds:
+            print('0x%08X\t%d\t%s' % (ptr, count, '\t'.join(get_method_info(ptr))))
+    if with_all is not None:
+        from mt_postings import load_postings
+        postings = load_postings(prefix)
+        for ptr in with_all:
+            print('[Method] 0x%08X %s' % (ptr, '\t'.join(get_method_info(ptr))))
+        for msgid, counts in postings.messages_with(with_all)[:top]:
+            print('%s\t%s' % ('\t'.join(map(str, counts)), matrix.message(msgid)))
+        for i, counts in postings.idles_with(with_all)[:top]:
+            timestamp, _, _ = matrix.idle(i, 0)
+            print('%s\t[Idle id=%d] %d' % ('\t'.join(map(str, counts)), i, timestamp))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Manager for logs from MiniTrace')
 
@@ -1064,13 +1444,22 @@ if __name__ == "__main__":
     print_parser = subparsers.add_parser('print',
         help='Print all log to read')
     print_parser.add_argument('prefix')
+    print_parser.add_argument('--message', default=None,
+        help='Print only during the message with given id, [id N], searched over data_N.bin with data_N.idx')
+    print_parser.add_argument('--idle', default=None,
+        help='Print only from n-th idle event of data_N.bin to the next one, with data_N.idx')
+    print_parser.add_argument('--idx', default='0',
+        help='N of data_N.bin to print, or of --idle')
 
     target_parser = subparsers.add_parser('target',
         help='Print for just target method called')
     target_parser.add_argument('prefix')
 
     targetall_parser = subparsers.add_parser('targetall')
-    targetall_parser.add_argument('prefixes', nargs='+')
+    targetall_parser.add_argument('prefixes', nargs='+',
+        help='Prefixes, glob patterns such as mt_output/mt_*_ are expanded')
+    targetall_parser.add_argument('-j', '--workers', default='0',
+        help='Number of worker processes, 0 for number of CPUs')
 
     stack_parser = subparsers.add_parser('stack',
         help='Print function stack for every method enter/exit')
@@ -1084,18 +1473,211 @@ if __name__ == "__main__":
         help='Print function stack for given methods')
     stack2_parser.add_argument('prefix')
     stack2_parser.add_argument('mtdptrs')
+    stack2_parser.add_argument('--collapsed', default=None,
+        help='Write contexts of the methods as collapsed stacks for flamegraph.pl')
 
     collapse_parser = subparsers.add_parser('collapse',
         help='Collapse MiniTrace logs')
-    collapse_parser.add_argument('prefix')
+    collapse_parser.add_argument('prefixes', nargs='+',
+        help='Prefixes, glob patterns such as mt_output/mt_*_ are expanded')
+    collapse_parser.add_argument('-j', '--workers', default='0',
+        help='Number of worker processes, 0 for number of CPUs')
+    collapse_parser.add_argument('--topk', default=None,
+        help='Keep only given number of methods per message, with Space-Saving error bounds')
+    collapse_parser.add_argument('--out_name', default=None,
+        help='Write to prefix + OUT_NAME instead of stdout, atomically, and resume an interrupted run')
+    collapse_parser.add_argument('--checkpoint_interval', default='60.0',
+        help='Seconds between checkpoints with --out_name')
+
+    collapse_binary_parser = subparsers.add_parser('collapse_binary',
+        help='Collapse MiniTrace logs per message into col_matrix/')
+    collapse_binary_parser.add_argument('prefixes', nargs='+',
+        help='Prefixes, glob patterns such as mt_output/mt_*_ are expanded')
+    collapse_binary_parser.add_argument('-j', '--workers', default='0',
+        help='Number of worker processes, 0 for number of CPUs')
+    collapse_binary_parser.add_argument('--method_db', default=None,
+        help='sqlite3 file of global method ids, to save method_gid.npz of each prefix')
+    collapse_binary_parser.add_argument('--topk', default=None,
+        help='Keep only given number of methods per message, error bounds in col_topk.txt')
+    collapse_binary_parser.add_argument('--no_recover', action='store_true',
+        help='Stop at the first corrupt record instead of skipping corrupt regions')
+
+    summary_parser = subparsers.add_parser('summary',
+        help='Method entries summed over collapsed prefixes, by global method id')
+    summary_parser.add_argument('prefixes', nargs='*',
+        help='Prefixes, glob patterns such as mt_output/mt_*_ are expanded')
+    summary_parser.add_argument('--method_db', default=None,
+        help='sqlite3 file of global method ids, in memory by default')
+    summary_parser.add_argument('--out_dir', default='.',
+        help='Directory of summary.txt and summary_<thread>.txt')
+
+    diff_parser = subparsers.add_parser('diff',
+        help='Compare method entries of t_N and nt_N runs of experiment units, by global method id')
+    diff_parser.add_argument('unit_dirs', nargs='+',
+        help='Directories of experiment units of tm_continuous, with t_N/ and nt_N/')
+    diff_parser.add_argument('--method_db', default=None,
+        help='sqlite3 file of global method ids, to save run_vectors.npz. In memory by default, without saving')
+    diff_parser.add_argument('--out_name', default='diff.txt',
+        help='Table written in every unit directory')
+    diff_parser.add_argument('--top', default=None,
+        help='Only given number of methods')
+    diff_parser.add_argument('--rebuild', action='store_true',
+        help='Sum the run vectors again even if run_vectors.npz is up to date')
+
+    follow_parser = subparsers.add_parser('follow',
+        help='Collapse per message while the trace is still written')
+    follow_parser.add_argument('prefix')
+    follow_parser.add_argument('--idx', default='0')
+    follow_parser.add_argument('--stream', action='store_true',
+        help='Read the trace from stdin, e.g. piped from adb exec-out')
+    follow_parser.add_argument('--device_prefix', default=None,
+        help='Follow the file on the device with adb exec-out tail -f')
+    follow_parser.add_argument('--serial', default=None)
+    follow_parser.add_argument('--checkpoint', default=None,
+        help='File to save the state periodically and resume from')
+    follow_parser.add_argument('--interval', default='1.0',
+        help='Polling interval of the local file in seconds')
+    follow_parser.add_argument('--timeout', default='10.0',
+        help='Stop after the local file did not grow for given seconds')
+    follow_parser.add_argument('--report', default='30.0',
+        help='Seconds between reports and checkpoints')
+
+    convert_parser = subparsers.add_parser('convert',
+        help='Convert data_N.bin into .npy columns in columns_N/')
+    convert_parser.add_argument('prefix')
+    convert_parser.add_argument('--parquet', action='store_true',
+        help='Also write parquet files, with pyarrow')
+
+    export_parser = subparsers.add_parser('export',
+        help='Export data_N.bin as Chrome trace-event JSON, for chrome://tracing or Perfetto')
+    export_parser.add_argument('prefix')
+    export_parser.add_argument('--idx', default='0')
+    export_parser.add_argument('--out', default=None,
+        help='Output file, gzipped if it ends with .gz. prefix + trace_N.json.gz by default')
+
+    merge_parser = subparsers.add_parser('merge',
+        help='Merge every data_N.bin of the prefixes of a run into one timeline')
+    merge_parser.add_argument('prefixes', nargs='+',
+        help='Prefixes, glob patterns such as mt_data/*/ are expanded')
+    merge_parser.add_argument('--out', default=None,
+        help='Output file, stdout by default')
+
+    slice_parser = subparsers.add_parser('slice',
+        help='Cut a time window of data_N.bin into a standalone trace, with the method stacks at its start')
+    slice_parser.add_argument('prefix')
+    slice_parser.add_argument('--to-ms', required=True,
+        help='End of the window, in milliseconds since the epoch')
+    slice_parser.add_argument('--from-ms', default=None,
+        help='Start of the window, 30 seconds before --to-ms by default')
+    slice_parser.add_argument('--idx', default=None,
+        help='Index of data_N.bin, the file written at --from-ms by default')
+    slice_parser.add_argument('--out', default=None,
+        help='Output prefix, prefix + slice_ by default')
+
+    fields_parser = subparsers.add_parser('fields',
+        help='Field accesses per thread, objects shared by threads and race candidates per message')
+    fields_parser.add_argument('prefix')
+    fields_parser.add_argument('--objects', default=None,
+        help='Number of objects tracked at once, 65536 by default')
+
+    check_parser = subparsers.add_parser('check',
+        help='Find corrupt regions and truncated tails of data_N.bin, as skipped by recovery')
+    check_parser.add_argument('prefix')
+
+    index_parser = subparsers.add_parser('index',
+        help='Build offset index data_N.idx for random access')
+    index_parser.add_argument('prefix')
 
     collapse_analyzer_parser = subparsers.add_parser('analyze',
         help='Analyze collapsed data')
-    collapse_analyzer_parser.add_argument('prefix')
+    collapse_analyzer_parser.add_argument('prefixes', nargs='+',
+        help='Prefixes, glob patterns such as mt_output/mt_*_ are expanded')
+    collapse_analyzer_parser.add_argument('-j', '--workers', default='0',
+        help='Number of worker processes, 0 for number of CPUs')
+
+    query_parser = subparsers.add_parser('query',
+        help='Query collapsed data of collapse_per_message_binary')
+    query_parser.add_argument('prefix')
+    query_parser.add_argument('--message', default=None,
+        help='Methods entered during the message of given id')
+    query_parser.add_argument('--method', default=None,
+        help='Messages which entered the method of given pointer (hex), or comma separated '
+             'pointers for messages and idle windows which entered all of them')
+    query_parser.add_argument('--idle', default=None,
+        help='Messages and methods of n-th idle window')
+    query_parser.add_argument('--top', default=None,
+        help='Only given number of rows')
 
     args = parser.parse_args()
     if args.func == 'print':
-        print_data(args.prefix)
+        if args.message is not None:
+            from mt_index import find_message_window
+            from mt_storage import trace_number
+            data_fname, start, stop = find_message_window(args.prefix, int(args.message))
+            print_data(args.prefix, trace_number(args.prefix, data_fname), start = start, stop = stop)
+        elif args.idle is not None:
+            from mt_index import load_index
+            index = load_index(args.prefix + "data_{}.bin".format(args.idx))
+            start, stop = index.idle_window(int(args.idle))
+            print_data(args.prefix, int(args.idx), start = start, stop = stop)
+        else:
+            print_data(args.prefix, int(args.idx))
+    elif args.func == 'follow':
+        from mt_follow import follow
+        follow(args.prefix, int(args.idx),
+            stream = sys.stdin.buffer if args.stream else None,
+            device_prefix = args.device_prefix,
+            serial = args.serial,
+            checkpoint = args.checkpoint,
+            interval = float(args.interval),
+            timeout = float(args.timeout),
+            report_interval = float(args.report))
+    elif args.func == 'convert':
+        from mt_columns import convert
+        from mt_storage import glob_traces
+        for data_fname in glob_traces(args.prefix):
+            idx = re.match(r"data_(.*)\.bin", data_fname[len(args.prefix):]).group(1)
+            print(convert(args.prefix, idx, parquet = args.parquet))
+    elif args.func == 'export':
+        from mt_export import export_chrome
+        out_fname = args.out
+        if out_fname is None:
+            out_fname = args.prefix + "trace_{}.json.gz".format(args.idx)
+        print('{} trace events written to {}'.format(
+            export_chrome(args.prefix, out_fname, int(args.idx)), out_fname))
+    elif args.func == 'merge':
+        from mt_merge import write_timeline
+        from mt_batch import expand_prefixes
+        if args.out is None:
+            write_timeline(expand_prefixes(args.prefixes))
+        else:
+            with open(args.out, 'wt') as f:
+                print('{} events written to {}'.format(
+                    write_timeline(expand_prefixes(args.prefixes), f), args.out))
+    elif args.func == 'slice':
+        from mt_slice import slice_trace, DEFAULT_WINDOW_MS
+        to_ms = int(args.to_ms)
+        from_ms = to_ms - DEFAULT_WINDOW_MS if args.from_ms is None else int(args.from_ms)
+        out_prefix = args.prefix + "slice_" if args.out is None else args.out
+        data_fname, start, stop = slice_trace(args.prefix, from_ms, to_ms, out_prefix,
+            None if args.idx is None else int(args.idx))
+        print('{} [{}, {}) written to {}data_0.bin'.format(data_fname, start,
+            'end' if stop is None else stop, out_prefix))
+    elif args.func == 'fields':
+        from mt_fields import write_field_report, DEFAULT_MAX_OBJECTS
+        aggregator = write_field_report(args.prefix,
+            DEFAULT_MAX_OBJECTS if args.objects is None else int(args.objects))
+        print('{} field records, {} message windows written to {}fields.txt and {}field_races.txt'.format(
+            aggregator.num_records, aggregator.num_windows, args.prefix, args.prefix))
+    elif args.func == 'check':
+        from mt_recover import check_traces
+        if check_traces(args.prefix):
+            sys.exit(1)
+    elif args.func == 'index':
+        from mt_index import build_index
+        from mt_storage import glob_traces
+        for data_fname in glob_traces(args.prefix):
+            print(build_index(data_fname))
     elif args.func == 'stack':
         count = 0
         if args.count is None:
@@ -1119,16 +1701,48 @@ if __name__ == "__main__":
         inspect_stack(args.prefix, stack_depth = depth, end_condition = end_condition)
     elif args.func == 'target':
         print_target_data(args.prefix)
-    elif args.func == 'targetall':
-        for prefix in args.prefixes:
-            print(prefix)
-            print_target_data(prefix)
+    elif args.func in ['targetall', 'collapse', 'collapse_binary', 'analyze']:
+        from mt_batch import BATCH_FUNCTIONS, expand_prefixes, run_batch
+        prefixes = expand_prefixes(args.prefixes)
+        workers = int(args.workers) or None
+        kwargs = dict()
+        if args.func == 'collapse_binary' and args.method_db is not None:
+            kwargs['method_db'] = args.method_db
+        if args.func == 'collapse_binary' and args.no_recover:
+            kwargs['recover'] = False
+        if args.func in ['collapse', 'collapse_binary'] and args.topk is not None:
+            kwargs['topk'] = int(args.topk)
+        if args.func == 'collapse' and args.out_name is not None:
+            kwargs['out_name'] = args.out_name
+            kwargs['checkpoint_interval'] = float(args.checkpoint_interval)
+        if args.func != 'targetall' and len(prefixes) == 1:
+            globals()[BATCH_FUNCTIONS[args.func]](prefixes[0], **kwargs)
+        elif run_batch(BATCH_FUNCTIONS[args.func], prefixes, workers, kwargs=kwargs):
+            sys.exit(1)
+    elif args.func == 'summary':
+        from mt_batch import expand_prefixes
+        collapse_directory(expand_prefixes(args.prefixes) if args.prefixes else None,
+            method_db = args.method_db, out_dir = args.out_dir)
+    elif args.func == 'diff':
+        from mt_methodid import MethodDictionary
+        from mt_diff import diff_runs, write_diff
+        with MethodDictionary(':memory:' if args.method_db is None else args.method_db) as dictionary:
+            for unit_dir in args.unit_dirs:
+                diff = diff_runs(unit_dir, dictionary, args.rebuild)
+                rows = dictionary.rows(diff.gids)
+                write_diff(os.path.join(unit_dir, args.out_name), diff, rows,
+                    None if args.top is None else int(args.top))
+                print('{}: {} t runs, {} nt runs, {} methods'.format(unit_dir, diff.num_t, diff.num_nt, len(diff.gids)))
+    elif args.func == 'query':
+        query_collapsed(args.prefix,
+            message = None if args.message is None else int(args.message),
+            method = None if args.method is None or ',' in args.method else int(args.method, 16),
+            with_all = None if args.method is None or ',' not in args.method \
+                else [int(ptr, 16) for ptr in args.method.split(',')],
+            idle = None if args.idle is None else int(args.idle),
+            top = None if args.top is None else int(args.top))
     elif args.func == 'stack2':
         mtdptrs = list(map(lambda s:int(s,16), args.mtdptrs.split(',')))
-        inspect_stack2(args.prefix, mtdptrs)
-    elif args.func == 'collapse':
-        collapse_per_message_2(args.prefix)
-    elif args.func == 'analyze':
-        analyze_collapsed_pickle(args.prefix)
+        inspect_stack2(args.prefix, mtdptrs, collapsed_fname=args.collapsed)
     else:
         raise
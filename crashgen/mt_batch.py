@@ -0,0 +1,85 @@
+'''
+Process-pool batch mode for consumer.py subcommands over many prefixes
+
+Each prefix is handled by a worker process of a bounded ProcessPoolExecutor,
+so collapsing / analyzing several MiniTrace outputs does not fight over the
+GIL. A worker writes whatever the subcommand prints into a temporary file;
+the parent copies those files to stdout in the order of the given prefixes,
+so the merged output is the same whatever order the jobs finish in.
+'''
+import os, sys
+import glob
+import shutil
+import tempfile
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+# subcommand -> function name in consumer.py, called with a prefix
+BATCH_FUNCTIONS = {
+    'targetall': 'print_target_data',
+    'collapse': 'collapse_per_message_2',
+    'collapse_binary': 'collapse_per_message_binary',
+    'analyze': 'analyze_collapsed_pickle',
+}
+
+def expand_prefixes(patterns):
+    '''
+    Prefixes with glob characters are matched against their info_t.log,
+    i.e. 'mt_output/mt_*_' or 'mt_data/*/'. Results keep the order of the
+    patterns, and are sorted within one pattern.
+    '''
+    prefixes = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            suffix = 'info_t.log'
+            matched = sorted(fname[:-len(suffix)] for fname in glob.glob(pattern + suffix))
+            if not matched:
+                print('Warning: no prefix matched with {}'.format(pattern), file=sys.stderr)
+        else:
+            matched = [pattern]
+        for prefix in matched:
+            if prefix not in prefixes:
+                prefixes.append(prefix)
+    return prefixes
+
+def run_job(func_name, prefix, out_fname, kwargs=None):
+    # Runs in a worker process, returns formatted exception or None
+    import consumer
+    func = getattr(consumer, func_name)
+    with open(out_fname, 'wt') as outf, contextlib.redirect_stdout(outf):
+        try:
+            func(prefix, **(kwargs or {}))
+        except Exception:
+            return traceback.format_exc()
+    return None
+
+def run_batch(func_name, prefixes, workers=None, header=True, kwargs=None):
+    '''
+    Run consumer.<func_name>(prefix, **kwargs) for every prefix with a process pool
+    of given size (None: number of CPUs). Outputs are printed in the order of prefixes.
+    Returns list of prefixes which failed.
+    '''
+    failed = []
+    tmpdir = tempfile.mkdtemp(prefix='mt_batch_')
+    try:
+        out_fnames = [os.path.join(tmpdir, '{}.txt'.format(i)) for i in range(len(prefixes))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_job, func_name, prefix, out_fname, kwargs)
+                for prefix, out_fname in zip(prefixes, out_fnames)]
+            for prefix, out_fname, future in zip(prefixes, out_fnames, futures):
+                error = future.result()
+                if header:
+                    print(prefix)
+                sys.stdout.flush()
+                with open(out_fname, 'rt') as f:
+                    shutil.copyfileobj(f, sys.stdout)
+                sys.stdout.flush()
+                os.remove(out_fname)
+                if error is not None:
+                    print('Failure on {} with {}'.format(func_name, prefix), file=sys.stderr)
+                    print(error, file=sys.stderr)
+                    failed.append(prefix)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return failed
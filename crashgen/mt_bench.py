@@ -0,0 +1,166 @@
+'''
+Offline benchmarks of consumer.py on synthetic traces of mt_synth.py
+
+Every benchmark runs in its own process, so peak RSS is measured separately,
+and reports events/sec, MB/sec of data_N.bin and peak RSS.
+
+    python mt_bench.py --records 2000000 --version 4
+    python mt_bench.py --prefix mt_output/synth_ parse_data collapse_v2
+'''
+import os, sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import subprocess
+import tempfile
+
+BENCHMARKS = [
+    'parse_data',
+    'parse_data_mmap',
+    'collapse_v2',
+    'collapse_per_message_binary',
+    'inspect_stack2',
+    'analyze_collapsed_pickle',
+]
+
+# analyze_collapsed_pickle reads col_matrix/ written by collapse_per_message_binary
+REQUIRES = {'analyze_collapsed_pickle': 'collapse_per_message_binary'}
+
+def _copy_prefix(prefix, dst_prefix):
+    # Hard links of the outputs, for benchmarks which remove data_N.bin
+    for fname in os.listdir(os.path.dirname(prefix) or '.'):
+        src = os.path.join(os.path.dirname(prefix), fname)
+        if not src.startswith(prefix) or not os.path.isfile(src):
+            continue
+        dst = dst_prefix + src[len(prefix):]
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+def _hot_methods(prefix, count=3):
+    # Most entered methods of the first data file, targets of inspect_stack2
+    from mt_blocks import count_method_entries
+    total = dict()
+    for m2c in count_method_entries(prefix + 'data_0.bin').values():
+        for ptr, cnt in m2c.items():
+            total[ptr] = total.get(ptr, 0) + cnt
+    return sorted(total, key=lambda ptr:-total[ptr])[:count]
+
+def run_child(name, prefix):
+    # Body of the child process, returns seconds of the benchmark
+    import consumer
+    if name == 'parse_data':
+        nop = lambda *args: None
+        start = time.perf_counter()
+        consumer.parse_data(prefix + 'data_0.bin', [nop] * 16, verbose=False)
+    elif name == 'parse_data_mmap':
+        nop = lambda *args: None
+        start = time.perf_counter()
+        consumer.parse_data_mmap(prefix + 'data_0.bin', [nop] * 16, verbose=False)
+    elif name == 'collapse_v2':
+        tmpdir = tempfile.mkdtemp(prefix='mt_bench_')
+        try:
+            tmp_prefix = os.path.join(tmpdir, 'copy_')
+            _copy_prefix(prefix, tmp_prefix)
+            start = time.perf_counter()
+            consumer.collapse_v2(tmp_prefix)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(tmpdir)
+        return elapsed
+    elif name == 'collapse_per_message_binary':
+        start = time.perf_counter()
+        consumer.collapse_per_message_binary(prefix)
+    elif name == 'inspect_stack2':
+        targets = _hot_methods(prefix)
+        start = time.perf_counter()
+        consumer.inspect_stack2(prefix, targets)
+    elif name == 'analyze_collapsed_pickle':
+        start = time.perf_counter()
+        consumer.analyze_collapsed_pickle(prefix)
+    else:
+        raise ValueError(name)
+    return time.perf_counter() - start
+
+def run_benchmark(name, prefix):
+    # Returns (seconds, peak RSS in bytes) measured by a child process
+    with tempfile.NamedTemporaryFile('rt', suffix='.json') as result:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+            '--child', name, os.path.abspath(prefix), result.name],
+            stdout=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+        values = json.load(result)
+    return values['seconds'], values['maxrss']
+
+def count_records(data_fname):
+    from mt_blocks import BlockDecoder
+    return sum(len(block) for block in BlockDecoder(data_fname))
+
+def main(args):
+    names = args.benchmarks or BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark {}, one of {}'.format(name, ', '.join(BENCHMARKS)), file=sys.stderr)
+            return 1
+
+    tmpdir = None
+    prefix = args.prefix
+    if prefix is None:
+        import mt_synth
+        tmpdir = tempfile.mkdtemp(prefix='mt_bench_', dir=args.workdir)
+        prefix = os.path.join(tmpdir, 'synth_')
+        start = time.perf_counter()
+        stats = mt_synth.write_trace(prefix, num_records=int(args.records),
+            version=int(args.version), seed=int(args.seed))
+        print('Synthetic trace: {} records, {} bytes, {:.2f}s'.format(
+            stats.num_records, stats.size, time.perf_counter() - start))
+    try:
+        data_fname = prefix + 'data_0.bin'
+        size = os.path.getsize(data_fname)
+        num_records = count_records(data_fname)
+
+        done = set()
+        print('%-28s %9s %12s %9s %10s' % ('benchmark', 'seconds', 'events/s', 'MB/s', 'peak MB'))
+        for name in names:
+            required = REQUIRES.get(name)
+            if required is not None and required not in done \
+                    and not os.path.isfile(prefix + 'col_matrix/meta.json'):
+                run_benchmark(required, prefix)
+                done.add(required)
+            seconds, maxrss = run_benchmark(name, prefix)
+            done.add(name)
+            print('%-28s %9.3f %12.0f %9.2f %10.1f' % (name, seconds,
+                num_records / seconds if seconds else 0, size / seconds / 1e6 if seconds else 0,
+                maxrss / 1e6))
+            sys.stdout.flush()
+    finally:
+        if tmpdir is not None and not args.keep:
+            shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        _, _, name, prefix, result_fname = sys.argv
+        seconds = run_child(name, prefix)
+        # ru_maxrss is in kilobytes on Linux
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        with open(result_fname, 'wt') as f:
+            json.dump({'seconds': seconds, 'maxrss': maxrss}, f)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmarks of consumer.py with synthetic traces')
+    parser.add_argument('benchmarks', nargs='*',
+        help='Some of {}, all of them by default'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--prefix', default=None,
+        help='Existing MiniTrace outputs instead of a synthetic trace')
+    parser.add_argument('--records', default='1000000')
+    parser.add_argument('--version', default='4')
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('--workdir', default=None,
+        help='Directory of the synthetic trace, temporary directory by default')
+    parser.add_argument('--keep', action='store_true',
+        help='Keep the synthetic trace')
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,424 @@
+'''
+Block-oriented decoder for MiniTrace data_N.bin files
+
+parse_data() pays a handful of f.read() calls and a Python call for every
+record. BlockDecoder reads the file in large blocks, finds record boundaries
+with one skim over a per-offset record-kind table, and gathers every fixed-size
+method / field record of the block into a numpy structured array at once.
+Only the remaining records (idle, ping, thread kill, target methods,
+exceptions and messages) go through the slow path and land in
+TraceBlock.events, in the same form as parse_data() callback arguments.
+'''
+import sys
+import struct
+import datetime
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from consumer import (
+    HEADER_SIZE,
+    StopParsingData,
+    parse_header,
+    callback_list,
+    kMiniTraceMethodEnter,
+    kMiniTraceFieldRead,
+    kMiniTraceActionMask,
+    warn_unparsed
+)
+from mt_storage import open_trace
+
+DEFAULT_BLOCK_SIZE = 1 << 22
+
+RECORD_DTYPE = np.dtype([
+    ('tid', '<u2'),
+    ('action', 'u1'),
+    ('ptr', '<u4'),
+    ('obj', '<u4'),
+    ('dex', '<u4'),
+    ('detail_idx', '<u2'),
+])
+
+# Layout of a field record on the disk, method records are its first 6 bytes
+_RAW_DTYPE = np.dtype({
+    'names': ['tid', 'value', 'obj', 'dex', 'detail_idx'],
+    'formats': ['<u2', '<u4', '<u4', '<u4', '<u2'],
+    'offsets': [0, 2, 6, 10, 14],
+    'itemsize': 16,
+})
+_RAW_SIZE = 16
+
+# Record kinds in the skim table
+KIND_VARIABLE = 0   # exception / message, length is in the record
+KIND_METHOD = 1     # 6 bytes
+KIND_FIELD = 2      # 16 bytes
+KIND_SPECIAL10 = 3  # idle, ping, target method (version >= 4)
+KIND_SPECIAL6 = 4   # thread kill, target method (version 3)
+
+_u2 = struct.Struct('<H')
+_u4 = struct.Struct('<I')
+_u2u8 = struct.Struct('<HQ')
+_u2u4 = struct.Struct('<HI')
+_u2u4u4 = struct.Struct('<HII')
+
+# Reasons for skim() to stop before the end of the buffer
+SKIM_OK = 0
+SKIM_SHORT_LENGTH = 1   # exception / message shorter than its header, parse_data() stops there
+SKIM_INVALID_ACTION = 2 # parse_data() raises RuntimeError there
+SKIM_BAD_CONTENT = 3    # exception / message longer than max_size, or not null terminated
+
+class TraceBlock:
+    def __init__(self, records, offsets, events):
+        # structured array with RECORD_DTYPE, obj/dex/detail_idx are 0 for methods
+        self.records = records
+        # file offset of each record
+        self.offsets = offsets
+        # list of (record_idx, offset, event_code, args)
+        #   record_idx: number of records in this block preceding the event
+        #   event_code, args: same as the callback index and arguments of parse_data()
+        self.events = events
+        # offset of the first record after this block, set by BlockDecoder
+        self.end_offset = None
+
+    def __len__(self):
+        return len(self.records) + len(self.events)
+
+def kind_table(a, version):
+    # a: uint8 array of the block, returns kind of a record starting at each offset
+    # for every offset with at least 6 bytes left
+    m = len(a) - 5
+    lo = a[:m]
+    hi = a[1:m+1]
+    action = a[2:m+2] & kMiniTraceActionMask
+    kinds = np.where(action <= 2, KIND_METHOD,
+        np.where(action <= 4, KIND_FIELD, KIND_VARIABLE)).astype(np.uint8)
+    special = np.nonzero((hi == 0) & (lo <= 5))[0]
+    tid = lo[special]
+    kinds[special] = np.where(tid <= 1, KIND_SPECIAL10,
+        np.where(tid == 2, KIND_SPECIAL6,
+            KIND_SPECIAL10 if version >= 4 else KIND_SPECIAL6))
+    return kinds.tobytes()
+
+def skim(buf, version, pos=0, table=None, limit=None, max_size=None):
+    '''
+    Find record boundaries of buf, from pos which is a record boundary.
+    Stops at the first boundary >= limit if given. With max_size, also stops
+    at exceptions / messages longer than it or without their null character.
+    table is kind_table() of the whole buf, when it is skimmed several times.
+    Returns (fixed, slow, consumed, status)
+        - fixed: offsets of method / field records
+        - slow: list of (record_idx, offset, size) for the other records
+        - consumed: offset right after the last complete record
+        - status: SKIM_OK, or the reason why the stream cannot continue at consumed
+    '''
+    n = len(buf)
+    if n < 6:
+        return [], [], pos, SKIM_OK
+    if table is None:
+        table = kind_table(np.frombuffer(buf, np.uint8), version)
+    m = n - 5
+    if limit is not None and limit < m:
+        m = limit
+
+    fixed = []
+    slow = []
+    append = fixed.append
+    while pos < m:
+        kind = table[pos]
+        if kind == KIND_METHOD:
+            append(pos)
+            pos += 6
+            continue
+        elif kind == KIND_FIELD:
+            size = 16
+        elif kind == KIND_SPECIAL10:
+            size = 10
+        elif kind == KIND_SPECIAL6:
+            size = 6
+        else:
+            value = _u4.unpack_from(buf, pos + 2)[0]
+            if value & kMiniTraceActionMask > 6:
+                return fixed, slow, pos, SKIM_INVALID_ACTION
+            size = value >> 3
+            if size < 6:
+                return fixed, slow, pos, SKIM_SHORT_LENGTH
+            if max_size is not None and (size > max_size or (pos + size <= n and buf[pos + size - 1] != 0)):
+                return fixed, slow, pos, SKIM_BAD_CONTENT
+        if pos + size > n:
+            break
+        if kind == KIND_FIELD:
+            append(pos)
+        else:
+            slow.append((len(fixed), pos, size))
+        pos += size
+    return fixed, slow, pos, SKIM_OK
+
+def decode_fixed(buf, starts):
+    # Gather method / field records at given offsets into RECORD_DTYPE array
+    a = np.frombuffer(buf + bytes(_RAW_SIZE), np.uint8)
+    windows = as_strided(a, shape=(len(buf), _RAW_SIZE), strides=(1, 1))
+    raw = windows[np.asarray(starts, dtype=np.int64)].view(_RAW_DTYPE).ravel()
+
+    records = np.empty(len(raw), dtype=RECORD_DTYPE)
+    records['tid'] = raw['tid']
+    value = raw['value']
+    action = (value & kMiniTraceActionMask).astype(np.uint8)
+    records['action'] = action
+    records['ptr'] = value & ~np.uint32(kMiniTraceActionMask)
+    isfield = action >= kMiniTraceFieldRead
+    records['obj'] = np.where(isfield, raw['obj'], 0)
+    records['dex'] = np.where(isfield, raw['dex'], 0)
+    records['detail_idx'] = np.where(isfield, raw['detail_idx'], 0)
+    return records
+
+def event_code(buf, pos, version):
+    # Callback index of parse_data() for a non-method, non-field record
+    tid = _u2.unpack_from(buf, pos)[0]
+    if tid <= 2:
+        return 7 + tid
+    elif tid <= 5:
+        return (13-3+tid) if version >= 4 else (10-3+tid)
+    return buf[pos + 2] & kMiniTraceActionMask
+
+def decode_slow(buf, pos, size, version):
+    # Returns (event_code, args) of a non-method, non-field record
+    tid = _u2.unpack_from(buf, pos)[0]
+    if tid <= 1:
+        return 7 + tid, (_u2u8.unpack_from(buf, pos)[1], )
+    elif tid == 2:
+        return 9, (_u2u4.unpack_from(buf, pos)[1], )
+    elif tid <= 5:
+        if version >= 4:
+            return 13-3+tid, _u2u4u4.unpack_from(buf, pos)[1:]
+        return 10-3+tid, (_u2u4.unpack_from(buf, pos)[1], )
+
+    action = buf[pos + 2] & kMiniTraceActionMask
+    content = buf[pos + 6:pos + size]
+    # ended with null character
+    try:
+        return action, (tid, content[:-1].decode())
+    except UnicodeDecodeError:
+        print("Failed to decode ->", content[:min(len(content)-1, 100)], file=sys.stderr)
+        raise
+
+def make_block(buf, base, fixed, slow, version, decode_events=True, recovery=None):
+    # TraceBlock of records found by skim(), base is the file offset of buf
+    # with recovery (mt_recover.Recovery), events which fail to decode are dropped
+    records = decode_fixed(buf, fixed)
+    offsets = np.asarray(fixed, dtype=np.int64) + base
+    events = []
+    for record_idx, pos, size in slow:
+        if decode_events:
+            try:
+                code, args = decode_slow(buf, pos, size, version)
+            except UnicodeDecodeError:
+                if recovery is None:
+                    raise
+                recovery.drop_event(base + pos, size)
+                continue
+        else:
+            code, args = event_code(buf, pos, version), None
+        events.append((record_idx, base + pos, code, args))
+    return TraceBlock(records, offsets, events)
+
+class BlockDecoder:
+    '''
+    Iterate TraceBlock over data_fname.
+    With decode_events=False, args of TraceBlock.events are left as None
+    for consumers which only need the method / field records.
+    start and stop work as in parse_data(): start must be a record boundary,
+    and records starting at or after stop are not decoded. After the iteration,
+    end_offset is the offset of the first record left.
+    With recover=True, corrupt regions are skipped instead of stopping there,
+    see mt_recover, and self.recovery tells what was skipped. threads are the
+    tids of info_t.log, which helps to find records again.
+    '''
+    def __init__(self, data_fname, block_size=DEFAULT_BLOCK_SIZE, decode_events=True,
+            start=None, stop=None, recover=False, threads=()):
+        self.data_fname = data_fname
+        self.block_size = block_size
+        self.decode_events = decode_events
+        with open_trace(data_fname) as f:
+            self.version, self.log_flag, self.timestamp = parse_header(f.read(HEADER_SIZE))
+        self.start = HEADER_SIZE if start is None else start
+        self.stop = stop
+        self.truncated_bytes = 0
+        self.end_offset = self.start
+        self.recovery = None
+        if recover:
+            from mt_recover import Recovery, MAX_EVENT_SIZE
+            self.recovery = Recovery(self.version, self.timestamp, threads)
+            self.max_size = MAX_EVENT_SIZE
+        else:
+            self.max_size = None
+
+    def __iter__(self):
+        version = self.version
+        stop = self.stop
+        recovery = self.recovery
+        with open_trace(self.data_fname) as f:
+            f.seek(self.start)
+            offset = self.start
+            carry = b''
+            while True:
+                chunk = f.read(self.block_size)
+                buf = carry + chunk
+                limit = None if stop is None else stop - offset
+                fixed, slow, consumed, status = skim(buf, version, limit=limit, max_size=self.max_size)
+
+                resumed = None
+                if recovery is not None and status != SKIM_OK:
+                    fixed, slow, consumed, dropped = recovery.backtrack(buf, fixed, slow, consumed)
+                    resumed = recovery.resync(buf, consumed, fixed, complete=not chunk)
+                    if resumed is None:
+                        # nothing plausible up to the end of buf, whose last
+                        # bytes may still begin a record
+                        resumed = max(consumed + 1, len(buf) - 5) if chunk else len(buf)
+                    recovery.skip(offset + consumed, offset + resumed, dropped)
+                elif recovery is not None and not chunk and len(buf) - consumed >= 6 \
+                        and (limit is None or consumed < limit):
+                    # the length of a record running past the end may be corrupt too
+                    resumed = recovery.resync(buf, consumed, fixed, complete=True)
+                    if resumed is not None:
+                        recovery.skip(offset + consumed, offset + resumed, 0)
+
+                if fixed or slow:
+                    block = make_block(buf, offset, fixed, slow, version, self.decode_events, recovery)
+                    block.end_offset = offset + (consumed if resumed is None else resumed)
+                    if recovery is not None:
+                        recovery.learn(block.records)
+                    yield block
+
+                if resumed is not None:
+                    carry = buf[resumed:]
+                    offset += resumed
+                    self.end_offset = offset
+                    if stop is not None and offset >= stop:
+                        break
+                    continue
+
+                carry = buf[consumed:]
+                offset += consumed
+                self.end_offset = offset
+                if status == SKIM_INVALID_ACTION:
+                    raise RuntimeError
+                if status != SKIM_OK or not chunk or (stop is not None and offset >= stop):
+                    break
+            if stop is None or offset < stop:
+                self.truncated_bytes = len(carry)
+
+def batch_adapter(callbacks):
+    '''
+    Batch handler for parse_data_batched() which calls per-event callbacks
+    0-4 of parse_data() for every record
+    '''
+    callbacks = callback_list(callbacks)
+    def replay(records):
+        for tid, action, ptr, obj, dex, detail_idx in zip(
+                records['tid'].tolist(), records['action'].tolist(), records['ptr'].tolist(),
+                records['obj'].tolist(), records['dex'].tolist(), records['detail_idx'].tolist()):
+            callback = callbacks[action]
+            if callback:
+                if action <= 2:
+                    callback(tid, ptr)
+                else:
+                    callback(tid, ptr, obj, dex, detail_idx)
+    return replay
+
+def parse_data_batched(data_fname, batch, callbacks=[], verbose=True, block_size=DEFAULT_BLOCK_SIZE,
+        start=None, on_block=None, recover=False, threads=()):
+    '''
+    Same as parse_data(), except that method / field records are given in bulk
+    to batch(records), records being RECORD_DTYPE array in the trace order.
+    Events 5-15 with a callback are the boundaries: every record before such
+    an event is given to batch before the callback. A run of records between
+    two boundaries may come in several calls of batch.
+    on_block(end_offset) is called once every record of a block is given,
+    end_offset being the record boundary to resume from with start.
+    recover and threads are those of BlockDecoder, corrupt regions are
+    reported on stderr. Returns the mt_recover.Recovery with recover=True.
+    '''
+    callbacks = callback_list(callbacks)
+    decoder = BlockDecoder(data_fname, block_size, start=start, recover=recover, threads=threads)
+    if verbose:
+        print("MiniTrace Log Version {}".format(decoder.version))
+        print("Log with flag {}, timestamp {}".format(
+            hex(decoder.log_flag),
+            datetime.datetime.fromtimestamp(decoder.timestamp//1000).strftime("%Y/%m/%d %H:%M:%S")))
+
+    try:
+        for block in decoder:
+            records = block.records
+            done = 0
+            for record_idx, offset, code, args in block.events:
+                callback = callbacks[code]
+                if callback:
+                    if record_idx > done:
+                        batch(records[done:record_idx])
+                        done = record_idx
+                    callback(*args)
+            if len(records) > done:
+                batch(records[done:])
+            if on_block is not None:
+                on_block(block.end_offset)
+    except StopParsingData:
+        return decoder.recovery
+    if decoder.recovery is not None:
+        decoder.recovery.report(data_fname)
+    if decoder.truncated_bytes:
+        warn_unparsed(data_fname, decoder.end_offset, decoder.end_offset + decoder.truncated_bytes)
+    return decoder.recovery
+
+def parse_data_blocks(data_fname, callbacks=[], verbose=True, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Same interface as parse_data(), driven by BlockDecoder
+    '''
+    parse_data_batched(data_fname, batch_adapter(callbacks), callbacks, verbose, block_size)
+
+def first_appearance_counts(values):
+    # (values, counts) of distinct values, in the order of their first appearance
+    values, first, counts = np.unique(values, return_index=True, return_counts=True)
+    order = np.argsort(first, kind='stable')
+    return values[order].tolist(), counts[order].tolist()
+
+# Below this, counting in a Python loop is faster than np.unique
+SMALL_BATCH = 256
+
+def add_counts(counter, values):
+    # counter[value] += 1 for every value, keeping the insertion order of per-value updates
+    if len(values) < SMALL_BATCH:
+        get = counter.get
+        for value in values.tolist():
+            counter[value] = get(value, 0) + 1
+        return
+    for value, count in zip(*first_appearance_counts(values)):
+        counter[value] = counter.get(value, 0) + count
+
+def count_method_entries(data_fname, methods=None, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Vectorized counterpart of counting kMiniTraceMethodEnter with parse_data
+    Returns DICT COUNTER : tid -> (DICT : fptr -> count)
+    Insertion order of both dictionaries follows the first appearance in the trace.
+    '''
+    counter = dict()
+    missing = dict()
+    for block in BlockDecoder(data_fname, block_size, decode_events=False):
+        records = block.records
+        entered = records[records['action'] == kMiniTraceMethodEnter]
+        if len(entered) == 0:
+            continue
+        keys = (entered['tid'].astype(np.uint64) << np.uint64(32)) | entered['ptr']
+        for key, count in zip(*first_appearance_counts(keys)):
+            tid = key >> 32
+            fptr = key & 0xFFFFFFFF
+            if methods is not None and fptr not in methods:
+                missing[fptr] = missing.get(fptr, 0) + count
+                continue
+            try:
+                m2c = counter[tid]
+            except KeyError:
+                m2c = counter[tid] = dict()
+            m2c[fptr] = m2c.get(fptr, 0) + count
+
+    for fptr, count in missing.items():
+        print("Warning on collapse: function %08X not found (%d times)" % (fptr, count), file=sys.stderr)
+    return counter
@@ -0,0 +1,137 @@
+'''
+Calling-context tree (CCT) of MiniTrace method stacks
+
+A node of CallingContextTree is one distinct stack, interned by
+(parent node, method pointer), so memory is bounded by the number of distinct
+calling contexts rather than the number of method entries. ContextTracker is
+an observer of mt_stack.ShadowStack which keeps the node of every frame
+alongside the shadow stack, and counts hits of entered methods on their nodes
+in the same pass.
+
+    tree = CallingContextTree()
+    mstack = ShadowStack(skippable_ptrs(methods))
+    mstack.add_observer(ContextTracker(tree, targets))
+    parse_data_batched(data_fname, mstack.batch)
+    tree.write_collapsed(out_fname, name_of)
+
+write_collapsed() writes the collapsed-stack text of flamegraph.pl, one line
+per node with hits, frames from the root separated by ';'.
+'''
+from array import array
+
+from consumer import kMiniTraceMethodEnter, kMiniTraceUnroll
+
+ROOT = 0
+
+def frame_name(finfos):
+    # [Lcom/example/Foo;, bar, ...] -> com.example.Foo.bar
+    classname = finfos[0]
+    if classname.startswith('L') and classname.endswith(';'):
+        classname = classname[1:-1].replace('/', '.')
+    return '.'.join([classname] + finfos[1:2])
+
+class CallingContextTree:
+    def __init__(self):
+        # node id -> parent, ptr, hits
+        self.parents = array('i', [-1])
+        self.ptrs = array('q', [-1])
+        self.hits = array('q', [0])
+        self.children = dict() # (parent << 32) | ptr -> node id
+
+    def __len__(self):
+        return len(self.ptrs)
+
+    def child(self, parent, ptr):
+        key = (parent << 32) | ptr
+        try:
+            return self.children[key]
+        except KeyError:
+            node = self.children[key] = len(self.ptrs)
+            self.parents.append(parent)
+            self.ptrs.append(ptr)
+            self.hits.append(0)
+            return node
+
+    def hit(self, node, count=1):
+        self.hits[node] += count
+
+    def path(self, node):
+        # Method pointers from the outermost frame to node
+        ptrs = []
+        while node != ROOT:
+            ptrs.append(self.ptrs[node])
+            node = self.parents[node]
+        ptrs.reverse()
+        return tuple(ptrs)
+
+    def hit_nodes(self):
+        return [node for node, hits in enumerate(self.hits) if hits > 0]
+
+    def inclusive_hits(self):
+        # hits of every node with its descendants, children always follow their parent
+        total = array('q', self.hits)
+        for node in range(len(total) - 1, 0, -1):
+            total[self.parents[node]] += total[node]
+        return total
+
+    def collapsed(self, name_of=None):
+        # (line, hits) of nodes with hits, line being 'frame;frame;...;frame'
+        if name_of is None:
+            name_of = lambda ptr: '%08X' % ptr
+        # names of the path of each node, shared through the parent
+        names = {ROOT: ''}
+        def line_of(node):
+            try:
+                return names[node]
+            except KeyError:
+                pending = []
+                while node not in names:
+                    pending.append(node)
+                    node = self.parents[node]
+                line = names[node]
+                for node in reversed(pending):
+                    name = name_of(self.ptrs[node]).replace(';', ':').replace(' ', '_')
+                    line = names[node] = name if not line else line + ';' + name
+                return line
+        for node in self.hit_nodes():
+            yield line_of(node), self.hits[node]
+
+    def write_collapsed(self, fname, name_of=None):
+        with open(fname, 'wt') as f:
+            for line, hits in self.collapsed(name_of):
+                f.write('{} {}\n'.format(line, hits))
+
+class ContextTracker:
+    '''
+    ShadowStack observer keeping the CCT node of each frame per thread.
+    Entries of targets (every method with None) are counted as hits.
+    '''
+    def __init__(self, tree, targets=None):
+        self.tree = tree
+        self.targets = None if targets is None else set(targets)
+        self.nodes = dict() # tid -> array of node, parallel to the shadow stack
+        self.last_hit = None # (tid, ptr, node) of the last counted entry
+
+    def current(self, tid):
+        nodes = self.nodes.get(tid)
+        return nodes[-1] if nodes else ROOT
+
+    def __call__(self, action, tid, ptr, old_depth, stack):
+        nodes = self.nodes.get(tid)
+        if nodes is None:
+            nodes = self.nodes[tid] = array('i')
+        # ShadowStack only removes frames from the top and pushes one
+        depth = len(stack)
+        if action == kMiniTraceMethodEnter:
+            del nodes[depth - 1:]
+            node = self.tree.child(nodes[-1] if nodes else ROOT, ptr)
+            nodes.append(node)
+            if self.targets is None or ptr in self.targets:
+                self.tree.hits[node] += 1
+                self.last_hit = (tid, ptr, node)
+        elif action == kMiniTraceUnroll:
+            del nodes[depth - 1:]
+            # the marker is not a frame, it shares the node below it
+            nodes.append(nodes[-1] if nodes else ROOT)
+        else:
+            del nodes[depth:]
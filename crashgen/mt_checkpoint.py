@@ -0,0 +1,140 @@
+'''
+Resumable collapse runs over data_0.bin, data_1.bin, ... of a prefix
+
+A checkpointed collapse writes its output to out_fname + '.tmp'. Every
+interval seconds, at a block boundary, it saves out_fname + '.ckpt' with the
+aggregator state, the position (index of the data file, offset of the next
+record) and the size of the output written so far. Both files are fsync'ed,
+and the checkpoint replaces the previous one atomically.
+
+A restarted collapse truncates the output back to the saved size, restores
+the state and goes on from the position. commit() renames the output to
+out_fname and removes the checkpoint; inputs may be removed only after it.
+'''
+import os, sys
+import time
+import pickle
+
+from mt_storage import trace_exists, trace_size
+
+CHECKPOINT_VERSION = 1
+
+# seconds between checkpoints
+CHECKPOINT_INTERVAL = 60.0
+
+def fsync_dir(dirname):
+    # Make a rename in dirname durable
+    try:
+        fd = os.open(dirname or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def atomic_pickle(fname, obj):
+    # Atomically replace fname, so a crash leaves the previous file
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+def data_fname_of(prefix, idx):
+    return prefix + "data_{}.bin".format(idx)
+
+class CollapseCheckpoint:
+    def __init__(self, prefix, out_fname, interval=CHECKPOINT_INTERVAL):
+        # interval None: the output is still atomic, without intermediate checkpoints
+        self.prefix = prefix
+        self.out_fname = out_fname
+        self.tmp_fname = out_fname + '.tmp'
+        self.fname = out_fname + '.ckpt'
+        self.interval = interval
+        self.outf = None
+        self.last_save = time.time()
+
+    def resume(self):
+        '''
+        Opens the output as self.outf and returns (state, idx, offset) of the
+        last checkpoint, or (None, 0, None) to start over: without checkpoint,
+        or when the data file it stopped in has changed since.
+        '''
+        saved = None
+        if os.path.isfile(self.fname) and os.path.isfile(self.tmp_fname):
+            with open(self.fname, 'rb') as f:
+                saved = pickle.load(f)
+            data_fname = data_fname_of(self.prefix, saved['idx'])
+            if saved['version'] != CHECKPOINT_VERSION:
+                saved = None
+            elif saved['offset'] is not None and (not trace_exists(data_fname) \
+                    or trace_size(data_fname) != saved['data_size']):
+                print("Warning on collapse: {} changed since checkpoint {}, starting over".format(
+                    data_fname, self.fname), file=sys.stderr)
+                saved = None
+
+        if saved is None:
+            self.outf = open(self.tmp_fname, 'wt')
+            return None, 0, None
+        with open(self.tmp_fname, 'r+b') as f:
+            f.truncate(saved['out_size'])
+        self.outf = open(self.tmp_fname, 'at')
+        print("Resume collapse from {} offset {}".format(
+            data_fname_of(self.prefix, saved['idx']), saved['offset']))
+        return saved['state'], saved['idx'], saved['offset']
+
+    def due(self):
+        return self.interval is not None and time.time() - self.last_save >= self.interval
+
+    def save(self, state, idx, offset, data_size=None):
+        # offset None: data file idx is to be parsed from its beginning
+        self.outf.flush()
+        os.fsync(self.outf.fileno())
+        atomic_pickle(self.fname, {
+            'version': CHECKPOINT_VERSION,
+            'idx': idx,
+            'offset': offset,
+            'data_size': data_size,
+            'out_size': os.fstat(self.outf.fileno()).st_size,
+            'state': state,
+        })
+        self.last_save = time.time()
+
+    def commit(self):
+        # Durable output at out_fname, after which inputs can be removed
+        self.outf.flush()
+        os.fsync(self.outf.fileno())
+        self.outf.close()
+        os.replace(self.tmp_fname, self.out_fname)
+        fsync_dir(os.path.dirname(self.out_fname))
+        try:
+            os.remove(self.fname)
+        except FileNotFoundError:
+            pass
+
+def collapse_traces(prefix, batch, callbacks, checkpoint=None, get_state=None, idx=0, offset=None):
+    '''
+    parse_data_batched() over data_<idx>.bin, data_<idx+1>.bin, ... of prefix
+    from offset, up to the first missing index. With checkpoint
+    (CollapseCheckpoint, resumed by the caller), get_state() is saved every
+    checkpoint.interval seconds. Returns names of the data files parsed.
+    '''
+    from mt_blocks import parse_data_batched
+    done_names = [data_fname_of(prefix, i) for i in range(idx)]
+    while trace_exists(data_fname_of(prefix, idx)):
+        data_fname = data_fname_of(prefix, idx)
+        on_block = None
+        if checkpoint is not None:
+            data_size = trace_size(data_fname)
+            def on_block(end_offset, idx=idx, data_size=data_size):
+                if checkpoint.due():
+                    checkpoint.save(get_state(), idx, end_offset, data_size)
+        parse_data_batched(data_fname, batch, callbacks, start=offset, on_block=on_block)
+        done_names.append(data_fname)
+        idx += 1
+        offset = None
+    return done_names
@@ -0,0 +1,296 @@
+'''
+Columnar export of MiniTrace outputs
+
+convert() turns prefix + data_N.bin with its info logs into a directory
+prefix + columns_N/ of .npy columns, which later analyses load with
+np.load(mmap_mode='r') to touch only the columns they need.
+
+    record_<name>.npy   method / field records, in the trace order
+        offset, tid, action, ptr, mid
+        mid is the row of the method table, -1 for fields and unknown methods
+    field_<name>.npy    rest of the field records
+        row (in record_*.npy), obj, dex, detail_idx
+    event_<name>.npy    the other records, in the trace order
+        offset, index (number of records before it), code (callback index of
+        parse_data()), tid, value, text_start, text_end
+    event_text.bin      exception / message strings, utf-8 without null
+    methods_ptr.npy, methods.tsv    method table, dictionary of mid
+    threads.tsv, fields.tsv         copies of info_t.log, info_f.log
+    meta.json
+
+The trace is converted block by block with BlockDecoder, and every column is
+appended to its .npy file whose header is rewritten at the end, so the memory
+does not depend on the size of the trace. With parquet=True and pyarrow
+installed, records.parquet, fields.parquet and events.parquet are written as
+well, one row group per block.
+'''
+import os, sys
+import json
+import shutil
+import numpy as np
+
+from consumer import parse_methodinfo
+from mt_blocks import BlockDecoder, DEFAULT_BLOCK_SIZE, RECORD_DTYPE
+from mt_storage import trace_size
+
+COLUMNS_VERSION = 1
+
+RECORD_COLUMNS = [
+    ('offset', np.dtype('<i8')),
+    ('tid', np.dtype('<u2')),
+    ('action', np.dtype('u1')),
+    ('ptr', np.dtype('<u4')),
+    ('mid', np.dtype('<i4')),
+]
+
+FIELD_COLUMNS = [
+    ('row', np.dtype('<i8')),
+    ('obj', np.dtype('<u4')),
+    ('dex', np.dtype('<u4')),
+    ('detail_idx', np.dtype('<u2')),
+]
+
+EVENT_COLUMNS = [
+    ('offset', np.dtype('<i8')),
+    ('index', np.dtype('<i8')),
+    ('code', np.dtype('u1')),
+    ('tid', np.dtype('<u4')),
+    ('value', np.dtype('<i8')),
+    ('text_start', np.dtype('<i8')),
+    ('text_end', np.dtype('<i8')),
+]
+
+# Length of .npy header, large enough to hold any 1-d shape
+NPY_HEADER_SIZE = 128
+
+def columns_dirname_of(prefix, idx):
+    return '{}columns_{}'.format(prefix, idx)
+
+def _npy_header(dtype, length):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.lib.format.dtype_to_descr(dtype), length)
+    # magic, version 1.0, u2 header length
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+class NpyColumnWriter:
+    '''
+    Append-only 1-d .npy file, readable with np.load() after close()
+    '''
+    def __init__(self, fname, dtype):
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.f = open(fname, 'wb')
+        self.f.write(_npy_header(self.dtype, 0))
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.f.write(values.tobytes())
+        self.length += len(values)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(_npy_header(self.dtype, self.length))
+        self.f.close()
+
+class MethodTable:
+    # ptr -> mid, by searching the sorted pointers of info_m.log
+    def __init__(self, methods):
+        self.ptrs = np.array(sorted(methods), dtype=np.uint32)
+        self.rows = [methods[ptr] for ptr in self.ptrs.tolist()]
+
+    def lookup(self, ptrs):
+        if len(self.ptrs) == 0:
+            return np.full(len(ptrs), -1, dtype=np.int32)
+        mid = np.searchsorted(self.ptrs, ptrs)
+        mid = np.minimum(mid, len(self.ptrs) - 1)
+        return np.where(self.ptrs[mid] == ptrs, mid, -1).astype(np.int32)
+
+def _event_columns(block, num_records, text_out, text_pos):
+    # Columns of TraceBlock.events, text_pos is the current size of event_text.bin
+    n = len(block.events)
+    columns = {name: np.zeros(n, dtype=dtype) for name, dtype in EVENT_COLUMNS}
+    columns['text_start'][:] = -1
+    columns['text_end'][:] = -1
+    for i, (record_idx, offset, code, args) in enumerate(block.events):
+        columns['offset'][i] = offset
+        columns['index'][i] = num_records + record_idx
+        columns['code'][i] = code
+        if code in (5, 6):
+            text = args[1].encode()
+            text_out.write(text)
+            columns['tid'][i] = args[0]
+            columns['text_start'][i] = text_pos
+            text_pos += len(text)
+            columns['text_end'][i] = text_pos
+        elif code >= 13:
+            columns['tid'][i] = args[0]
+            columns['value'][i] = args[1]
+        else:
+            columns['value'][i] = args[0]
+    return columns, text_pos
+
+def _parquet_writers(dirname):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print('Warning: pyarrow is not installed, parquet files are not written', file=sys.stderr)
+        return None
+
+    def schema(columns):
+        return pa.schema([(name, pa.from_numpy_dtype(dtype)) for name, dtype in columns])
+
+    def write(writer, columns, values):
+        writer.write_table(pa.table([pa.array(values[name]) for name, _ in columns],
+            schema=writer.schema))
+
+    return {
+        'records': pq.ParquetWriter(os.path.join(dirname, 'records.parquet'), schema(RECORD_COLUMNS)),
+        'fields': pq.ParquetWriter(os.path.join(dirname, 'fields.parquet'), schema(FIELD_COLUMNS)),
+        'events': pq.ParquetWriter(os.path.join(dirname, 'events.parquet'), schema(EVENT_COLUMNS)),
+        'write': write,
+    }
+
+def convert(prefix, idx=0, dirname=None, parquet=False, block_size=DEFAULT_BLOCK_SIZE):
+    data_fname = '{}data_{}.bin'.format(prefix, idx)
+    if dirname is None:
+        dirname = columns_dirname_of(prefix, idx)
+    os.makedirs(dirname, exist_ok=True)
+
+    method_fname = prefix + 'info_m.log'
+    table = MethodTable(parse_methodinfo(method_fname) if os.path.isfile(method_fname) else {})
+    np.save(os.path.join(dirname, 'methods_ptr.npy'), table.ptrs)
+    with open(os.path.join(dirname, 'methods.tsv'), 'wt') as f:
+        for row in table.rows:
+            f.write('\t'.join(row) + '\n')
+    for src, dst in [('info_t.log', 'threads.tsv'), ('info_f.log', 'fields.tsv')]:
+        if os.path.isfile(prefix + src):
+            shutil.copyfile(prefix + src, os.path.join(dirname, dst))
+
+    record_writers = {name: NpyColumnWriter(os.path.join(dirname, 'record_{}.npy'.format(name)), dtype)
+        for name, dtype in RECORD_COLUMNS}
+    field_writers = {name: NpyColumnWriter(os.path.join(dirname, 'field_{}.npy'.format(name)), dtype)
+        for name, dtype in FIELD_COLUMNS}
+    event_writers = {name: NpyColumnWriter(os.path.join(dirname, 'event_{}.npy'.format(name)), dtype)
+        for name, dtype in EVENT_COLUMNS}
+    parquet_writers = _parquet_writers(dirname) if parquet else None
+
+    num_records = 0
+    text_pos = 0
+    decoder = BlockDecoder(data_fname, block_size)
+    with open(os.path.join(dirname, 'event_text.bin'), 'wb') as text_out:
+        for block in decoder:
+            records = block.records
+            columns = {name: records[name] for name in RECORD_DTYPE.names}
+            columns['offset'] = block.offsets
+            columns['mid'] = np.where(records['action'] <= 2, table.lookup(records['ptr']), -1)
+            isfield = np.nonzero(records['action'] >= 3)[0]
+            field_columns = {name: records[name][isfield] for name in ['obj', 'dex', 'detail_idx']}
+            field_columns['row'] = isfield + record_writers['tid'].length
+            for name, writer in record_writers.items():
+                writer.append(columns[name])
+            for name, writer in field_writers.items():
+                writer.append(field_columns[name])
+
+            # index counts every record before the event, events included
+            event_columns, text_pos = _event_columns(block, num_records, text_out, text_pos)
+            event_columns['index'] += np.arange(len(block.events))
+            for name, writer in event_writers.items():
+                writer.append(event_columns[name])
+
+            if parquet_writers is not None:
+                parquet_writers['write'](parquet_writers['records'], RECORD_COLUMNS, columns)
+                parquet_writers['write'](parquet_writers['fields'], FIELD_COLUMNS, field_columns)
+                parquet_writers['write'](parquet_writers['events'], EVENT_COLUMNS, event_columns)
+            num_records += len(block)
+
+    for writers in [record_writers, field_writers, event_writers]:
+        for writer in writers.values():
+            writer.close()
+    if parquet_writers is not None:
+        for name in ['records', 'fields', 'events']:
+            parquet_writers[name].close()
+
+    with open(os.path.join(dirname, 'meta.json'), 'wt') as f:
+        json.dump({
+            'columns_version': COLUMNS_VERSION,
+            'data_fname': os.path.basename(data_fname),
+            'data_size': trace_size(data_fname),
+            'version': decoder.version,
+            'log_flag': decoder.log_flag,
+            'timestamp': decoder.timestamp,
+            'num_records': num_records,
+            'truncated_bytes': decoder.truncated_bytes,
+        }, f, indent=2)
+    return dirname
+
+class ColumnStore:
+    '''
+    Reader of a directory made by convert(), columns are memory-mapped on demand
+    '''
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'meta.json'), 'rt') as f:
+            self.meta = json.load(f)
+        assert self.meta['columns_version'] == COLUMNS_VERSION, dirname
+        self.version = self.meta['version']
+        self._cache = dict()
+
+    def _load(self, fname):
+        try:
+            return self._cache[fname]
+        except KeyError:
+            array = self._cache[fname] = np.load(os.path.join(self.dirname, fname), mmap_mode='r')
+            return array
+
+    def record(self, name):
+        return self._load('record_{}.npy'.format(name))
+
+    def field(self, name):
+        return self._load('field_{}.npy'.format(name))
+
+    def event(self, name):
+        return self._load('event_{}.npy'.format(name))
+
+    def text(self, i):
+        # string of i-th event, for exceptions / messages
+        start, end = int(self.event('text_start')[i]), int(self.event('text_end')[i])
+        with open(os.path.join(self.dirname, 'event_text.bin'), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start).decode()
+
+    def methods(self):
+        # mid -> [classname, methodname, signature, sourcefile]
+        with open(os.path.join(self.dirname, 'methods.tsv'), 'rt') as f:
+            return [line.rstrip('\n').split('\t') for line in f]
+
+    def method_entry_counts(self, methods=None):
+        '''
+        Same result as mt_blocks.count_method_entries() without reading data_N.bin
+        Returns DICT COUNTER : tid -> (DICT : fptr -> count)
+        '''
+        entered = np.nonzero(self.record('action') == 0)[0]
+        keys = (self.record('tid')[entered].astype(np.uint64) << np.uint64(32)) \
+            | self.record('ptr')[entered]
+        keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        order = np.argsort(first, kind='stable')
+        counter = dict()
+        missing = dict()
+        for key, count in zip(keys[order].tolist(), counts[order].tolist()):
+            tid = key >> 32
+            fptr = key & 0xFFFFFFFF
+            if methods is not None and fptr not in methods:
+                missing[fptr] = missing.get(fptr, 0) + count
+                continue
+            counter.setdefault(tid, dict())[fptr] = count
+        for fptr, count in missing.items():
+            print("Warning on collapse: function %08X not found (%d times)" % (fptr, count), file=sys.stderr)
+        return counter
+
+    def target_events(self, codes=(10, 11, 12, 13, 14, 15)):
+        # (code, tid, method_id) arrays of target method events, tid is 0 with version 3
+        code = self.event('code')
+        mask = np.isin(code, codes)
+        return code[mask], self.event('tid')[mask], self.event('value')[mask]
@@ -0,0 +1,262 @@
+'''
+Method behaviour diff between targeted (t_N) and non-targeted (nt_N) runs
+
+tm_continuous.run() leaves, for every experiment unit, the runs t_0, t_1, ...
+and nt_0, nt_1, ..., each with the MiniTrace outputs of its processes in
+mt_data/*/. run_vectors() sums the method entries of every process of a run
+by global method id (mt_methodid), from col_matrix/ of collapse_binary (its
+idle windows and the tail after the last one) or from the outputs of
+collapse, into a sparse runs x gids matrix:
+
+    run_vectors.npz     is_t, numbers: kind and N of each run
+                        indptr, gids, counts: CSR of runs x gids, gids ascending
+                        dictionary: uuid of the MethodDictionary of the gids
+
+which is saved in the unit directory and reused while it is newer than the
+collapsed outputs and was made with the same database. Vectors of an
+in-memory database are not saved. diff_runs() then compares both kinds of runs for every
+method at once, with numpy over the entries of the matrix:
+
+    mean_t, mean_nt     mean entries per million entries of the run
+    log2fc              log2((mean_t + PSEUDO_RATE) / (mean_nt + PSEUDO_RATE))
+    present_t, present_nt
+                        number of runs which entered the method
+    auc, p              Mann-Whitney U of the rates as P(t > nt), and its two
+                        sided p-value (normal approximation, ties corrected)
+
+Runs which never entered a method have rate 0 there, so ranks are only
+computed over methods entered by some run.
+
+    python consumer.py diff ../results/continuous/* --method_db methods.sqlite3
+'''
+import os, sys
+import re
+import glob
+import math
+import numpy as np
+
+from mt_methodid import load_remap, collapsed_entries
+
+# entries per million entries added to both means of log2fc
+PSEUDO_RATE = 1.0
+
+RUN_PATTERN = re.compile(r'(n?t)_([0-9]+)$')
+
+def run_vectors_fname_of(unit_dir):
+    return os.path.join(unit_dir, 'run_vectors.npz')
+
+def find_runs(unit_dir):
+    # [(is_t, N, run directory)] of unit_dir, t_N first, by N
+    runs = []
+    for run_dir in glob.glob(os.path.join(unit_dir, '*_*')):
+        gp = RUN_PATTERN.match(os.path.basename(run_dir))
+        if gp and os.path.isdir(run_dir):
+            runs.append((gp.group(1) == 't', int(gp.group(2)), run_dir))
+    return sorted(runs, key=lambda run:(not run[0], run[1]))
+
+def run_prefixes(run_dir):
+    # prefixes of the processes of a run
+    return sorted(os.path.join(dirname, '') for dirname in glob.glob(os.path.join(run_dir, 'mt_data', '*'))
+        if os.path.isdir(dirname))
+
+def _input_fnames(prefix):
+    # collapsed outputs and method ids which prefix_vector() reads
+    from mt_matrix import matrix_dirname_of
+    fnames = [os.path.join(matrix_dirname_of(prefix), 'meta.json'), prefix + 'collapse.txt',
+        prefix + 'info_m.log', prefix + 'method_gid.npz']
+    return [fname for fname in fnames + glob.glob(prefix + 'collapse_*.pk') if os.path.isfile(fname)]
+
+def prefix_vector(prefix, dictionary):
+    '''
+    (gids, counts) of the method entries of prefix, over every thread, from
+    col_matrix/ if there is one, else from collapse_*.pk or collapse.txt.
+    None if prefix was not collapsed.
+    '''
+    from mt_matrix import matrix_dirname_of, open_matrix
+    remap = load_remap(prefix, dictionary)
+    if os.path.isfile(os.path.join(matrix_dirname_of(prefix), 'meta.json')):
+        arrays = open_matrix(matrix_dirname_of(prefix)).arrays
+        # idle windows and the tail after them split the entries of every thread
+        counts = np.bincount(arrays['idle_mids'], weights=arrays['idle_counts'],
+            minlength=len(arrays['methods_ptr'])).astype(np.int64)
+        if 'tail_mids' in arrays:
+            counts += np.bincount(arrays['tail_mids'], weights=arrays['tail_counts'],
+                minlength=len(arrays['methods_ptr'])).astype(np.int64)
+        gids = remap.lookup(arrays['methods_ptr'])
+        known = (gids >= 0) & (counts > 0)
+        return gids[known], counts[known]
+    entries = collapsed_entries(prefix, remap)
+    if not entries:
+        return None
+    gids = np.concatenate([gids for _, _, gids, _ in entries])
+    counts = np.concatenate([counts for _, _, _, counts in entries])
+    known = gids >= 0
+    if not known.all():
+        print('Warning: {} methods of {} are not in info_m.log'.format(
+            int((~known).sum()), prefix), file=sys.stderr)
+    return gids[known], counts[known]
+
+def _sum_by_gid(gids, counts):
+    gids, inverse = np.unique(gids, return_inverse=True)
+    return gids.astype(np.int32), np.bincount(inverse, weights=counts, minlength=len(gids)).astype(np.int64)
+
+class RunVectors:
+    def __init__(self, is_t, numbers, indptr, gids, counts, dictionary):
+        self.is_t = np.asarray(is_t, dtype=bool)
+        self.numbers = np.asarray(numbers, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.gids = np.asarray(gids, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.dictionary = str(dictionary) # uuid of the MethodDictionary
+
+    def __len__(self):
+        return len(self.is_t)
+
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            np.savez(f, is_t=self.is_t, numbers=self.numbers, indptr=self.indptr,
+                gids=self.gids, counts=self.counts, dictionary=np.array(self.dictionary))
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as f:
+            npz = np.load(f)
+            if 'dictionary' not in npz.files:
+                return None
+            return RunVectors(npz['is_t'], npz['numbers'], npz['indptr'], npz['gids'], npz['counts'],
+                npz['dictionary'])
+
+def run_vectors(unit_dir, dictionary, rebuild=False):
+    '''
+    RunVectors of the runs of unit_dir, from run_vectors.npz while it is
+    newer than every collapsed output of the runs and made with dictionary
+    '''
+    runs = [(is_t, number, run_prefixes(run_dir)) for is_t, number, run_dir in find_runs(unit_dir)]
+    fname = run_vectors_fname_of(unit_dir)
+    if not rebuild and os.path.isfile(fname):
+        mtime = os.path.getmtime(fname)
+        vectors = RunVectors.load(fname)
+        if vectors is not None and vectors.dictionary == dictionary.uuid \
+                and vectors.is_t.tolist() == [is_t for is_t, _, _ in runs] \
+                and vectors.numbers.tolist() == [number for _, number, _ in runs] \
+                and all(os.path.getmtime(input_fname) <= mtime for _, _, prefixes in runs
+                    for prefix in prefixes for input_fname in _input_fnames(prefix)):
+            return vectors
+
+    indptr = [0]
+    all_gids = []
+    all_counts = []
+    for is_t, number, prefixes in runs:
+        parts = []
+        for prefix in prefixes:
+            try:
+                vector = prefix_vector(prefix, dictionary)
+            except FileNotFoundError:
+                vector = None
+            if vector is None:
+                print('Warning: {} is not collapsed, skipped'.format(prefix), file=sys.stderr)
+                continue
+            parts.append(vector)
+        gids, counts = _sum_by_gid(np.concatenate([gids for gids, _ in parts] + [np.zeros(0, dtype=np.int32)]),
+            np.concatenate([counts for _, counts in parts] + [np.zeros(0, dtype=np.int64)]))
+        all_gids.append(gids)
+        all_counts.append(counts)
+        indptr.append(indptr[-1] + len(gids))
+
+    vectors = RunVectors([is_t for is_t, _, _ in runs], [number for _, number, _ in runs], indptr,
+        np.concatenate(all_gids + [np.zeros(0, dtype=np.int32)]),
+        np.concatenate(all_counts + [np.zeros(0, dtype=np.int64)]), dictionary.uuid)
+    if dictionary.persistent:
+        vectors.save(fname)
+    return vectors
+
+def _tied_ranks(values):
+    '''
+    Ranks from 1 of every row of values, averaged over ties, and sum of
+    t^3 - t over the ties of each row
+    '''
+    num_rows, num_cols = values.shape
+    order = np.argsort(values, axis=1, kind='stable')
+    ordered = np.take_along_axis(values, order, axis=1)
+    cols = np.broadcast_to(np.arange(num_cols), values.shape)
+    new = np.ones(values.shape, dtype=bool)
+    new[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    first = np.maximum.accumulate(np.where(new, cols, 0), axis=1)
+    last_new = np.ones(values.shape, dtype=bool)
+    last_new[:, :-1] = new[:, 1:]
+    last = np.minimum.accumulate(np.where(last_new, cols, num_cols - 1)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=1)
+    sizes = (last - first + 1).astype(np.float64)
+    # a tie of t values appears t times, each adding t^2 - 1
+    return ranks, (sizes * sizes - 1).sum(axis=1)
+
+class RunDiff:
+    def __init__(self, vectors):
+        is_t = vectors.is_t
+        self.num_t = int(is_t.sum())
+        self.num_nt = len(is_t) - self.num_t
+        rows = np.repeat(np.arange(len(vectors)), np.diff(vectors.indptr))
+        totals = np.bincount(rows, weights=vectors.counts, minlength=len(vectors))
+        rates = vectors.counts * 1e6 / np.maximum(totals, 1)[rows]
+
+        # columns: gids entered by some run
+        self.gids, col = np.unique(vectors.gids, return_inverse=True)
+        num_gids = len(self.gids)
+        entry_t = is_t[rows]
+        self.present_t = np.bincount(col[entry_t], minlength=num_gids)
+        self.present_nt = np.bincount(col[~entry_t], minlength=num_gids)
+        self.mean_t = np.bincount(col[entry_t], weights=rates[entry_t], minlength=num_gids) / max(self.num_t, 1)
+        self.mean_nt = np.bincount(col[~entry_t], weights=rates[~entry_t], minlength=num_gids) / max(self.num_nt, 1)
+        self.log2fc = np.log2((self.mean_t + PSEUDO_RATE) / (self.mean_nt + PSEUDO_RATE))
+
+        # Mann-Whitney U over the runs, t runs first
+        order = np.argsort(~is_t, kind='stable')
+        position = np.empty(len(vectors), dtype=np.int64)
+        position[order] = np.arange(len(vectors))
+        dense = np.zeros((num_gids, len(vectors)), dtype=np.float64)
+        dense[col, position[rows]] = rates
+        ranks, ties = _tied_ranks(dense)
+        n1, n2 = self.num_t, self.num_nt
+        n = n1 + n2
+        u = ranks[:, :n1].sum(axis=1) - n1 * (n1 + 1) / 2.0
+        self.auc = u / (n1 * n2) if n1 and n2 else np.full(num_gids, 0.5)
+        sigma = np.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1)))) if n > 1 else np.zeros(num_gids)
+        z = np.where(sigma > 0, (u - n1 * n2 / 2.0) / np.where(sigma > 0, sigma, 1), 0.0)
+        self.p = np.array([math.erfc(abs(value) / math.sqrt(2)) for value in z.tolist()])
+
+    def only_t(self):
+        # gids entered by every t run and no nt run
+        return self.gids[(self.present_t == self.num_t) & (self.present_nt == 0)]
+
+    def only_nt(self):
+        return self.gids[(self.present_nt == self.num_nt) & (self.present_t == 0)]
+
+    def ranked(self):
+        # column indices by ascending p, then descending |log2fc|
+        return np.lexsort((-np.abs(self.log2fc), self.p))
+
+def diff_runs(unit_dir, dictionary, rebuild=False):
+    return RunDiff(run_vectors(unit_dir, dictionary, rebuild))
+
+def write_diff(fname, diff, rows, top=None):
+    '''
+    Table of diff by ascending p, after the methods entered by every run of
+    one kind only. rows: gid -> [classname, methodname, signature, sourcefile]
+    '''
+    get_row = lambda gid:rows[gid] if gid in rows else ['gid_%d' % gid]
+    with open(fname, 'wt') as f:
+        f.write('[Runs] t {} nt {}\n'.format(diff.num_t, diff.num_nt))
+        for name, gids in [('t only', diff.only_t()), ('nt only', diff.only_nt())]:
+            f.write('[{}] {} methods\n'.format(name, len(gids)))
+            for gid in gids.tolist():
+                f.write('{}\t{}\n'.format(gid, '\t'.join(get_row(gid))))
+        f.write('[Methods] gid\tmean_t\tmean_nt\tlog2fc\tpresent_t\tpresent_nt\tauc\tp\tmethod\n')
+        ranked = diff.ranked()
+        if top is not None:
+            ranked = ranked[:top]
+        for i in ranked.tolist():
+            gid = int(diff.gids[i])
+            f.write('%d\t%.3f\t%.3f\t%.3f\t%d\t%d\t%.3f\t%.3g\t%s\n' % (gid, diff.mean_t[i], diff.mean_nt[i],
+                diff.log2fc[i], diff.present_t[i], diff.present_nt[i], diff.auc[i], diff.p[i],
+                '\t'.join(get_row(gid))))
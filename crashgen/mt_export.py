@@ -0,0 +1,178 @@
+'''
+Chrome trace-event JSON exporter of MiniTrace data_N.bin
+
+The trace is streamed block by block with BlockDecoder, and method records
+are replayed on mt_stack.ShadowStack, whose changes become balanced B / E
+slices on the track of each thread. Messages and exceptions are thread
+instant events, idle and ping events are global instant events. The output
+opens in chrome://tracing or ui.perfetto.dev, gzipped when the name ends
+with .gz.
+
+Records have no timestamps, so the time of a record is interpolated from
+its ordinal between the anchors of mt_index: the header timestamp, and every
+idle / ping event (milliseconds). Records after the last anchor continue at
+the average rate of the trace. Times are microseconds from the header.
+
+    python consumer.py export mt_output/mt_1234_ --out trace.json.gz
+'''
+import json
+
+from consumer import (
+    parse_methodinfo,
+    parse_threadinfo,
+    kMiniTraceMethodEnter,
+    kMiniTraceMethodExit,
+    kMiniTraceUnroll,
+)
+from mt_blocks import BlockDecoder
+from mt_index import load_index, TimeAnchors
+from mt_stack import ShadowStack, skippable_ptrs, MISMATCH_RESYNC
+from mt_cct import frame_name
+
+PID = 1
+
+# smaller than DEFAULT_BLOCK_SIZE, as every record of a block becomes Python objects
+EXPORT_BLOCK_SIZE = 1 << 18
+
+# event code of parse_data() -> name of the instant event
+THREAD_EVENTS = {5: 'exception', 6: 'message'}
+GLOBAL_EVENTS = {7: 'idle', 8: 'ping'}
+
+class TraceEventWriter:
+    '''
+    ShadowStack observer writing B / E events, with the number of real frames
+    (UNROLL markers excluded) kept alongside the stack of each thread
+    '''
+    def __init__(self, f, name_of):
+        self.f = f
+        self.name_of = name_of
+        self.names = dict() # ptr -> JSON string of the name
+        self.levels = dict() # tid -> array of frame count, parallel to the shadow stack
+        self.lines = []
+        self.ts = 0.0
+        self.num_events = 0
+
+    def name(self, ptr):
+        try:
+            return self.names[ptr]
+        except KeyError:
+            name = self.names[ptr] = json.dumps(self.name_of(ptr))
+            return name
+
+    def __call__(self, action, tid, ptr, old_depth, stack):
+        levels = self.levels.get(tid)
+        if levels is None:
+            levels = self.levels[tid] = []
+        depth = len(stack)
+        before = levels[-1] if levels else 0
+        if action == kMiniTraceMethodEnter:
+            if depth > old_depth:
+                levels.append(before + 1)
+                self.lines.append('{"ph":"B","pid":%d,"tid":%d,"ts":%.3f,"name":%s}' % (
+                    PID, tid, self.ts, self.name(ptr)))
+            else:
+                # the unrolled frame is entered again, its slice goes on
+                del levels[depth:]
+            return
+        if action == kMiniTraceUnroll:
+            del levels[depth - 1:]
+            levels.append(levels[-1] if levels else 0)
+        else:
+            del levels[depth:]
+        self.end(tid, before - (levels[-1] if levels else 0))
+
+    def end(self, tid, count):
+        if count > 0:
+            self.lines.extend(['{"ph":"E","pid":%d,"tid":%d,"ts":%.3f}' % (PID, tid, self.ts)] * count)
+
+    def instant(self, tid, name, scope='t', args=None):
+        line = '{"ph":"i","pid":%d,"tid":%d,"ts":%.3f,"s":"%s","name":%s' % (
+            PID, tid, self.ts, scope, json.dumps(name))
+        if args is not None:
+            line += ',"args":' + json.dumps(args)
+        self.lines.append(line + '}')
+
+    def metadata(self, name, tid, value):
+        self.lines.append(json.dumps({'ph': 'M', 'pid': PID, 'tid': tid, 'name': name,
+            'args': {'name': value}}))
+
+    def flush(self):
+        if self.lines:
+            if self.num_events:
+                self.f.write(',\n')
+            self.f.write(',\n'.join(self.lines))
+            self.num_events += len(self.lines)
+            self.lines = []
+
+    def close_all(self):
+        # close slices left open at the end of the trace
+        for tid, levels in self.levels.items():
+            self.end(tid, levels[-1] if levels else 0)
+            levels.clear()
+
+def _open_output(out_fname):
+    if out_fname.endswith('.gz'):
+        import gzip
+        return gzip.open(out_fname, 'wt', compresslevel=3)
+    return open(out_fname, 'wt', buffering=1 << 20)
+
+def export_chrome(prefix, out_fname, idx=0, block_size=EXPORT_BLOCK_SIZE):
+    '''
+    Write data_<idx>.bin of prefix as trace-event JSON to out_fname,
+    returns the number of trace events
+    '''
+    data_fname = prefix + "data_{}.bin".format(idx)
+    methods = parse_methodinfo(prefix + "info_m.log")
+    threads = parse_threadinfo(prefix + "info_t.log")
+    name_of = lambda ptr:frame_name(methods[ptr]) if ptr in methods else "method_%08X" % ptr
+
+    index = load_index(data_fname)
+    decoder = BlockDecoder(data_fname, block_size)
+    anchors = TimeAnchors(index, decoder.timestamp)
+
+    with _open_output(out_fname) as f:
+        f.write('{"displayTimeUnit":"ms","otherData":%s,"traceEvents":[\n' % json.dumps({
+            'prefix': prefix, 'data_fname': data_fname,
+            'version': decoder.version, 'timestamp_ms': decoder.timestamp}))
+        writer = TraceEventWriter(f, name_of)
+        writer.metadata('process_name', 0, prefix)
+        for tid, tname in threads.items():
+            writer.metadata('thread_name', tid, tname)
+
+        mstack = ShadowStack(skippable_ptrs(methods), MISMATCH_RESYNC, [writer])
+        actions = {kMiniTraceMethodEnter: mstack.enter, kMiniTraceMethodExit: mstack.exit,
+            kMiniTraceUnroll: mstack.unroll}
+        ordinal = 0
+        for block in decoder:
+            records = block.records
+            num_records = len(records)
+            record_ts, event_ts = anchors.block(ordinal, block)
+
+            tids = records['tid'].tolist()
+            acts = records['action'].tolist()
+            ptrs = records['ptr'].tolist()
+            record_ts = record_ts.tolist()
+            event_ts = event_ts.tolist()
+            done = 0
+            for (record_idx, offset, code, args), ts in zip(block.events + [(num_records, None, None, None)],
+                    event_ts + [None]):
+                for i in range(done, record_idx):
+                    callback = actions.get(acts[i])
+                    if callback is not None:
+                        writer.ts = record_ts[i]
+                        callback(tids[i], ptrs[i])
+                done = record_idx
+                if code is None:
+                    break
+                writer.ts = ts
+                if code in GLOBAL_EVENTS:
+                    writer.instant(0, GLOBAL_EVENTS[code], 'g', {'timestamp_ms': args[0]})
+                elif code in THREAD_EVENTS:
+                    writer.instant(args[0], args[1] if code == 6 else THREAD_EVENTS[code],
+                        args={THREAD_EVENTS[code]: args[1]})
+            ordinal += len(block)
+            writer.flush()
+        writer.close_all()
+        writer.flush()
+        f.write('\n]}\n')
+    return writer.num_events
@@ -0,0 +1,224 @@
+'''
+Field access aggregation of MiniTrace field read / write records
+
+FieldAggregator makes one pass over the records (parse_data_batched()) and
+keeps, in memory bounded by the number of fields, threads and max_objects:
+
+    counts      reads and writes of each (field, thread)
+    objects     LRU of the last max_objects objects, with the threads which
+                read and wrote each of them
+    windows     threads reading and writing each field during the current
+                message window, from one dispatched message to the next
+
+A field written on one thread and read on another during the same window
+is a race candidate, and is given to on_window() when the window closes.
+
+Fields are numbered in the order of appearance from (ptr, detail_idx), and
+threads get one bit of a 64 bit mask in the same way. The 64th bit is shared
+by every thread after the 63rd, so masks stay integers of fixed size.
+Records are grouped per batch with numpy, so Python work follows the number
+of distinct fields and objects of a batch, not the number of records.
+
+    python consumer.py fields mt_output/mt_1234_ --objects 100000
+'''
+import collections
+import numpy as np
+
+from consumer import parse_threadinfo, parse_fieldinfo, kMiniTraceFieldRead, kMiniTraceFieldWrite
+from mt_storage import ordered_traces
+
+DEFAULT_MAX_OBJECTS = 1 << 16
+
+MASK_BITS = 64
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+def is_race(read_mask, write_mask):
+    # some thread wrote and another one read
+    return read_mask != 0 and write_mask != 0 and not (read_mask == write_mask and popcount(write_mask) == 1)
+
+def _grouped_masks(keys, bits, write):
+    # distinct keys with OR of reading bits, OR of writing bits and number of records
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    zero = np.uint64(0)
+    read_bits = np.where(write, zero, bits)[order]
+    write_bits = np.where(write, bits, zero)[order]
+    return (keys[starts].tolist(),
+        np.bitwise_or.reduceat(read_bits, starts).tolist(),
+        np.bitwise_or.reduceat(write_bits, starts).tolist(),
+        np.diff(np.append(starts, len(keys))).tolist())
+
+class FieldAggregator:
+    def __init__(self, max_objects=DEFAULT_MAX_OBJECTS, on_window=None):
+        # on_window(message, [((ptr, detail_idx), writer tids, reader tids)]) for each
+        # window with race candidates, which are kept in self.windows without it
+        self.max_objects = max_objects
+        self.on_window = on_window
+        self.windows = []
+
+        self.fid_of = dict()    # ptr << 16 | detail_idx -> fid
+        self.field_keys = []    # fid -> (ptr, detail_idx)
+        self.slot_of = np.full(1 << 16, -1, dtype=np.int64) # tid -> bit of masks
+        self.slot_tids = []     # bit -> tid
+        self.counts = dict()    # fid << 17 | tid << 1 | is write -> count
+
+        self.objects = collections.OrderedDict() # obj -> [read_mask, write_mask, accesses]
+        self.evicted = 0
+        self.evicted_shared = 0
+
+        self.cur_message = "Initial"
+        self.window = dict()    # fid -> [read_mask, write_mask]
+        self.num_windows = 0
+        self.num_records = 0
+
+    def _bits(self, tids):
+        new = np.unique(tids[self.slot_of[tids] < 0])
+        for tid in new.tolist():
+            self.slot_of[tid] = len(self.slot_tids)
+            self.slot_tids.append(tid)
+        slots = np.minimum(self.slot_of[tids], MASK_BITS - 1).astype(np.uint64)
+        return np.left_shift(np.uint64(1), slots)
+
+    def _fids(self, ptrs, detail_idxs):
+        keys, inverse = np.unique((ptrs.astype(np.int64) << 16) | detail_idxs, return_inverse=True)
+        fids = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys.tolist()):
+            fid = self.fid_of.get(key)
+            if fid is None:
+                fid = self.fid_of[key] = len(self.field_keys)
+                self.field_keys.append((key >> 16, key & 0xFFFF))
+            fids[i] = fid
+        return fids[inverse]
+
+    def batch(self, records):
+        # Batch callback of parse_data_batched()
+        action = records['action']
+        records = records[(action == kMiniTraceFieldRead) | (action == kMiniTraceFieldWrite)]
+        if len(records) == 0:
+            return
+        self.num_records += len(records)
+        write = records['action'] == kMiniTraceFieldWrite
+        tids = records['tid'].astype(np.int64)
+        bits = self._bits(tids)
+        fids = self._fids(records['ptr'], records['detail_idx'])
+
+        keys, counts = np.unique((fids << 17) | (tids << 1) | write, return_counts=True)
+        get = self.counts.get
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.counts[key] = get(key, 0) + count
+
+        window = self.window
+        for fid, read_mask, write_mask, _ in zip(*_grouped_masks(fids, bits, write)):
+            masks = window.get(fid)
+            if masks is None:
+                window[fid] = [read_mask, write_mask]
+            else:
+                masks[0] |= read_mask
+                masks[1] |= write_mask
+
+        objects = self.objects
+        for obj, read_mask, write_mask, count in zip(*_grouped_masks(records['obj'].astype(np.int64), bits, write)):
+            entry = objects.get(obj)
+            if entry is None:
+                objects[obj] = [read_mask, write_mask, count]
+                if len(objects) > self.max_objects:
+                    self._evict()
+            else:
+                entry[0] |= read_mask
+                entry[1] |= write_mask
+                entry[2] += count
+                objects.move_to_end(obj)
+
+    def _evict(self):
+        _, (read_mask, write_mask, _) = self.objects.popitem(last=False)
+        self.evicted += 1
+        if write_mask and popcount(read_mask | write_mask) > 1:
+            self.evicted_shared += 1
+
+    def close_window(self):
+        candidates = [(self.field_keys[fid], self.thread_ids(write_mask), self.thread_ids(read_mask))
+            for fid, (read_mask, write_mask) in sorted(self.window.items()) if is_race(read_mask, write_mask)]
+        if candidates:
+            if self.on_window is None:
+                self.windows.append((self.cur_message, candidates))
+            else:
+                self.on_window(self.cur_message, candidates)
+        self.window = dict()
+        self.num_windows += 1
+
+    def message_dispatched(self, tid, msg):
+        self.close_window()
+        self.cur_message = msg
+
+    def finish(self):
+        self.close_window()
+
+    def thread_ids(self, mask):
+        # tids of the bits of mask, -1 for threads after the 63rd
+        tids = []
+        while mask:
+            slot = (mask & -mask).bit_length() - 1
+            tids.append(self.slot_tids[slot] if slot < MASK_BITS - 1 or len(self.slot_tids) == MASK_BITS else -1)
+            mask &= mask - 1
+        return tids
+
+    def field_counts(self):
+        # [((ptr, detail_idx), tid, reads, writes)] by descending number of accesses
+        rows = dict()
+        for key, count in self.counts.items():
+            row = rows.setdefault(key >> 1, [0, 0])
+            row[key & 1] += count
+        return sorted(((self.field_keys[key >> 16], key & 0xFFFF, reads, writes) for key, (reads, writes) in rows.items()),
+            key=lambda row:-(row[2] + row[3]))
+
+    def shared_objects(self):
+        # [(obj, read_mask, write_mask, accesses)] of live objects written and accessed by several threads
+        return sorted(((obj, read_mask, write_mask, accesses)
+            for obj, (read_mask, write_mask, accesses) in self.objects.items()
+            if write_mask and popcount(read_mask | write_mask) > 1), key=lambda row:-row[3])
+
+def aggregate_fields(prefix, max_objects=DEFAULT_MAX_OBJECTS, on_window=None):
+    # FieldAggregator over every data_N.bin of prefix
+    from mt_blocks import parse_data_batched
+    aggregator = FieldAggregator(max_objects, on_window)
+    for data_fname in ordered_traces(prefix):
+        parse_data_batched(data_fname, aggregator.batch, {6: aggregator.message_dispatched}, verbose=False)
+    aggregator.finish()
+    return aggregator
+
+def write_field_report(prefix, max_objects=DEFAULT_MAX_OBJECTS, top=100):
+    '''
+    prefix + fields.txt: accesses per field and thread, and shared live objects
+    prefix + field_races.txt: race candidates of each message window, written during the pass
+    '''
+    threads = parse_threadinfo(prefix + "info_t.log")
+    fields = parse_fieldinfo(prefix + "info_f.log")
+    get_thread_name = lambda tid:"%s(%d)" % (threads[tid], tid) if tid in threads else \
+        ("Thread-%d" % tid if tid != -1 else "others")
+
+    field_name = lambda key:'\t'.join(fields[key]) if key in fields else "field_%08X" % key[0]
+    thread_names = lambda tids:','.join(map(get_thread_name, tids))
+
+    with open(prefix + "field_races.txt", 'wt') as racef:
+        def on_window(message, candidates):
+            racef.write('[Message] {}\n'.format(message))
+            for key, writers, readers in candidates:
+                racef.write('written by {} read by {}\t{}\n'.format(
+                    thread_names(writers), thread_names(readers), field_name(key)))
+        aggregator = aggregate_fields(prefix, max_objects, on_window)
+
+    with open(prefix + "fields.txt", 'wt') as f:
+        f.write('[Fields] {} records, {} fields, {} threads\n'.format(
+            aggregator.num_records, len(aggregator.field_keys), len(aggregator.slot_tids)))
+        for key, tid, reads, writes in aggregator.field_counts():
+            f.write('%d\t%d\t%s\t%s\n' % (reads, writes, get_thread_name(tid), field_name(key)))
+        shared = aggregator.shared_objects()
+        f.write('[Objects] {} live, {} evicted, {} evicted shared, {} live shared\n'.format(
+            len(aggregator.objects), aggregator.evicted, aggregator.evicted_shared, len(shared)))
+        for obj, read_mask, write_mask, accesses in shared[:top]:
+            f.write('0x%08X\t%d\twritten by %s\tread by %s\n' % (obj, accesses,
+                thread_names(aggregator.thread_ids(write_mask)), thread_names(aggregator.thread_ids(read_mask))))
+    return aggregator
@@ -0,0 +1,290 @@
+'''
+Follow mode for MiniTrace data_N.bin while mtserver is still writing it
+
+TraceFeeder takes the trace as arbitrary pieces of bytes, dispatches every
+complete record to parse_data() callbacks, and keeps a partial trailing
+record until the rest of it arrives. It is fed either by polling a growing
+local file, or by a stream such as
+
+    adb exec-out tail -c +1 -f /data/data/<package>/mt_XX_data_0.bin
+
+FollowCollapser keeps the counters of collapse_per_message_binary() up to
+date during the run, with hits of the target methods, and can be checkpointed
+with the offset of the feeder, so a later follow resumes from there.
+'''
+import os, sys
+import time
+import pickle
+import subprocess
+import datetime
+
+from consumer import (
+    HEADER_SIZE,
+    MessageCollapser,
+    callback_list,
+    parse_buffer,
+    parse_header,
+    parse_methodinfo,
+    parse_threadinfo,
+    kMiniTraceActionMask
+)
+from mt_matrix import matrix_dirname_of
+from mt_checkpoint import atomic_pickle
+
+READ_SIZE = 1 << 20
+
+class TraceFeeder:
+    def __init__(self, callbacks, start=None):
+        # start: offset of a record boundary to begin with, the bytes before it
+        # (except the header) are dropped, e.g. to resume from a checkpoint
+        self.callbacks = callback_list(callbacks)
+        self.version = self.log_flag = self.timestamp = None
+        self.buf = bytearray()
+        self.offset = 0   # file offset of self.buf[0]
+        self.start = start
+        self.stopped = False
+        self.interrupted = False  # by StopParsingData
+
+    @property
+    def pending(self):
+        # bytes of the partial trailing record
+        return len(self.buf)
+
+    @property
+    def position(self):
+        # offset of the next record to parse
+        return self.offset
+
+    def jump(self, offset):
+        # The source skips to offset, which must be a record boundary
+        assert self.version is not None and not self.buf
+        self.offset = offset
+
+    def feed(self, data):
+        '''
+        Parse every complete record with data appended.
+        Returns False once no record can be parsed any more, because a callback
+        raised StopParsingData or the stream has a record which parse_data()
+        cannot go over.
+        '''
+        if self.stopped:
+            return False
+        self.buf += data
+        if self.version is None:
+            if len(self.buf) < HEADER_SIZE:
+                return True
+            self.version, self.log_flag, self.timestamp = parse_header(bytes(self.buf[:HEADER_SIZE]))
+            del self.buf[:HEADER_SIZE]
+            self.offset = HEADER_SIZE
+        if self.start is not None:
+            skip = min(self.start - self.offset, len(self.buf))
+            del self.buf[:skip]
+            self.offset += skip
+            if self.offset < self.start:
+                return True
+            self.start = None
+
+        pos, stopped = parse_buffer(self.buf, self.version, self.callbacks, 0, len(self.buf))
+        del self.buf[:pos]
+        self.offset += pos
+        self.interrupted = stopped
+        if stopped or self._broken():
+            self.stopped = True
+        return not self.stopped
+
+    def _broken(self):
+        # exception / message record shorter than its header, parse_data() stops there
+        if len(self.buf) < 6 or self.buf[0] | (self.buf[1] << 8) <= 5:
+            return False
+        value = int.from_bytes(self.buf[2:6], 'little')
+        return (value & kMiniTraceActionMask) in (5, 6) and (value >> 3) < 6
+
+    def finish(self, name):
+        # Warn on bytes left at the end of the trace
+        if self.buf and not self.interrupted:
+            print("Warning: {} bytes of {} from offset {} are not parsed".format(
+                len(self.buf), name, self.offset), file=sys.stderr)
+
+def follow_file(data_fname, feeder, interval=1.0, timeout=10.0, on_poll=None):
+    '''
+    Feed data_fname to feeder while it grows. Returns when the file did not
+    grow for timeout seconds (None: never), or the feeder stops.
+    on_poll(feeder) is called after every read.
+    '''
+    last_growth = time.time()
+    while not os.path.isfile(data_fname):
+        if timeout is not None and time.time() - last_growth > timeout:
+            print("Warning: {} does not appear".format(data_fname), file=sys.stderr)
+            return feeder
+        time.sleep(interval)
+
+    with open(data_fname, 'rb') as f:
+        if feeder.start is not None:
+            header = b''
+            while len(header) < HEADER_SIZE:
+                header += f.read(HEADER_SIZE - len(header))
+                if len(header) < HEADER_SIZE:
+                    time.sleep(interval)
+            feeder.feed(header)
+            f.seek(feeder.start)
+            feeder.jump(feeder.start)
+            feeder.start = None
+        while True:
+            data = f.read(READ_SIZE)
+            if data:
+                last_growth = time.time()
+                running = feeder.feed(data)
+                if on_poll is not None:
+                    on_poll(feeder)
+                if not running:
+                    break
+                continue
+            if timeout is not None and time.time() - last_growth > timeout:
+                break
+            time.sleep(interval)
+            if on_poll is not None:
+                on_poll(feeder)
+    feeder.finish(data_fname)
+    return feeder
+
+def follow_stream(stream, feeder, name='<stream>', on_poll=None):
+    # Feed a binary stream, e.g. stdout of adb, until EOF
+    fd = stream.fileno()
+    while True:
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            break
+        running = feeder.feed(data)
+        if on_poll is not None:
+            on_poll(feeder)
+        if not running:
+            break
+    feeder.finish(name)
+    return feeder
+
+def adb_follow_command(device_fname, serial=None):
+    # adb command writing the device file and whatever is appended to it
+    cmd = ['adb']
+    if serial is not None:
+        cmd += ['-s', serial]
+    return cmd + ['exec-out', 'tail', '-c', '+1', '-f', device_fname]
+
+class FollowCollapser(MessageCollapser):
+    '''
+    MessageCollapser which also counts target method hits
+    (tid, method_id) -> count, tid is 0 with MiniTrace version 3
+    '''
+    def __init__(self, main_tid, dispatchMessage_ptr):
+        MessageCollapser.__init__(self, main_tid, dispatchMessage_ptr)
+        self.target_hits = dict()
+
+    def message_dispatched(self, tid, msg):
+        if self.main_tid is None:
+            self.main_tid = tid
+        if self.dispatchMessage_ptr is None:
+            # no exit of dispatchMessage to look at, the next message closes it
+            self.cur_msg_id = -1
+        MessageCollapser.message_dispatched(self, tid, msg)
+
+    def target_enter(self, method_id):
+        self.target_enter_v4(0, method_id)
+
+    def target_enter_v4(self, tid, method_id):
+        key = (tid, method_id)
+        try:
+            self.target_hits[key] += 1
+        except KeyError:
+            self.target_hits[key] = 1
+
+    def callbacks(self):
+        callbacks = MessageCollapser.callbacks(self)
+        callbacks[10] = self.target_enter
+        callbacks[13] = self.target_enter_v4
+        return callbacks
+
+    def report(self, methods=None, top=10):
+        get_name = lambda ptr: '\t'.join(methods[ptr]) if methods is not None and ptr in methods \
+            else "method_%08X" % ptr
+        print('[Follow] {} messages, {} idle, current message {}'.format(
+            len(self.messages), len(self.idle_infos), self.cur_msg_id))
+        if self.cur_msg_id != -1:
+            counts = self.mtds_per_message[self.cur_msg_id]
+            print('[Follow] {}'.format(self.messages[self.cur_msg_id]))
+            for ptr in sorted(counts, key=lambda ptr:-counts[ptr])[:top]:
+                print('0x%08X\t%d\t%s' % (ptr, counts[ptr], get_name(ptr)))
+        for (tid, method_id), count in sorted(self.target_hits.items()):
+            print('[Follow] target {} on thread {}: {} hits'.format(method_id, tid, count))
+        sys.stdout.flush()
+
+def save_checkpoint(fname, feeder, collapser):
+    # Atomically replace fname, so a crash leaves the previous checkpoint
+    atomic_pickle(fname, {'offset': feeder.position, 'collapser': collapser})
+
+def load_checkpoint(fname):
+    # Returns (offset, collapser)
+    with open(fname, 'rb') as f:
+        state = pickle.load(f)
+    return state['offset'], state['collapser']
+
+def follow(prefix, idx=0, stream=None, device_prefix=None, serial=None,
+        checkpoint=None, interval=1.0, timeout=10.0, report_interval=30.0):
+    '''
+    Follow data_<idx>.bin of prefix (or the stream, or the file on the device
+    with device_prefix) and write col_matrix/ of collapse_per_message_binary()
+    at the end. With checkpoint, the state is saved every report_interval
+    seconds and resumed if the checkpoint exists.
+    '''
+    methods = None
+    main_tid = None
+    dispatchMessage_ptr = None
+    if os.path.isfile(prefix + "info_m.log"):
+        methods = parse_methodinfo(prefix + "info_m.log")
+        try:
+            dispatchMessage_ptr = methods.find_method_ptr("Landroid/os/Handler;", "dispatchMessage")
+        except KeyError:
+            pass
+    if os.path.isfile(prefix + "info_t.log"):
+        main_tid = min(parse_threadinfo(prefix + "info_t.log").keys())
+    if dispatchMessage_ptr is None:
+        print("Warning: dispatchMessage is unknown without {}info_m.log, "
+            "a message lasts until the next one".format(prefix), file=sys.stderr)
+
+    start = None
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        start, collapser = load_checkpoint(checkpoint)
+        print('[Follow] resume from offset {}'.format(start))
+    else:
+        collapser = FollowCollapser(main_tid, dispatchMessage_ptr)
+    feeder = TraceFeeder(collapser.callbacks(), start)
+
+    last_report = [time.time()]
+    def on_poll(feeder):
+        now = time.time()
+        if now - last_report[0] < report_interval:
+            return
+        last_report[0] = now
+        print('[Follow] {} offset {}'.format(
+            datetime.datetime.now().strftime("%H:%M:%S"), feeder.position))
+        collapser.report(methods)
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, feeder, collapser)
+
+    data_fname = "{}data_{}.bin".format(prefix, idx)
+    if device_prefix is not None:
+        device_fname = "{}data_{}.bin".format(device_prefix, idx)
+        proc = subprocess.Popen(adb_follow_command(device_fname, serial), stdout=subprocess.PIPE)
+        try:
+            follow_stream(proc.stdout, feeder, device_fname, on_poll)
+        finally:
+            proc.kill()
+            proc.wait()
+    elif stream is not None:
+        follow_stream(stream, feeder, on_poll=on_poll)
+    else:
+        follow_file(data_fname, feeder, interval, timeout, on_poll)
+
+    collapser.report(methods)
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, feeder, collapser)
+    collapser.make_matrix(matrix_dirname_of(prefix))
+    return collapser
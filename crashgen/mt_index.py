@@ -0,0 +1,245 @@
+'''
+Sidecar offset index for MiniTrace data_N.bin files
+
+build_index() makes one pass with BlockDecoder and writes data_N.idx next to
+the trace. For every dispatched message (event 6), idle (7) and ping (8)
+record it keeps the byte offset of the record, the number of records before
+it, and the running stack depth of every thread at that moment. With the
+offsets, parse_data(..., start=..., stop=...) jumps straight to a window
+instead of replaying the whole trace.
+
+Stack depths are relative to the beginning of the trace: entering a method
+counts +1, exiting or unrolling counts -1. They become negative for frames
+which were already on the stack when tracing started.
+'''
+import os
+import re
+import numpy as np
+
+from mt_blocks import BlockDecoder, DEFAULT_BLOCK_SIZE
+from mt_storage import trace_size, ordered_traces
+
+INDEX_VERSION = 1
+
+ANCHOR_MESSAGE = 6
+ANCHOR_IDLE = 7
+ANCHOR_PING = 8
+ANCHOR_CODES = [ANCHOR_MESSAGE, ANCHOR_IDLE, ANCHOR_PING]
+
+def index_fname_of(data_fname):
+    # data_0.bin -> data_0.idx
+    return os.path.splitext(data_fname)[0] + '.idx'
+
+def message_id(msg):
+    # Messages from APE start with [id ##]
+    gp = re.match(r'\[id ([0-9]+)\]', msg)
+    if gp:
+        return int(gp.group(1))
+    return -1
+
+class DepthTracker:
+    '''
+    Running stack depth per thread, evaluated at given record positions of a block
+    '''
+    def __init__(self):
+        self.depths = dict() # tid -> depth
+
+    def advance(self, records, positions):
+        # Returns list of dict tid -> depth, one for each of positions
+        # (number of records of the block consumed before the evaluation),
+        # and moves the running depths to the end of the block.
+        action = records['action']
+        delta = np.where(action == 0, 1, np.where(action <= 2, -1, 0)).astype(np.int64)
+        tids = records['tid']
+        positions = np.asarray(positions, dtype=np.int64)
+
+        snapshots = [dict(self.depths) for _ in range(len(positions))]
+        order = np.argsort(tids, kind='stable')
+        sorted_tids = tids[order]
+        bounds = np.nonzero(np.diff(sorted_tids))[0] + 1
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+            tid = int(tids[group[0]])
+            base = self.depths.get(tid, 0)
+            cum = np.cumsum(delta[group])
+            if len(positions) > 0:
+                # number of this thread's records before each position
+                cnt = np.searchsorted(group, positions)
+                values = np.where(cnt > 0, cum[np.maximum(cnt - 1, 0)], 0) + base
+                for snapshot, value, c in zip(snapshots, values.tolist(), cnt.tolist()):
+                    if c > 0 or tid in snapshot:
+                        snapshot[tid] = value
+            self.depths[tid] = base + int(cum[-1])
+        return snapshots
+
+def build_index(data_fname, idx_fname=None, block_size=DEFAULT_BLOCK_SIZE):
+    if idx_fname is None:
+        idx_fname = index_fname_of(data_fname)
+
+    kinds = []
+    offsets = []
+    ordinals = []
+    values = []     # timestamp for idle / ping, message id for message
+    tids = []       # thread dispatching the message, 0 for idle / ping
+    depth_indptr = [0]
+    depth_tids = []
+    depth_values = []
+
+    tracker = DepthTracker()
+    num_records = 0
+    decoder = BlockDecoder(data_fname, block_size)
+    for block in decoder:
+        anchors = [(i, ev) for i, ev in enumerate(block.events) if ev[2] in ANCHOR_CODES]
+        snapshots = tracker.advance(block.records, [ev[0] for i, ev in anchors])
+        for (i, (record_idx, offset, code, args)), snapshot in zip(anchors, snapshots):
+            kinds.append(code)
+            offsets.append(offset)
+            # records before this one, counting the other events too
+            ordinals.append(num_records + record_idx + i)
+            if code == ANCHOR_MESSAGE:
+                values.append(message_id(args[1]))
+                tids.append(args[0])
+            else:
+                values.append(args[0])
+                tids.append(0)
+            for tid in sorted(snapshot):
+                if snapshot[tid] != 0:
+                    depth_tids.append(tid)
+                    depth_values.append(snapshot[tid])
+            depth_indptr.append(len(depth_tids))
+        num_records += len(block)
+
+    with open(idx_fname, 'wb') as f:
+        np.savez_compressed(f,
+            version=np.array([INDEX_VERSION], dtype=np.int64),
+            data_size=np.array([trace_size(data_fname)], dtype=np.int64),
+            trace_version=np.array([decoder.version], dtype=np.int64),
+            num_records=np.array([num_records], dtype=np.int64),
+            kinds=np.array(kinds, dtype=np.uint8),
+            offsets=np.array(offsets, dtype=np.int64),
+            ordinals=np.array(ordinals, dtype=np.int64),
+            values=np.array(values, dtype=np.int64),
+            tids=np.array(tids, dtype=np.uint32),
+            depth_indptr=np.array(depth_indptr, dtype=np.int64),
+            depth_tids=np.array(depth_tids, dtype=np.uint32),
+            depth_values=np.array(depth_values, dtype=np.int32))
+    return idx_fname
+
+class TraceIndex:
+    def __init__(self, idx_fname):
+        with open(idx_fname, 'rb') as f:
+            npz = np.load(f)
+            assert int(npz['version'][0]) == INDEX_VERSION, idx_fname
+            self.data_size = int(npz['data_size'][0])
+            self.trace_version = int(npz['trace_version'][0])
+            self.num_records = int(npz['num_records'][0])
+            self.kinds = npz['kinds']
+            self.offsets = npz['offsets']
+            self.ordinals = npz['ordinals']
+            self.values = npz['values']
+            self.tids = npz['tids']
+            self.depth_indptr = npz['depth_indptr']
+            self.depth_tids = npz['depth_tids']
+            self.depth_values = npz['depth_values']
+
+        self._by_kind = {code: np.nonzero(self.kinds == code)[0] for code in ANCHOR_CODES}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def anchors(self, code):
+        # Positions of anchors with given kind, in the trace order
+        return self._by_kind[code]
+
+    def depths(self, i):
+        # Stack depth of every thread with non-zero depth at anchor i
+        lo, hi = self.depth_indptr[i], self.depth_indptr[i+1]
+        return dict(zip(self.depth_tids[lo:hi].tolist(), self.depth_values[lo:hi].tolist()))
+
+    def window(self, i, code=None):
+        '''
+        (start, stop) byte offsets from anchor i up to the next anchor of the same
+        kind (or given code), stop is None at the end of the trace
+        '''
+        if code is None:
+            code = int(self.kinds[i])
+        following = self._by_kind[code]
+        j = np.searchsorted(following, i, side='right')
+        stop = int(self.offsets[following[j]]) if j < len(following) else None
+        return int(self.offsets[i]), stop
+
+    def message_window(self, n):
+        # Window of the n-th dispatched message
+        return self.window(int(self._by_kind[ANCHOR_MESSAGE][n]))
+
+    def message_window_by_id(self, msgid):
+        # Window of the message which starts with [id msgid]
+        candidates = self._by_kind[ANCHOR_MESSAGE]
+        found = candidates[self.values[candidates] == msgid]
+        if len(found) == 0:
+            raise KeyError(msgid)
+        return self.window(int(found[0]))
+
+    def idle_window(self, n):
+        # Window from the n-th idle event to the next one
+        return self.window(int(self._by_kind[ANCHOR_IDLE][n]))
+
+    def find_timestamp(self, timestamp):
+        # Last idle / ping anchor with timestamp <= given one, -1 if there is none
+        timed = np.concatenate([self._by_kind[ANCHOR_IDLE], self._by_kind[ANCHOR_PING]])
+        timed.sort()
+        earlier = timed[self.values[timed] <= timestamp]
+        if len(earlier) == 0:
+            return -1
+        return int(earlier[-1])
+
+class TimeAnchors:
+    '''
+    Piecewise linear map of record ordinals to microseconds from the header
+    '''
+    def __init__(self, index, header_timestamp):
+        timed = np.sort(np.concatenate([index.anchors(ANCHOR_IDLE), index.anchors(ANCHOR_PING)]))
+        ordinals = np.concatenate([[0], index.ordinals[timed]]).astype(np.float64)
+        millis = np.concatenate([[header_timestamp], index.values[timed]]).astype(np.float64)
+        # a clock going back would reorder slices
+        micros = np.maximum.accumulate((millis - header_timestamp) * 1000.0)
+        if len(ordinals) > 1 and ordinals[-1] > 0 and micros[-1] > 0:
+            rate = micros[-1] / ordinals[-1]
+        else:
+            rate = 1.0
+        end = max(float(index.num_records), ordinals[-1] + 1)
+        self.ordinals = np.append(ordinals, end)
+        self.micros = np.append(micros, micros[-1] + (end - ordinals[-1]) * rate)
+
+    def __call__(self, ordinals):
+        return np.interp(ordinals, self.ordinals, self.micros)
+
+    def block(self, ordinal, block):
+        # Times of the records and of the events of a block starting at ordinal
+        event_idx = np.array([ev[0] for ev in block.events], dtype=np.int64)
+        # every record is preceded by the events before it
+        positions = np.arange(len(block.records), dtype=np.int64)
+        return (self(ordinal + positions + np.searchsorted(event_idx, positions, side='right')),
+            self(ordinal + event_idx + np.arange(len(event_idx))))
+
+def load_index(data_fname, rebuild=True):
+    # Load data_N.idx, (re)building it when missing or made for another file
+    idx_fname = index_fname_of(data_fname)
+    if os.path.isfile(idx_fname):
+        index = TraceIndex(idx_fname)
+        if index.data_size == trace_size(data_fname):
+            return index
+    if not rebuild:
+        return None
+    build_index(data_fname, idx_fname)
+    return TraceIndex(idx_fname)
+
+def find_message_window(prefix, msgid):
+    # (data_fname, start, stop) of the message [id msgid], ids go on over the data_N.bin of prefix
+    for data_fname in ordered_traces(prefix):
+        try:
+            return (data_fname, ) + load_index(data_fname).message_window_by_id(msgid)
+        except KeyError:
+            continue
+    raise KeyError(msgid)
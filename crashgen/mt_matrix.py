@@ -0,0 +1,229 @@
+'''
+Sparse message x method store of collapse_per_message_binary()
+
+The counters of MessageCollapser are saved to prefix + col_matrix/ as .npy
+arrays, which MessageMatrix opens with np.load(mmap_mode='r'), so a query
+only touches the pages of its slice.
+
+    methods_ptr.npy         mid -> method pointer, sorted
+    msg_ids.npy             row -> message id, sorted
+    msg_text.npy, msg_text_indptr.npy
+                            utf-8 message of each row
+    msg_indptr.npy, msg_mids.npy, msg_counts.npy
+                            CSR rows x mids, entries of a row by descending
+                            count (first entered first on ties)
+    mtd_indptr.npy, mtd_rows.npy, mtd_counts.npy
+                            CSC of the same matrix, rows of a mid ascending
+    idle_timestamps.npy     timestamp of each idle event
+    idle_msg_indptr.npy, idle_msg_ids.npy
+                            ids of messages dispatched before each idle event
+    idle_indptr.npy, idle_mids.npy, idle_counts.npy
+                            CSR idle windows x mids, like msg_*
+    tail_msg_ids.npy, tail_indptr.npy, tail_mids.npy, tail_counts.npy
+                            the window after the last idle event, up to the
+                            end of the traces, like one idle window
+    inv_*.npy               delta-encoded posting lists of mid, see mt_postings
+    meta.json
+'''
+import os
+import json
+import pickle
+import numpy as np
+
+MATRIX_VERSION = 1
+
+def matrix_dirname_of(prefix):
+    return prefix + 'col_matrix'
+
+def _counts_csr(counters, mid_of):
+    # indptr, mids, counts of dicts ptr -> count, in order of descending count
+    indptr = np.zeros(len(counters) + 1, dtype=np.int64)
+    mids = []
+    counts = []
+    for i, counter in enumerate(counters):
+        ptrs = sorted(counter, key=lambda ptr:-counter[ptr])
+        mids.extend(mid_of[ptr] for ptr in ptrs)
+        counts.extend(counter[ptr] for ptr in ptrs)
+        indptr[i + 1] = len(mids)
+    return indptr, np.array(mids, dtype=np.int32), np.array(counts, dtype=np.int32)
+
+def _strings(strings):
+    # utf-8 bytes of strings and offsets
+    encoded = [string.encode() for string in strings]
+    indptr = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=indptr[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), indptr
+
+def build_arrays(messages, mtds_per_message, idle_infos, tail=None):
+    '''
+    Arrays of the store, name -> array, from the dicts of MessageCollapser
+        messages: msgid -> message
+        mtds_per_message: msgid -> {ptr -> count}
+        idle_infos: list of (timestamp, list of msgid, {ptr -> count})
+        tail: (list of msgid, {ptr -> count}) after the last idle event
+    '''
+    if tail is None:
+        tail = ([], {})
+    ptrs = set(tail[1])
+    for counter in mtds_per_message.values():
+        ptrs.update(counter)
+    for _, _, counter in idle_infos:
+        ptrs.update(counter)
+    methods_ptr = np.array(sorted(ptrs), dtype=np.uint32)
+    mid_of = {ptr:mid for mid, ptr in enumerate(methods_ptr.tolist())}
+
+    arrays = {'methods_ptr': methods_ptr}
+    msg_ids = sorted(messages)
+    arrays['msg_ids'] = np.array(msg_ids, dtype=np.int64)
+    arrays['msg_text'], arrays['msg_text_indptr'] = _strings([messages[msgid] for msgid in msg_ids])
+    indptr, mids, counts = _counts_csr([mtds_per_message.get(msgid, {}) for msgid in msg_ids], mid_of)
+    arrays['msg_indptr'], arrays['msg_mids'], arrays['msg_counts'] = indptr, mids, counts
+
+    # CSC, stable sort keeps the rows of a mid ascending
+    rows = np.repeat(np.arange(len(msg_ids), dtype=np.int32), np.diff(indptr))
+    order = np.argsort(mids, kind='stable')
+    arrays['mtd_indptr'] = np.zeros(len(methods_ptr) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(mids, minlength=len(methods_ptr)), out=arrays['mtd_indptr'][1:])
+    arrays['mtd_rows'] = rows[order]
+    arrays['mtd_counts'] = counts[order]
+
+    arrays['idle_timestamps'] = np.array([info[0] for info in idle_infos], dtype=np.int64)
+    arrays['idle_msg_indptr'] = np.zeros(len(idle_infos) + 1, dtype=np.int64)
+    np.cumsum([len(info[1]) for info in idle_infos], out=arrays['idle_msg_indptr'][1:])
+    arrays['idle_msg_ids'] = np.array([msgid for info in idle_infos for msgid in info[1]], dtype=np.int64)
+    arrays['idle_indptr'], arrays['idle_mids'], arrays['idle_counts'] = _counts_csr(
+        [info[2] for info in idle_infos], mid_of)
+    arrays['tail_msg_ids'] = np.array(tail[0], dtype=np.int64)
+    arrays['tail_indptr'], arrays['tail_mids'], arrays['tail_counts'] = _counts_csr([tail[1]], mid_of)
+    return arrays
+
+def write_matrix(dirname, messages, mtds_per_message, idle_infos, tail=None):
+    '''
+    Write the store into dirname + '.tmp', then put it in place of dirname,
+    so an interrupted collapse never leaves a mix of old and new arrays
+    '''
+    import shutil
+    from mt_postings import build_postings, POSTINGS_VERSION
+    dirname = dirname.rstrip(os.sep)
+    tmp_dirname = dirname + '.tmp'
+    shutil.rmtree(tmp_dirname, ignore_errors=True)
+    os.makedirs(tmp_dirname)
+    arrays = build_arrays(messages, mtds_per_message, idle_infos, tail)
+    arrays.update(build_postings(arrays))
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dirname, name + '.npy'), array)
+    # meta.json last, a directory without it is incomplete
+    with open(os.path.join(tmp_dirname, 'meta.json'), 'wt') as f:
+        json.dump({
+            'matrix_version': MATRIX_VERSION,
+            'num_messages': len(arrays['msg_ids']),
+            'num_methods': len(arrays['methods_ptr']),
+            'num_idles': len(arrays['idle_timestamps']),
+            'nnz': len(arrays['msg_mids']),
+            'postings_version': POSTINGS_VERSION,
+        }, f, indent=2)
+    # a directory cannot replace a non-empty one, the old one moves aside first
+    old_dirname = dirname + '.old'
+    shutil.rmtree(old_dirname, ignore_errors=True)
+    if os.path.isdir(dirname):
+        os.rename(dirname, old_dirname)
+    os.rename(tmp_dirname, dirname)
+    shutil.rmtree(old_dirname, ignore_errors=True)
+    return dirname
+
+class MessageMatrix:
+    def __init__(self, arrays):
+        # arrays: name -> array, see build_arrays()
+        self.arrays = arrays
+        self.methods_ptr = arrays['methods_ptr']
+        self.msg_ids = arrays['msg_ids']
+
+    def __len__(self):
+        return len(self.msg_ids)
+
+    def mid_of(self, ptr):
+        # -1 if no message nor idle window entered ptr
+        mid = int(np.searchsorted(self.methods_ptr, ptr))
+        if mid < len(self.methods_ptr) and self.methods_ptr[mid] == ptr:
+            return mid
+        return -1
+
+    def row_of(self, msgid):
+        row = int(np.searchsorted(self.msg_ids, msgid))
+        if row < len(self.msg_ids) and self.msg_ids[row] == msgid:
+            return row
+        raise KeyError(msgid)
+
+    def message_ids(self):
+        return self.msg_ids.tolist()
+
+    def message(self, msgid):
+        row = self.row_of(msgid)
+        indptr = self.arrays['msg_text_indptr']
+        return self.arrays['msg_text'][indptr[row]:indptr[row + 1]].tobytes().decode()
+
+    def _entries(self, prefix, i, top):
+        indptr = self.arrays[prefix + '_indptr']
+        start, end = int(indptr[i]), int(indptr[i + 1])
+        if top is not None:
+            end = min(end, start + top)
+        ptrs = self.methods_ptr[self.arrays[prefix + '_mids'][start:end]]
+        return list(zip(ptrs.tolist(), self.arrays[prefix + '_counts'][start:end].tolist()))
+
+    def top_methods(self, msgid, top=None):
+        # [(ptr, count)] entered during the message, by descending count
+        return self._entries('msg', self.row_of(msgid), top)
+
+    def messages_of(self, ptr):
+        # [(msgid, count)] of messages which entered ptr, by message id
+        mid = self.mid_of(ptr)
+        if mid == -1:
+            return []
+        indptr = self.arrays['mtd_indptr']
+        start, end = int(indptr[mid]), int(indptr[mid + 1])
+        rows = self.arrays['mtd_rows'][start:end]
+        return list(zip(self.msg_ids[rows].tolist(), self.arrays['mtd_counts'][start:end].tolist()))
+
+    def num_idles(self):
+        return len(self.arrays['idle_timestamps'])
+
+    def idle(self, i, top=None):
+        # (timestamp, [msgid], [(ptr, count)]) of i-th idle window
+        indptr = self.arrays['idle_msg_indptr']
+        msgids = self.arrays['idle_msg_ids'][indptr[i]:indptr[i + 1]].tolist()
+        return int(self.arrays['idle_timestamps'][i]), msgids, self._entries('idle', i, top)
+
+    def tail(self, top=None):
+        # ([msgid], [(ptr, count)]) after the last idle event, empty for matrices written before it
+        if 'tail_indptr' not in self.arrays:
+            return [], []
+        return self.arrays['tail_msg_ids'].tolist(), self._entries('tail', 0, top)
+
+    def idles_between(self, start_timestamp, end_timestamp):
+        # indices of idle windows ending in [start_timestamp, end_timestamp)
+        timestamps = self.arrays['idle_timestamps']
+        return range(int(np.searchsorted(timestamps, start_timestamp)),
+            int(np.searchsorted(timestamps, end_timestamp)))
+
+def open_matrix(dirname):
+    with open(os.path.join(dirname, 'meta.json'), 'rt') as f:
+        meta = json.load(f)
+    assert meta['matrix_version'] == MATRIX_VERSION, dirname
+    arrays = dict()
+    for fname in os.listdir(dirname):
+        if fname.endswith('.npy'):
+            arrays[fname[:-4]] = np.load(os.path.join(dirname, fname), mmap_mode='r')
+    return MessageMatrix(arrays)
+
+def load_collapsed(prefix):
+    # MessageMatrix of prefix, from col_*.pk of older outputs if there is no col_matrix/
+    dirname = matrix_dirname_of(prefix)
+    if os.path.isfile(os.path.join(dirname, 'meta.json')):
+        return open_matrix(dirname)
+    with open(prefix + "col_msgs.pk", 'rb') as pkfile:
+        messages = pickle.load(pkfile)
+    with open(prefix + "col_mpm.pk", 'rb') as pkfile:
+        mtds_per_message = pickle.load(pkfile)
+    with open(prefix + "col_idle.pk", 'rb') as pkfile:
+        idle_infos = pickle.load(pkfile)
+    return MessageMatrix(build_arrays(messages, mtds_per_message, idle_infos))
@@ -0,0 +1,179 @@
+'''
+K-way merge of every trace of a run into one timeline
+
+An APE run leaves one prefix for each app process (mt_data/*/ directories,
+or mt_output/mt_<pid>_), and each of them may have several data_N.bin files.
+merge_events() streams all of them as a single sequence of events ordered by
+time, with heapq.merge over one generator per prefix, so memory depends on
+the number of prefixes and the block size, not on the number of events.
+
+Records have no timestamps. Idle and ping events are the sync points: their
+times are the clock of the device, and the time of every other record is
+interpolated from its ordinal between them (mt_index.TimeAnchors). Times of
+one prefix never go backwards, also across its data_N.bin files.
+
+Each event is (ms, source, seq, code, args) where code and args are those of
+parse_data() callbacks, and sources[source] gives the prefix, the process
+and the thread names of the event.
+
+    python consumer.py merge mt_data/*/ --out timeline.txt
+'''
+import os
+import re
+import heapq
+
+from consumer import parse_threadinfo, parse_methodinfo, parse_fieldinfo
+from mt_blocks import BlockDecoder
+from mt_index import load_index, TimeAnchors
+from mt_storage import ordered_traces
+
+# every stream holds one decoded block as Python objects
+MERGE_BLOCK_SIZE = 1 << 18
+
+# parse_data() codes whose first argument is the tid
+THREAD_CODES = {0, 1, 2, 3, 4, 5, 6, 9, 13, 14, 15}
+
+def process_of(prefix):
+    # pid of mt_<pid>_ prefixes, the directory name of mt_data/<name>/ ones
+    dirname, basename = os.path.split(prefix)
+    gp = re.match(r'mt_([0-9]+)_$', basename)
+    if gp:
+        return gp.group(1)
+    if basename == '':
+        return os.path.basename(dirname)
+    return basename
+
+class Source:
+    '''
+    One prefix of the run, with its data_N.bin files in the order of writing
+    '''
+    def __init__(self, number, prefix):
+        self.number = number
+        self.prefix = prefix
+        self.process = process_of(prefix)
+        self.threads = parse_threadinfo(prefix + "info_t.log")
+        self.data_fnames = ordered_traces(prefix)
+        self.num_events = 0
+
+    def thread_name(self, tid):
+        return "%s(%d)" % (self.threads[tid], tid) if tid in self.threads else "Thread-%d" % tid
+
+    def events(self, block_size=MERGE_BLOCK_SIZE):
+        # (ms, source, seq, code, args) of every record and event, ms never decreasing
+        seq = 0
+        last = float('-inf')
+        for data_fname in self.data_fnames:
+            index = load_index(data_fname)
+            decoder = BlockDecoder(data_fname, block_size)
+            anchors = TimeAnchors(index, decoder.timestamp)
+            ordinal = 0
+            for block in decoder:
+                records = block.records
+                num_records = len(records)
+                record_ms, event_ms = anchors.block(ordinal, block)
+                # the header of the next file may be earlier than the
+                # extrapolated end of the previous one
+                record_ms = (record_ms / 1000.0 + decoder.timestamp).clip(last)
+                event_ms = (event_ms / 1000.0 + decoder.timestamp).clip(last)
+                if num_records:
+                    last = max(last, float(record_ms[-1]))
+                if len(event_ms):
+                    last = max(last, float(event_ms[-1]))
+
+                columns = [records[name].tolist() for name in ('tid', 'action', 'ptr', 'obj', 'dex', 'detail_idx')]
+                record_ms = record_ms.tolist()
+                event_ms = event_ms.tolist()
+                done = 0
+                for (record_idx, offset, code, args), ms in zip(block.events + [(num_records, None, None, None)],
+                        event_ms + [None]):
+                    for rms, tid, action, ptr, obj, dex, detail_idx in zip(record_ms[done:record_idx],
+                            *[column[done:record_idx] for column in columns]):
+                        if action <= 2:
+                            yield (rms, self.number, seq, action, (tid, ptr))
+                        else:
+                            yield (rms, self.number, seq, action, (tid, ptr, obj, dex, detail_idx))
+                        seq += 1
+                    done = record_idx
+                    if code is None:
+                        break
+                    yield (ms, self.number, seq, code, args)
+                    seq += 1
+                ordinal += len(block)
+        self.num_events = seq
+
+def merge_events(prefixes, block_size=MERGE_BLOCK_SIZE):
+    '''
+    Returns (sources, iterator of (ms, source, seq, code, args)) over every
+    data_N.bin of prefixes, in the order of ms. Ties keep the order of
+    prefixes, then the order within the prefix.
+    '''
+    sources = [Source(number, prefix) for number, prefix in enumerate(prefixes)]
+    return sources, heapq.merge(*[source.events(block_size) for source in sources])
+
+def replay(prefixes, callbacks, block_size=MERGE_BLOCK_SIZE):
+    '''
+    parse_data() over the merged timeline: callbacks is list or dict of
+    code -> function(source, *args), where source is the Source of the event
+    '''
+    if isinstance(callbacks, list):
+        callbacks = dict(enumerate(callbacks))
+    sources, events = merge_events(prefixes, block_size)
+    for ms, number, seq, code, args in events:
+        callback = callbacks.get(code)
+        if callback is not None:
+            callback(sources[number], *args)
+    return sources
+
+def _describe(code, args, get_method_info, get_field_info):
+    if code <= 2:
+        return '%s method 0x%08X %s' % (['Entering ', 'Exiting  ', 'Unrolling'][code],
+            args[1], '\t'.join(get_method_info(args[1])))
+    elif code <= 4:
+        return '%s field 0x%08X object 0x%08X dex 0x%08X %s' % (['Reading', 'Writing'][code - 3],
+            args[1], args[2], args[3], '\t'.join(get_field_info(args[1], args[4])))
+    elif code == 5:
+        return 'ExceptionCaught %s' % args[1].replace('\n', '\\n')
+    elif code == 6:
+        return 'Dispatched Message %s' % args[1]
+    elif code == 7:
+        return 'Idle Timestamp %d' % args[0]
+    elif code == 8:
+        return 'Ping Timestamp %d' % args[0]
+    elif code == 9:
+        return 'Thread terminated'
+    elif code <= 12:
+        return 'TargetMethod #%d be %s' % (args[0], ['entered', 'exited', 'unwinded'][code - 10])
+    return 'TargetMethod #%d be %s' % (args[1], ['entered', 'exited', 'unwinded'][code - 13])
+
+def write_timeline(prefixes, out=None, block_size=MERGE_BLOCK_SIZE):
+    '''
+    Text timeline of the run, one line per event:
+        ms, process, thread, description
+    to out (file object, stdout by default), returns the number of events
+    '''
+    import sys
+    if out is None:
+        out = sys.stdout
+    sources, events = merge_events(prefixes, block_size)
+    method_infos = []
+    field_infos = []
+    for source in sources:
+        methods = parse_methodinfo(source.prefix + "info_m.log")
+        fields = parse_fieldinfo(source.prefix + "info_f.log")
+        method_infos.append(lambda ptr, methods=methods:methods[ptr] if ptr in methods else ["method_%08X" % ptr])
+        field_infos.append(lambda ptr, detidx, fields=fields:fields[ptr, detidx] \
+            if (ptr, detidx) in fields else ["field_%08X" % ptr])
+
+    lines = []
+    count = 0
+    for ms, number, seq, code, args in events:
+        source = sources[number]
+        thread = source.thread_name(args[0]) if code in THREAD_CODES else '-'
+        lines.append('%.3f\t%s\t%s\t%s\n' % (ms, source.process, thread,
+            _describe(code, args, method_infos[number], field_infos[number])))
+        count += 1
+        if len(lines) >= 4096:
+            out.write(''.join(lines))
+            lines = []
+    out.write(''.join(lines))
+    return count
@@ -0,0 +1,249 @@
+'''
+Global method ids shared by MiniTrace outputs of every app and run
+
+Method pointers of info_m.log are only valid in the process which wrote
+them. MethodDictionary is an sqlite3 database giving every
+(classname, methodname, signature, sourcefile) a stable integer id (gid),
+and build_remap() saves the pointers of one prefix with their gids as
+prefix + method_gid.npz, at collapse time. Aggregations over many prefixes
+then run on integer arrays, and only look the strings up for the output.
+
+Each database has a random uuid, saved in method_gid.npz with the gids, so
+a remap made with another database is rebuilt instead of mixing ids. Remaps
+of an in-memory database are never saved, their ids die with it.
+
+    python consumer.py collapse_binary mt_output/mt_*_ --method_db methods.sqlite3
+    python consumer.py summary mt_output/mt_*_ --method_db methods.sqlite3
+'''
+import os
+import glob
+import sqlite3
+import uuid
+import numpy as np
+
+from consumer import parse_methodinfo, parse_threadinfo
+
+REMAP_DTYPE = np.dtype([('ptr', '<u4'), ('gid', '<i4')])
+
+# sqlite3 limits the number of host parameters of a statement
+QUERY_CHUNK = 500
+
+def remap_fname_of(prefix):
+    return prefix + 'method_gid.npz'
+
+class MethodDictionary:
+    def __init__(self, db_fname, timeout=60.0):
+        self.db_fname = db_fname
+        self.persistent = db_fname not in (':memory:', '')
+        # collapse workers of several processes may share the database
+        self.conn = sqlite3.connect(db_fname, timeout=timeout)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS methods (
+            id INTEGER PRIMARY KEY,
+            classname TEXT NOT NULL,
+            methodname TEXT NOT NULL,
+            signature TEXT NOT NULL,
+            sourcefile TEXT NOT NULL,
+            UNIQUE (classname, methodname, signature, sourcefile))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL)''')
+        # the first process creating the database names it
+        self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('uuid', ?)", (uuid.uuid4().hex, ))
+        self.conn.commit()
+        self.uuid = self.conn.execute("SELECT value FROM meta WHERE key = 'uuid'").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM methods').fetchone()[0]
+
+    def ids_of(self, rows):
+        '''
+        gids of rows of [classname, methodname, signature, sourcefile],
+        adding the new ones. Returns int32 array in the order of rows.
+        '''
+        conn = self.conn
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('''CREATE TEMP TABLE IF NOT EXISTS query (
+                pos INTEGER PRIMARY KEY, classname, methodname, signature, sourcefile)''')
+            conn.execute('DELETE FROM query')
+            conn.executemany('INSERT INTO query VALUES (?, ?, ?, ?, ?)',
+                ((pos, ) + tuple(row) for pos, row in enumerate(rows)))
+            # new methods take ids in the order of rows
+            conn.execute('''INSERT OR IGNORE INTO methods (classname, methodname, signature, sourcefile)
+                SELECT classname, methodname, signature, sourcefile FROM query ORDER BY pos''')
+            pairs = conn.execute('''SELECT query.pos, methods.id FROM query JOIN methods
+                USING (classname, methodname, signature, sourcefile)''').fetchall()
+            conn.execute('DELETE FROM query')
+        ids = np.full(len(pairs), -1, dtype=np.int32)
+        if pairs:
+            pairs = np.array(pairs, dtype=np.int64)
+            ids[pairs[:, 0]] = pairs[:, 1]
+        return ids
+
+    def rows(self, gids):
+        # gid -> [classname, methodname, signature, sourcefile] of given gids
+        result = dict()
+        gids = sorted(set(int(gid) for gid in gids))
+        for start in range(0, len(gids), QUERY_CHUNK):
+            chunk = gids[start:start + QUERY_CHUNK]
+            for row in self.conn.execute('''SELECT id, classname, methodname, signature, sourcefile
+                    FROM methods WHERE id IN ({})'''.format(','.join('?' * len(chunk))), chunk):
+                result[row[0]] = list(row[1:])
+        return result
+
+def build_remap(prefix, dictionary):
+    # Table of info_m.log, saved as prefix + method_gid.npz if dictionary is persistent
+    methods = parse_methodinfo(prefix + 'info_m.log')
+    ptrs = list(methods)
+    gids = dictionary.ids_of(methods.values())
+    table = np.zeros(len(ptrs), dtype=REMAP_DTYPE)
+    table['ptr'] = ptrs
+    table['gid'] = gids
+    table.sort(order='ptr')
+    if dictionary.persistent:
+        with open(remap_fname_of(prefix), 'wb') as f:
+            np.savez(f, table=table, dictionary=np.array(dictionary.uuid))
+    return table
+
+class PtrRemap:
+    '''
+    ptr -> gid of one prefix, -1 for pointers missing in info_m.log
+    '''
+    def __init__(self, table):
+        self.ptrs = np.ascontiguousarray(table['ptr'])
+        self.gids = np.ascontiguousarray(table['gid'])
+
+    def lookup(self, ptrs):
+        ptrs = np.asarray(ptrs, dtype=np.uint32)
+        if len(self.ptrs) == 0:
+            return np.full(len(ptrs), -1, dtype=np.int32)
+        pos = np.minimum(np.searchsorted(self.ptrs, ptrs), len(self.ptrs) - 1)
+        return np.where(self.ptrs[pos] == ptrs, self.gids[pos], -1).astype(np.int32)
+
+def load_remap(prefix, dictionary=None):
+    '''
+    PtrRemap of prefix, built with dictionary if method_gid.npz is missing,
+    stale, or made with another database. Without dictionary, any saved one.
+    '''
+    fname = remap_fname_of(prefix)
+    if os.path.isfile(fname) and os.path.getmtime(fname) >= os.path.getmtime(prefix + 'info_m.log'):
+        with open(fname, 'rb') as f:
+            npz = np.load(f)
+            if dictionary is None or str(npz['dictionary']) == dictionary.uuid:
+                return PtrRemap(npz['table'])
+    if dictionary is None:
+        raise FileNotFoundError(fname)
+    return PtrRemap(build_remap(prefix, dictionary))
+
+def collapsed_entries(prefix, remap):
+    '''
+    Method entries of collapse_*.pk (collapse_v2) or collapse.txt (collapse),
+    in the order of the files. Returns list of (thread name, ptr array,
+    gid array, count array), with gid -1 for pointers missing in info_m.log
+    '''
+    import pickle
+    threads = parse_threadinfo(prefix + 'info_t.log') if os.path.isfile(prefix + 'info_t.log') else {}
+    get_thread_name = lambda tid:threads[tid] if tid in threads else "Thread-%d" % tid
+    parts = [] # (thread name, ptrs, counts)
+    for pk_fname in sorted(glob.glob(prefix + 'collapse_*.pk')):
+        with open(pk_fname, 'rb') as pkfile:
+            counter = pickle.load(pkfile)
+        for tid, m2c in counter.items():
+            parts.append((get_thread_name(tid),
+                np.fromiter(m2c.keys(), np.uint32, len(m2c)), np.fromiter(m2c.values(), np.int64, len(m2c))))
+    if os.path.isfile(prefix + 'collapse.txt'):
+        with open(prefix + 'collapse.txt', 'rt') as f:
+            for line in f:
+                tname, count, ptr = line.rstrip('\n').split('\t')[:3]
+                # lines of one thread are contiguous
+                if not parts or parts[-1][0] != tname:
+                    parts.append((tname, [], []))
+                parts[-1][1].append(int(ptr, 16))
+                parts[-1][2].append(int(count))
+
+    entries = []
+    for tname, ptrs, counts in parts:
+        ptrs = np.asarray(ptrs, dtype=np.uint32)
+        entries.append((tname, ptrs, remap.lookup(ptrs), np.asarray(counts, dtype=np.int64)))
+    return entries
+
+class EntryCounts:
+    '''
+    Counts by nonnegative integer key, with the order in which keys appeared
+    '''
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.first = np.zeros(0, dtype=np.int64) # -1 for keys never added
+        self.seen = 0
+
+    def add(self, keys, counts):
+        if len(keys) == 0:
+            return
+        size = int(keys.max()) + 1
+        if size > len(self.counts):
+            self.counts = np.concatenate([self.counts, np.zeros(size - len(self.counts), dtype=np.int64)])
+            self.first = np.concatenate([self.first, np.full(size - len(self.first), -1, dtype=np.int64)])
+        np.add.at(self.counts, keys, counts)
+        uniq, index = np.unique(keys, return_index=True)
+        new = self.first[uniq] < 0
+        new_keys = uniq[new][np.argsort(index[new])]
+        self.first[new_keys] = self.seen + np.arange(len(new_keys))
+        self.seen += len(new_keys)
+
+    def ranked(self):
+        # (key, count) of keys added, by descending count, then order of appearance
+        keys = np.flatnonzero(self.first >= 0)
+        order = np.lexsort((self.first[keys], -self.counts[keys]))
+        return list(zip(keys[order].tolist(), self.counts[keys][order].tolist()))
+
+class GlobalCounts:
+    '''
+    Entry counts by gid over many prefixes, in total and per thread name.
+    Methods missing in info_m.log are counted by name, "method_%08X" of their
+    pointer. Keys of EntryCounts are 2 * gid, or 2 * index of the name + 1.
+    '''
+    def __init__(self, threads=None):
+        self.total = EntryCounts()
+        self.threads = threads # thread names to count separately, None for all
+        self.per_thread = dict() # thread name -> EntryCounts
+        self.names = [] # names of missing methods
+        self.name_index = dict()
+
+    def _keys(self, ptrs, gids):
+        keys = gids.astype(np.int64) * 2
+        missing = np.flatnonzero(gids < 0)
+        for i, ptr in zip(missing.tolist(), ptrs[missing].tolist()):
+            name = "method_%08X" % ptr
+            index = self.name_index.get(name)
+            if index is None:
+                index = self.name_index[name] = len(self.names)
+                self.names.append(name)
+            keys[i] = index * 2 + 1
+        return keys
+
+    def add(self, entries):
+        for tname, ptrs, gids, counts in entries:
+            keys = self._keys(ptrs, gids)
+            self.total.add(keys, counts)
+            if self.threads is None or tname in self.threads:
+                self.per_thread.setdefault(tname, EntryCounts()).add(keys, counts)
+
+    def ranked(self, thread=None):
+        # (gid or name, count) of total or of thread, by descending count, then order of appearance
+        counts = self.total if thread is None else self.per_thread.get(thread, EntryCounts())
+        return [(self.names[key >> 1] if key & 1 else key >> 1, count) for key, count in counts.ranked()]
+
+def write_summary(fname, ranked, rows):
+    # ranked: (gid or name, count), rows: gid -> [classname, methodname, signature, sourcefile]
+    with open(fname, 'wt') as f:
+        for key, count in ranked:
+            f.write('{}\t{}\n'.format(count, '\t'.join(rows[key] if key in rows else [key])))
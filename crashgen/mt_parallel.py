@@ -0,0 +1,253 @@
+'''
+Intra-file parallel decoding of one MiniTrace data_N.bin
+
+The file is cut into chunks of equal size, and every chunk goes to a worker
+process. A cut rarely falls on a record boundary, so a worker skims its chunk
+speculatively from the cut, restarting one byte later whenever the guessed
+record stream turns out to be invalid. Streams started from a wrong offset
+merge into the true one within a few records, so the worker only keeps the
+boundaries it met within the first `probe` bytes, and decodes and aggregates
+the rest of the chunk (the settled part) up to the first boundary after the
+chunk end (the exit).
+
+The parent then walks the chunks in order. The exit of a chunk is the true
+entry of the next one; if that entry is one of the boundaries kept by the
+worker, the speculative stream was right, and only the short head between the
+entry and the settled part is decoded in the parent. Otherwise the whole chunk
+is decoded again from the entry, so the result never depends on the guess.
+
+Partial aggregates carry the file offset of their first record, which makes
+the reduced result identical to a serial pass, including dictionary order.
+Per-thread stack depth deltas are reduced the same way, giving the running
+depth of every thread at each chunk entry.
+'''
+import os, sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from consumer import HEADER_SIZE, parse_header, kMiniTraceMethodEnter
+from mt_blocks import (
+    BlockDecoder,
+    DEFAULT_BLOCK_SIZE,
+    SKIM_OK,
+    kind_table,
+    make_block,
+    skim
+)
+from mt_index import DepthTracker
+from mt_storage import is_compressed
+
+DEFAULT_CHUNK_SIZE = 1 << 25
+DEFAULT_PROBE = 1 << 16
+# bytes read after the chunk end, to find the exit
+DEFAULT_MARGIN = 1 << 20
+# size of the longest record other than exceptions / messages
+MAX_FIXED_SIZE = 16
+
+class EntryCounts:
+    '''
+    Partial aggregate of method entries : (tid, fptr) -> count
+    with the offset of the first entry
+    '''
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.first = np.empty(0, dtype=np.int64)
+
+    def add(self, block):
+        records = block.records
+        mask = records['action'] == kMiniTraceMethodEnter
+        entered = records[mask]
+        if len(entered) == 0:
+            return
+        keys = (entered['tid'].astype(np.uint64) << np.uint64(32)) | entered['ptr']
+        keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        other = EntryCounts()
+        other.keys = keys
+        other.counts = counts.astype(np.int64)
+        other.first = block.offsets[mask][first]
+        self.merge(other)
+
+    def merge(self, other):
+        keys = np.concatenate([self.keys, other.keys])
+        counts = np.concatenate([self.counts, other.counts])
+        first = np.concatenate([self.first, other.first])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        self.keys = keys
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+        self.first = np.full(len(keys), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(self.first, inverse, first)
+
+    def result(self, methods=None):
+        # Same as mt_blocks.count_method_entries()
+        counter = dict()
+        missing = dict()
+        order = np.argsort(self.first, kind='stable')
+        for key, count in zip(self.keys[order].tolist(), self.counts[order].tolist()):
+            tid = key >> 32
+            fptr = key & 0xFFFFFFFF
+            if methods is not None and fptr not in methods:
+                missing[fptr] = missing.get(fptr, 0) + count
+                continue
+            try:
+                m2c = counter[tid]
+            except KeyError:
+                m2c = counter[tid] = dict()
+            m2c[fptr] = count
+
+        for fptr, count in missing.items():
+            print("Warning on collapse: function %08X not found (%d times)" % (fptr, count), file=sys.stderr)
+        return counter
+
+class ChunkResult:
+    def __init__(self, begin, sample, settled, exit, partial, depths):
+        self.begin = begin
+        self.sample = sample    # set of candidate boundaries before the settled part
+        self.settled = settled  # offset where the aggregated part starts
+        self.exit = exit        # first boundary after the chunk, None if unknown
+        self.partial = partial
+        self.depths = depths    # tid -> depth delta of the settled part
+
+def _next_boundary(buf, version, table, pos):
+    # Offset of the record after the one at pos, None if there is no valid record at pos
+    fixed, slow, consumed, status = skim(buf, version, pos, table, limit=pos + 1)
+    if status != SKIM_OK or consumed == pos:
+        return None
+    return consumed
+
+def resolve_head(buf, version, table, starts, limit):
+    '''
+    Follow the record streams from every offset of starts at once, until they
+    merge into one. Returns (visited, merged)
+        - visited: offsets met by any stream before the merge
+        - merged: the offset where all the surviving streams met, None if they did
+          not meet before limit, or all of them died
+    '''
+    visited = set()
+    current = set(starts)
+    while len(current) > 1:
+        pos = min(current)
+        current.remove(pos)
+        if pos >= limit:
+            return visited, None
+        visited.add(pos)
+        nxt = _next_boundary(buf, version, table, pos)
+        if nxt is not None:
+            current.add(nxt)
+    if not current:
+        return visited, None
+    return visited, current.pop()
+
+def scan_chunk(data_fname, version, begin, end, aggregator, probe=DEFAULT_PROBE,
+        margin=DEFAULT_MARGIN, block_size=DEFAULT_BLOCK_SIZE):
+    # Runs in a worker process
+    last = end >= os.path.getsize(data_fname)
+    with open(data_fname, 'rb') as f:
+        f.seek(begin)
+        buf = f.read(end - begin + (0 if last else margin))
+    length = end - begin
+    partial = aggregator()
+    tracker = DepthTracker()
+    if len(buf) < 6:
+        return ChunkResult(begin, set(), begin, begin if last else None, partial, {})
+    table = kind_table(np.frombuffer(buf, np.uint8), version)
+
+    # The true entry is one of the first bytes, unless a long record crosses the cut
+    visited, pos = resolve_head(buf, version, table, range(min(MAX_FIXED_SIZE, length)), probe)
+    if pos is None:
+        return ChunkResult(begin, set(), None, None, partial, {})
+
+    # settled part
+    settled = pos
+    while pos < length:
+        fixed, slow, consumed, status = skim(buf, version, pos, table,
+            limit=min(pos + block_size, length))
+        if fixed or slow:
+            block = make_block(buf, begin, fixed, slow, version, decode_events=False)
+            partial.add(block)
+            tracker.advance(block.records, [])
+        if status != SKIM_OK:
+            # parse_data() would stop or fail there
+            return ChunkResult(begin, set(), None, None, partial, {})
+        if consumed == pos:
+            break
+        pos = consumed
+
+    exit = pos if pos >= length or last else None
+    return ChunkResult(begin, set(p + begin for p in visited), settled + begin,
+        None if exit is None else exit + begin, partial, tracker.depths)
+
+def decode_range(data_fname, aggregator, start, stop, tracker=None, block_size=DEFAULT_BLOCK_SIZE):
+    # Aggregate records in [start, stop) serially, returns (partial, end_offset, complete)
+    partial = aggregator()
+    decoder = BlockDecoder(data_fname, block_size, decode_events=False, start=start, stop=stop)
+    for block in decoder:
+        partial.add(block)
+        if tracker is not None:
+            tracker.advance(block.records, [])
+    complete = stop is not None and decoder.end_offset >= stop
+    return partial, decoder.end_offset, complete
+
+def parallel_reduce(data_fname, aggregator=EntryCounts, workers=None, chunk_size=None,
+        probe=DEFAULT_PROBE):
+    '''
+    Aggregate the whole data_fname with a process pool.
+    Returns (partial, entry_depths)
+        - partial: reduced aggregator, same as aggregating every record serially
+        - entry_depths: list of (offset, DICT tid -> depth) at each chunk entry
+    '''
+    if is_compressed(data_fname):
+        # compressed streams cannot be cut into chunks, see mt_storage
+        partial, _, _ = decode_range(data_fname, aggregator, None, None)
+        return partial, [(HEADER_SIZE, dict())]
+    with open(data_fname, 'rb') as f:
+        version = parse_header(f.read(HEADER_SIZE))[0]
+    size = os.path.getsize(data_fname)
+    if workers is None or workers <= 0:
+        workers = os.cpu_count()
+    if chunk_size is None:
+        chunk_size = min(DEFAULT_CHUNK_SIZE, (size - HEADER_SIZE) // (workers * 4))
+    chunk_size = max(chunk_size, probe * 4)
+
+    cuts = list(range(HEADER_SIZE, size, chunk_size)) + [size]
+    if len(cuts) == 1:
+        cuts.append(size)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan_chunk, data_fname, version, begin, end, aggregator, probe)
+            for begin, end in zip(cuts[:-1], cuts[1:])]
+
+        total = aggregator()
+        tracker = DepthTracker()
+        entry_depths = []
+        entry = HEADER_SIZE
+        for end, future in zip(cuts[1:], futures):
+            result = future.result()
+            entry_depths.append((entry, dict(tracker.depths)))
+            if result.exit is not None and (entry in result.sample or entry == result.settled):
+                partial, _, _ = decode_range(data_fname, aggregator, entry, result.settled, tracker)
+                total.merge(partial)
+                total.merge(result.partial)
+                for tid, delta in result.depths.items():
+                    tracker.depths[tid] = tracker.depths.get(tid, 0) + delta
+                entry = result.exit
+            else:
+                partial, entry, complete = decode_range(data_fname, aggregator, entry,
+                    end if end < size else None, tracker)
+                total.merge(partial)
+                if not complete:
+                    break
+            if entry >= size:
+                break
+
+        for future in futures:
+            future.cancel()
+    return total, entry_depths
+
+def count_method_entries(data_fname, methods=None, workers=None, chunk_size=None):
+    '''
+    Parallel counterpart of mt_blocks.count_method_entries()
+    Returns DICT COUNTER : tid -> (DICT : fptr -> count)
+    '''
+    partial, _ = parallel_reduce(data_fname, EntryCounts, workers, chunk_size)
+    return partial.result(methods)
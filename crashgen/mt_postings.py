@@ -0,0 +1,167 @@
+'''
+Inverted index of col_matrix/: method -> messages and idle windows
+
+write_matrix() stores, next to the CSR / CSC arrays of mt_matrix, one
+posting list per method (mid) of the rows of the messages which entered it,
+and one of the idle windows, both ascending:
+
+    inv_msg_ptr.npy         mid -> byte offsets in inv_msg_gaps and inv_msg_counts
+    inv_msg_gaps.npy        rows as gaps from the previous row (first one from 0)
+    inv_msg_counts.npy      entry count of each posting
+    inv_idle_ptr.npy, inv_idle_gaps.npy, inv_idle_counts.npy
+                            same for idle windows
+
+Gaps and counts are LEB128 varints (7 bits per byte, high bit set on every
+byte but the last), decoded with numpy for the slice of one method. The
+arrays are memory-mapped by open_matrix(), so a query reads only the
+postings of its methods. Intersections start from the shortest list and
+probe the others with searchsorted.
+
+    python consumer.py query mt_output/mt_1234_ --method 70F17F58,720A61A0
+'''
+import os
+import numpy as np
+
+POSTINGS_VERSION = 1
+
+POSTING_KINDS = ['msg', 'idle']
+
+def encode_varints(values):
+    # uint8 array of LEB128 varints of non-negative values, and byte length of each
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    ends = np.cumsum(nbytes)
+    out = np.zeros(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    starts = ends - nbytes
+    for k in range(int(nbytes.max()) if len(nbytes) else 0):
+        has = nbytes > k
+        byte = (values[has] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (nbytes[has] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has] + k] = (byte | more).astype(np.uint8)
+    return out, nbytes
+
+def decode_varints(buf):
+    # Values of a run of whole LEB128 varints
+    buf = np.asarray(buf, dtype=np.uint8)
+    last = np.flatnonzero(buf < 0x80)
+    values = buf[last].astype(np.int64)
+    if len(last) == len(buf):
+        return values
+    # from the last byte of each varint down to its first one
+    lengths = np.diff(np.concatenate([[-1], last]))
+    k = 1
+    longer = np.flatnonzero(lengths > k)
+    while len(longer):
+        values[longer] = (values[longer] << 7) | (buf[last[longer] - k] & 0x7F)
+        k += 1
+        longer = longer[lengths[longer] > k]
+    return values
+
+def _postings(mids, rows, counts, num_mids, prefix):
+    # Arrays of the posting lists of (mid, row, count) entries, rows ascending
+    order = np.argsort(mids, kind='stable')
+    mids, rows, counts = mids[order], rows[order], counts[order]
+    bounds = np.zeros(num_mids + 1, dtype=np.int64)
+    np.cumsum(np.bincount(mids, minlength=num_mids), out=bounds[1:])
+    gaps = rows.copy()
+    gaps[1:] -= rows[:-1]
+    # the first posting of every mid keeps its row
+    firsts = bounds[:-1][np.diff(bounds) > 0]
+    gaps[firsts] = rows[firsts]
+
+    gap_bytes, gap_nbytes = encode_varints(gaps)
+    count_bytes, count_nbytes = encode_varints(counts)
+    # byte offsets of each mid in both streams
+    gap_ptr = np.concatenate([[0], np.cumsum(gap_nbytes)])[bounds]
+    count_ptr = np.concatenate([[0], np.cumsum(count_nbytes)])[bounds]
+    return {
+        'inv_{}_ptr'.format(prefix): np.stack([gap_ptr, count_ptr], axis=1).astype(np.int64),
+        'inv_{}_gaps'.format(prefix): gap_bytes,
+        'inv_{}_counts'.format(prefix): count_bytes,
+    }
+
+def build_postings(arrays):
+    '''
+    Posting arrays, name -> array, from the arrays of mt_matrix.build_arrays()
+    '''
+    num_mids = len(arrays['methods_ptr'])
+    postings = dict()
+    for kind in POSTING_KINDS:
+        indptr = arrays[kind + '_indptr']
+        rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+        postings.update(_postings(np.asarray(arrays[kind + '_mids'], dtype=np.int64), rows,
+            np.asarray(arrays[kind + '_counts'], dtype=np.int64), num_mids, kind))
+    return postings
+
+class PostingIndex:
+    def __init__(self, matrix):
+        # matrix: mt_matrix.MessageMatrix with the posting arrays
+        self.matrix = matrix
+        self.arrays = matrix.arrays
+
+    def postings(self, kind, mid):
+        # (rows, counts) of mid, rows ascending
+        ptr = self.arrays['inv_{}_ptr'.format(kind)]
+        (gap_lo, count_lo), (gap_hi, count_hi) = ptr[mid].tolist(), ptr[mid + 1].tolist()
+        rows = np.cumsum(decode_varints(self.arrays['inv_{}_gaps'.format(kind)][gap_lo:gap_hi]))
+        counts = decode_varints(self.arrays['inv_{}_counts'.format(kind)][count_lo:count_hi])
+        return rows, counts
+
+    def _mids(self, ptrs):
+        # mids of ptrs, None if one of them was never entered
+        mids = [self.matrix.mid_of(ptr) for ptr in ptrs]
+        if any(mid == -1 for mid in mids):
+            return None
+        return mids
+
+    def intersect(self, kind, ptrs):
+        '''
+        (rows, counts) of rows of kind which entered every method of ptrs,
+        counts being array of rows x ptrs
+        '''
+        mids = self._mids(ptrs)
+        if not mids:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(ptrs)), dtype=np.int64)
+        lists = [self.postings(kind, mid) for mid in mids]
+        order = sorted(range(len(lists)), key=lambda i:len(lists[i][0]))
+        rows = lists[order[0]][0]
+        for i in order[1:]:
+            other = lists[i][0]
+            pos = np.minimum(np.searchsorted(other, rows), max(len(other) - 1, 0))
+            rows = rows[other[pos] == rows] if len(other) else rows[:0]
+            if len(rows) == 0:
+                break
+        counts = np.zeros((len(rows), len(lists)), dtype=np.int64)
+        for i, (posting_rows, posting_counts) in enumerate(lists):
+            counts[:, i] = posting_counts[np.searchsorted(posting_rows, rows)]
+        return rows, counts
+
+    def messages_with(self, ptrs):
+        # [(msgid, [count of each ptr])] of messages which entered every method of ptrs
+        rows, counts = self.intersect('msg', ptrs)
+        return list(zip(self.matrix.msg_ids[rows].tolist(), counts.tolist()))
+
+    def idles_with(self, ptrs):
+        # [(idle index, [count of each ptr])] of idle windows which entered every method of ptrs
+        rows, counts = self.intersect('idle', ptrs)
+        return list(zip(rows.tolist(), counts.tolist()))
+
+def load_postings(prefix):
+    '''
+    PostingIndex of col_matrix/ of prefix, adding the posting arrays to
+    matrices written before them
+    '''
+    from mt_matrix import load_collapsed, matrix_dirname_of
+    matrix = load_collapsed(prefix)
+    if 'inv_msg_ptr' not in matrix.arrays:
+        postings = build_postings(matrix.arrays)
+        dirname = matrix_dirname_of(prefix)
+        if os.path.isdir(dirname):
+            for name, array in postings.items():
+                np.save(os.path.join(dirname, name + '.npy'), array)
+        matrix.arrays.update(postings)
+    return PostingIndex(matrix)
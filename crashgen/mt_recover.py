@@ -0,0 +1,254 @@
+'''
+Resynchronization of BlockDecoder over corrupt or partial regions
+
+An app killed during a write leaves a partial record, and the records after
+it are read from a wrong boundary: parse_data() raises RuntimeError on the
+first invalid action, or stops on a bad length, losing the rest of the file.
+With BlockDecoder(recover=True), skim() still runs at full speed, and a
+trace which skim() reads to the end decodes exactly as without recovery.
+Only when skim() stops on a bad record does Recovery
+
+    - drop the records before it since the last RESYNC_RECORDS plausible
+      records in a row, as misaligned ones can pass skim() for a while
+    - look for the next offset starting RESYNC_RECORDS plausible records in
+      a row, checking every offset of the block at once with numpy
+    - record the region in between as skipped, and go on from there
+
+A record is plausible when its tid is known (info_t.log, records of the
+previous blocks, or tids frequent in the current one), and, for the other
+records, when idle / ping timestamps are near the header, and exceptions /
+messages have action 5 or 6, at most MAX_EVENT_SIZE bytes and end with a
+null character.
+
+    python consumer.py check mt_output/mt_1234_
+    python mt_recover.py --records 200000   # regression check on clean synthetic traces
+'''
+import os, sys
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from consumer import kMiniTraceActionMask, kMiniTraceExceptionCaught
+
+# number of plausible records in a row after a resync point
+RESYNC_RECORDS = 8
+
+# longer exceptions / messages are taken as corrupt lengths
+MAX_EVENT_SIZE = 1 << 20
+
+# tids seen this many times in a block are taken as threads
+MIN_TID_COUNT = 3
+
+# idle / ping timestamps in ms, around the header one
+TIMESTAMP_BEFORE = 24 * 3600 * 1000
+TIMESTAMP_AFTER = 366 * 24 * 3600 * 1000
+
+class Recovery:
+    def __init__(self, version, timestamp, threads=()):
+        from mt_blocks import KIND_METHOD, KIND_FIELD, KIND_SPECIAL10, KIND_SPECIAL6, KIND_VARIABLE
+        self.version = version
+        self.min_timestamp = timestamp - TIMESTAMP_BEFORE
+        self.max_timestamp = timestamp + TIMESTAMP_AFTER
+        self.known = np.zeros(1 << 16, dtype=bool)
+        for tid in threads:
+            self.known[tid & 0xFFFF] = True
+        self.sizes = np.zeros(5, dtype=np.int64)
+        self.sizes[[KIND_METHOD, KIND_FIELD, KIND_SPECIAL10, KIND_SPECIAL6]] = [6, 16, 10, 6]
+        self.kind_variable = KIND_VARIABLE
+        self.kind_special10 = KIND_SPECIAL10
+        self.kind_special6 = KIND_SPECIAL6
+        # (start, end, records dropped) of every skipped region
+        self.regions = []
+        self.dropped_events = 0
+
+    @property
+    def skipped_bytes(self):
+        return sum(end - start for start, end, _ in self.regions)
+
+    @property
+    def skipped_events(self):
+        return sum(dropped for _, _, dropped in self.regions) + self.dropped_events
+
+    def learn(self, records):
+        # tids of records decoded in sync
+        self.known[records['tid']] = True
+
+    def _known_in(self, a, fixed):
+        # known tids, with the ones frequent among the fixed records of a
+        known = self.known
+        if len(fixed):
+            starts = np.asarray(fixed, dtype=np.int64)
+            tids, counts = np.unique(a[starts].astype(np.int64) | (a[starts + 1].astype(np.int64) << 8),
+                return_counts=True)
+            frequent = tids[counts >= MIN_TID_COUNT]
+            if len(frequent):
+                known = known.copy()
+                known[frequent] = True
+        return known
+
+    def plausible(self, a, known):
+        '''
+        (valid, size) for every offset of uint8 array a having 6 bytes left:
+        whether a plausible record starts there, and its size
+        '''
+        from mt_blocks import kind_table
+        m = len(a) - 5
+        kinds = np.frombuffer(kind_table(a, self.version), np.uint8)
+        tid = a[:m].astype(np.int64) | (a[1:m+1].astype(np.int64) << 8)
+        value = a[2:m+2].astype(np.int64) | (a[3:m+3].astype(np.int64) << 8) \
+            | (a[4:m+4].astype(np.int64) << 16) | (a[5:m+5].astype(np.int64) << 24)
+        size = self.sizes[kinds]
+        valid = known[tid] if known.any() else np.ones(m, dtype=bool)
+        # tids 0-5 are not threads there
+        valid[(kinds == self.kind_special10) | (kinds == self.kind_special6)] = True
+
+        variable = np.flatnonzero(kinds == self.kind_variable)
+        action = value[variable] & kMiniTraceActionMask
+        length = value[variable] >> 3
+        last = np.minimum(variable + length - 1, len(a) - 1)
+        # exception / message
+        valid[variable] &= (action >= kMiniTraceExceptionCaught) & (action <= 6) \
+            & (length > 6) & (length <= MAX_EVENT_SIZE) \
+            & ((variable + length > len(a)) | (a[last] == 0))
+        size[variable] = np.maximum(length, 1)
+
+        timed = np.flatnonzero((kinds == self.kind_special10) & (tid <= 1))
+        inside = timed[timed + 10 <= len(a)]
+        if len(inside):
+            windows = as_strided(a, shape=(len(a) - 7, 8), strides=(1, 1))
+            timestamp = windows[inside + 2].copy().view('<u8').ravel()
+            valid[inside] = (timestamp >= max(self.min_timestamp, 0)) & (timestamp <= self.max_timestamp)
+        return valid, size
+
+    def backtrack(self, buf, fixed, slow, pos):
+        '''
+        Drop the records of skim() before pos after the last RESYNC_RECORDS
+        plausible records in a row, which may be misaligned too. Returns
+        (fixed, slow, start of the dropped ones, number dropped)
+        '''
+        a = np.frombuffer(buf, np.uint8)
+        known = self._known_in(a, fixed)
+        cut = (fixed, slow, pos, 0)
+        dropped = 0
+        run = 0
+        while (fixed or slow) and run < RESYNC_RECORDS:
+            if slow and slow[-1][0] == len(fixed):
+                start, size = slow[-1][1:]
+                slow = slow[:-1]
+            else:
+                start, size = fixed[-1], 16
+                fixed = fixed[:-1]
+            dropped += 1
+            if self.plausible(a[start:start + size + 5], known)[0][0]:
+                run += 1
+            else:
+                # misaligned from here on, unless a long enough run comes before
+                run = 0
+                cut = (fixed, slow, start, dropped)
+        return cut
+
+    def resync(self, buf, pos, fixed=(), complete=False):
+        '''
+        First offset after pos starting RESYNC_RECORDS plausible records, None
+        if there is no such offset. Records past the end of buf are taken as
+        plausible, unless complete (buf then ends at the end of the file), in
+        which case the records may only stop right at the end.
+        '''
+        a = np.frombuffer(buf, np.uint8)
+        known = self._known_in(a, fixed)
+        a = a[pos + 1:]
+        m = len(a) - 5
+        if m <= 0:
+            return None
+        valid, size = self.plausible(a, known)
+        ok = valid.copy()
+        cur = np.arange(m, dtype=np.int64)
+        for _ in range(RESYNC_RECORDS - 1):
+            cur = cur + size[np.minimum(cur, m - 1)] * (cur < m)
+            past = (cur == len(a)) if complete else (cur >= m)
+            ok &= past | ((cur < m) & valid[np.minimum(cur, m - 1)])
+        found = np.flatnonzero(ok)
+        if len(found) == 0:
+            return None
+        return pos + 1 + int(found[0])
+
+    def skip(self, start, end, dropped):
+        self.regions.append((start, end, dropped))
+
+    def drop_event(self, offset, size):
+        # an event record which failed to decode
+        self.dropped_events += 1
+
+    def report(self, data_fname, file=sys.stderr):
+        if not self.regions and not self.dropped_events:
+            return
+        print("Warning: {} corrupt regions of {}, {} bytes skipped, {} records dropped".format(
+            len(self.regions), data_fname, self.skipped_bytes, self.skipped_events), file=file)
+        for start, end, dropped in self.regions:
+            print("    [{}, {}) {} bytes, {} records".format(start, end, end - start, dropped), file=file)
+
+def check_traces(prefix, file=sys.stdout):
+    '''
+    Decode every data_N.bin of prefix with recovery, printing what is skipped.
+    Returns the number of files with corrupt regions or a truncated tail.
+    '''
+    from consumer import parse_threadinfo
+    from mt_blocks import BlockDecoder
+    from mt_storage import ordered_traces
+    threads = ()
+    if os.path.isfile(prefix + "info_t.log"):
+        threads = list(parse_threadinfo(prefix + "info_t.log").keys())
+    damaged = 0
+    for data_fname in ordered_traces(prefix):
+        decoder = BlockDecoder(data_fname, recover=True, threads=threads)
+        count = sum(len(block) for block in decoder)
+        recovery = decoder.recovery
+        print("{}: {} records, {} corrupt regions, {} bytes skipped, {} records dropped, {} bytes truncated".format(
+            data_fname, count, len(recovery.regions), recovery.skipped_bytes, recovery.skipped_events,
+            decoder.truncated_bytes), file=file)
+        for start, end, dropped in recovery.regions:
+            print("    [{}, {}) {} bytes, {} records".format(start, end, end - start, dropped), file=file)
+        if recovery.regions or recovery.dropped_events or decoder.truncated_bytes:
+            damaged += 1
+    return damaged
+
+def decoded(data_fname, recover=False, threads=()):
+    # records of data_fname as bytes, and its events with the number of records before them
+    from mt_blocks import BlockDecoder
+    records = []
+    events = []
+    num_records = 0
+    for block in BlockDecoder(data_fname, recover=recover, threads=threads):
+        records.append(block.records.tobytes())
+        events.extend((num_records + record_idx, ) + tuple(event) for record_idx, *event in block.events)
+        num_records += len(block.records)
+    return b''.join(records), events
+
+def same_with_recovery(data_fname, threads=()):
+    # whether data_fname decodes to the same records and events with and without recovery
+    return decoded(data_fname) == decoded(data_fname, recover=True, threads=threads)
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    from consumer import parse_threadinfo
+    from mt_synth import write_trace
+
+    parser = argparse.ArgumentParser(description='Check that recovery changes nothing on clean synthetic traces')
+    parser.add_argument('--records', default='200000')
+    parser.add_argument('--seeds', default='4')
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        for version in (3, 4):
+            for seed in range(int(args.seeds)):
+                for short_lived_rate in (0.0, 0.0001, 0.01):
+                    prefix = os.path.join(workdir, 'synth_{}_{}_{}_'.format(version, seed, short_lived_rate))
+                    write_trace(prefix, num_records=int(args.records), version=version,
+                        short_lived_rate=short_lived_rate, seed=seed)
+                    threads = list(parse_threadinfo(prefix + "info_t.log").keys())
+                    same = same_with_recovery(prefix + "data_0.bin", threads)
+                    print('version {} seed {} short lived threads {}: {}'.format(
+                        version, seed, short_lived_rate, 'same' if same else 'DIFFERENT'))
+                    failures += not same
+    sys.exit(1 if failures else 0)
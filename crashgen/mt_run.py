@@ -1,5 +1,7 @@
 import os, sys
 import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from androidkit import (
     get_package_name,
@@ -20,7 +22,7 @@ class WrongConnectionState(Exception):
     pass
 
 class Connections:
-    def __init__(self, package_name, serial, output_folder):
+    def __init__(self, package_name, serial, output_folder, compress=None):
         if not os.path.isdir(output_folder):
             os.makedirs(output_folder)
 
@@ -32,6 +34,11 @@ class Connections:
         self.log = []
         self.errlog = []
 
+        # codec of mt_storage for pulled traces, None to keep them raw
+        self.compress = compress
+        self._storage = None
+        self._storage_futures = []
+
     def new_connection(self, socketfd, pid):
         if socketfd in self.connections:
             raise WrongConnectionState
@@ -61,6 +68,28 @@ class Connections:
                 serial=self.serial)
         run_adb_cmd("shell rm {}".format(fname),
                 serial=self.serial)
+        self.store(os.path.join(self.output_folder, os.path.split(fname)[1]))
+
+    def store(self, fname):
+        # Compress pulled trace in background, zlib and lzma release the GIL
+        if self.compress is None or not re.match(r'.*data_[0-9]+\.bin$', fname):
+            return
+        from mt_storage import compress_trace
+        if self._storage is None:
+            self._storage = ThreadPoolExecutor(max_workers=1)
+        self._storage_futures.append((fname, self._storage.submit(compress_trace, fname, self.compress)))
+
+    def wait_storage(self):
+        for fname, future in self._storage_futures:
+            try:
+                print('{} stored {}'.format(TAG, future.result()))
+            except Exception:
+                print('{} failed to compress {}'.format(TAG, fname), file=sys.stderr)
+                traceback.print_exc()
+        self._storage_futures = []
+        if self._storage is not None:
+            self._storage.shutdown()
+            self._storage = None
 
     def close_connection(self, socketfd, prefix):
         if socketfd not in self.connections:
@@ -99,6 +128,9 @@ class Connections:
                         break
                     run_adb_cmd("shell rm {}".format(fname),
                             serial=self.serial)
+                if prefix_local != "":
+                    for file in pulled_files:
+                        self.store(file)
             del self.connections[socketfd]
             return prefix_local
         else:
@@ -130,6 +162,7 @@ class Connections:
         for l in self.errlog:
             print('{} {}'.format(TAG, l))
         print('{} END of the log in [{}]'.format(TAG, reason))
+        self.wait_storage()
 
         if previous_mp_mode:
             set_multiprocessing_mode()
@@ -185,8 +218,8 @@ def kill_mtserver(serial = None):
     for pid in pids:
         run_adb_cmd('shell kill {}'.format(pid), serial=serial)
 
-def run_mtserver(package_name, output_folder, serial=None):
-    connections = Connections(package_name, serial, output_folder)
+def run_mtserver(package_name, output_folder, serial=None, compress=None):
+    connections = Connections(package_name, serial, output_folder, compress)
 
     kill_mtserver(serial)
     try:
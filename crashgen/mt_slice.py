@@ -0,0 +1,213 @@
+'''
+Time-window slices of MiniTrace data_N.bin
+
+slice_trace() cuts the records between two idle / ping anchors out of a
+trace into a standalone prefix:
+
+    header          the original one, stamped with the time of the first anchor
+    context         enter / unroll records rebuilding the shadow stack of
+                    every thread at the first anchor
+    window          the raw records from the anchor at or before from_ms up
+                    to the first anchor after to_ms, both included
+    info_*.log      copies of the original ones
+
+so mt_stack.ShadowStack replaying the slice ends up with the same stacks as
+when replaying the whole trace. Anchors come from the offset index of
+mt_index, and stacks at idle / ping anchors from the sidecar data_N.stk,
+which one ShadowStack pass builds like the index. Once both exist, a slice
+reads only its window.
+
+    python consumer.py slice mt_output/mt_1234_ --to-ms 1600000030000
+'''
+import os
+import struct
+import shutil
+import numpy as np
+
+from consumer import (
+    HEADER_SIZE,
+    parse_header,
+    parse_methodinfo,
+    kMiniTraceMethodEnter,
+    kMiniTraceUnroll,
+)
+from mt_index import load_index, ANCHOR_IDLE, ANCHOR_PING
+from mt_stack import ShadowStack, UNROLL, skippable_ptrs, MISMATCH_RESYNC
+from mt_storage import open_trace, trace_size, ordered_traces
+
+STACK_INDEX_VERSION = 1
+
+# default window before to_ms
+DEFAULT_WINDOW_MS = 30000
+
+# idle / ping records are u2 tid, u8 timestamp
+TIMED_RECORD_SIZE = 10
+
+COPY_SIZE = 1 << 22
+
+_method = struct.Struct('<HI')
+_timestamp = struct.Struct('<Q')
+
+def stack_fname_of(data_fname):
+    # data_0.bin -> data_0.stk
+    return os.path.splitext(data_fname)[0] + '.stk'
+
+def timed_anchors(index):
+    # Positions of idle / ping anchors of index, in the trace order
+    return np.sort(np.concatenate([index.anchors(ANCHOR_IDLE), index.anchors(ANCHOR_PING)]))
+
+def build_stack_index(data_fname, skippable=(), stk_fname=None):
+    '''
+    Shadow stack of every thread at each idle / ping record of data_fname,
+    in the order of timed_anchors() of its index
+    '''
+    from mt_blocks import parse_data_batched
+    if stk_fname is None:
+        stk_fname = stack_fname_of(data_fname)
+
+    mstack = ShadowStack(skippable, MISMATCH_RESYNC)
+    anchor_indptr = [0]
+    tids = []
+    frame_indptr = [0]
+    frames = []
+    def snapshot(timestamp):
+        for tid, stack in mstack.stacks.items():
+            if stack:
+                tids.append(tid)
+                frames.extend(stack)
+                frame_indptr.append(len(frames))
+        anchor_indptr.append(len(tids))
+    parse_data_batched(data_fname, mstack.batch, {7: snapshot, 8: snapshot}, verbose=False)
+
+    with open(stk_fname, 'wb') as f:
+        np.savez_compressed(f,
+            version=np.array([STACK_INDEX_VERSION], dtype=np.int64),
+            data_size=np.array([trace_size(data_fname)], dtype=np.int64),
+            anchor_indptr=np.array(anchor_indptr, dtype=np.int64),
+            tids=np.array(tids, dtype=np.uint32),
+            frame_indptr=np.array(frame_indptr, dtype=np.int64),
+            frames=np.array(frames, dtype=np.int64))
+    return stk_fname
+
+class StackIndex:
+    def __init__(self, stk_fname):
+        with open(stk_fname, 'rb') as f:
+            npz = np.load(f)
+            assert int(npz['version'][0]) == STACK_INDEX_VERSION, stk_fname
+            self.data_size = int(npz['data_size'][0])
+            self.anchor_indptr = npz['anchor_indptr']
+            self.tids = npz['tids']
+            self.frame_indptr = npz['frame_indptr']
+            self.frames = npz['frames']
+
+    def __len__(self):
+        return len(self.anchor_indptr) - 1
+
+    def stacks(self, k):
+        # tid -> list of ptr (UNROLL included) from the bottom, at the k-th timed anchor
+        lo, hi = self.anchor_indptr[k], self.anchor_indptr[k+1]
+        return {tid: self.frames[self.frame_indptr[row]:self.frame_indptr[row+1]].tolist()
+            for row, tid in zip(range(lo, hi), self.tids[lo:hi].tolist())}
+
+def load_stack_index(data_fname, skippable=(), rebuild=True):
+    # Load data_N.stk, (re)building it when missing or made for another file
+    stk_fname = stack_fname_of(data_fname)
+    if os.path.isfile(stk_fname):
+        stack_index = StackIndex(stk_fname)
+        if stack_index.data_size == trace_size(data_fname):
+            return stack_index
+    if not rebuild:
+        return None
+    build_stack_index(data_fname, skippable, stk_fname)
+    return StackIndex(stk_fname)
+
+def trace_at(prefix, timestamp):
+    # data_N.bin of prefix being written at timestamp: the last one started before it
+    chosen = None
+    for data_fname in ordered_traces(prefix):
+        with open_trace(data_fname) as f:
+            _, _, started = parse_header(f.read(HEADER_SIZE))
+        if chosen is None or started <= timestamp:
+            chosen = data_fname
+    return chosen
+
+def context_records(stacks):
+    # Records which rebuild stacks on an empty ShadowStack
+    out = bytearray()
+    for tid in sorted(stacks):
+        stack = stacks[tid]
+        for i, ptr in enumerate(stack):
+            if ptr == UNROLL:
+                # unrolling the frame below keeps it, with UNROLL on top
+                below = stack[i-1] if i > 0 and stack[i-1] != UNROLL else 0
+                out += _method.pack(tid, below | kMiniTraceUnroll)
+            else:
+                out += _method.pack(tid, ptr | kMiniTraceMethodEnter)
+    return bytes(out)
+
+def find_window(index, from_ms, to_ms):
+    '''
+    (k, start, stop) of the window: k-th timed anchor at or before from_ms
+    (-1 if none, the window then starts after the header), start and stop
+    offsets, stop being None at the end of the trace
+    '''
+    timed = timed_anchors(index)
+    values = index.values[timed]
+    before = np.flatnonzero(values <= from_ms)
+    if len(before):
+        k = int(before[-1])
+        start = int(index.offsets[timed[k]])
+    else:
+        k = -1
+        start = HEADER_SIZE
+    after = np.flatnonzero(values[k+1:] > to_ms)
+    if len(after):
+        stop = int(index.offsets[timed[k + 1 + after[0]]]) + TIMED_RECORD_SIZE
+    else:
+        stop = None
+    return k, start, stop
+
+def slice_trace(prefix, from_ms, to_ms, out_prefix, idx=None):
+    '''
+    Write the window [from_ms, to_ms] of data_<idx>.bin of prefix as
+    out_prefix + data_0.bin, with info_*.log. idx None takes the data file
+    being written at from_ms. Returns (data_fname, start, stop) of the window.
+    '''
+    if idx is None:
+        data_fname = trace_at(prefix, from_ms)
+        if data_fname is None:
+            raise FileNotFoundError(prefix + "data_0.bin")
+    else:
+        data_fname = prefix + "data_{}.bin".format(idx)
+
+    index = load_index(data_fname)
+    k, start, stop = find_window(index, from_ms, to_ms)
+    stacks = dict()
+    if k >= 0:
+        skippable = ()
+        if os.path.isfile(prefix + "info_m.log"):
+            skippable = skippable_ptrs(parse_methodinfo(prefix + "info_m.log"))
+        stacks = load_stack_index(data_fname, skippable).stacks(k)
+
+    out_fname = out_prefix + "data_0.bin"
+    with open_trace(data_fname) as src, open(out_fname, 'wb') as dst:
+        header = src.read(HEADER_SIZE)
+        if k >= 0:
+            # timestamp of the header is the time of the first record
+            header = header[:12] + _timestamp.pack(int(index.values[timed_anchors(index)[k]]))
+        dst.write(header)
+        dst.write(context_records(stacks))
+        src.seek(start)
+        remaining = None if stop is None else stop - start
+        while remaining is None or remaining > 0:
+            chunk = src.read(COPY_SIZE if remaining is None else min(COPY_SIZE, remaining))
+            if not chunk:
+                break
+            dst.write(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    for name in ['info_m.log', 'info_t.log', 'info_f.log']:
+        if os.path.isfile(prefix + name):
+            shutil.copyfile(prefix + name, out_prefix + name)
+    return data_fname, start, stop
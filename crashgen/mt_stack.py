@@ -0,0 +1,155 @@
+'''
+Shadow method stacks of MiniTrace threads
+
+ShadowStack replays enter / exit / unroll records into one array('q') of
+method pointers per thread, with UNROLL marking the frame being unrolled,
+the same model as inspect_stack() always had:
+
+    unroll(ptr)  pops until ptr is on the top, and pushes UNROLL
+    enter(ptr)   after [ptr, UNROLL], re-enters ptr in place of both
+    exit(ptr)    pops UNROLL and up to two frames looking for ptr, then the
+                 skippable frames (ThreadLocal$Values, whose exits MiniTrace
+                 misses) before ptr
+
+Every frame is pushed once and popped once, so the work is amortised O(1)
+per record. When exit(ptr) does not find ptr, the policy decides:
+
+    MISMATCH_RAISE   raise StackMismatch, a RuntimeError
+    MISMATCH_RESYNC  pop down to the innermost ptr, or clear the stack
+    MISMATCH_IGNORE  keep the stack as it was
+
+Observers are called with (action, tid, ptr, old_depth, stack) after each
+update, action being kMiniTraceMethodEnter / Exit / Unroll.
+'''
+from array import array
+
+from consumer import kMiniTraceMethodEnter, kMiniTraceMethodExit, kMiniTraceUnroll
+
+UNROLL = -1
+
+MISMATCH_RAISE = 'raise'
+MISMATCH_RESYNC = 'resync'
+MISMATCH_IGNORE = 'ignore'
+
+THREADLOCAL_VALUES = 'Ljava/lang/ThreadLocal$Values;'
+
+class StackMismatch(RuntimeError):
+    def __init__(self, tid, ptr, stack):
+        RuntimeError.__init__(self, 'exit of method 0x%08X on thread %d does not match the stack %s' % (
+            ptr, tid, ' '.join('u' if p == UNROLL else '%08X' % p for p in stack[-4:])))
+        self.tid = tid
+        self.ptr = ptr
+
+def skippable_ptrs(methods, classnames=(THREADLOCAL_VALUES, )):
+    # Pointers of methods whose frames may be left without their exit
+    return set(ptr for ptr, finfos in methods.items() if finfos[0] in classnames)
+
+class ShadowStack:
+    def __init__(self, skippable=(), policy=MISMATCH_RAISE, observers=()):
+        assert policy in (MISMATCH_RAISE, MISMATCH_RESYNC, MISMATCH_IGNORE), policy
+        self.stacks = dict() # tid -> array of ptr
+        self.skippable = frozenset(skippable)
+        self.policy = policy
+        self.observers = list(observers)
+        self.mismatches = 0
+
+    def get_stack(self, tid):
+        try:
+            return self.stacks[tid]
+        except KeyError:
+            stack = self.stacks[tid] = array('q')
+            return stack
+
+    def frames(self, tid):
+        # Pointers of the stack of tid from the bottom, without UNROLL
+        return tuple(ptr for ptr in self.get_stack(tid) if ptr != UNROLL)
+
+    def depth(self, tid):
+        return len(self.get_stack(tid))
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def enter(self, tid, ptr):
+        stack = self.get_stack(tid)
+        old_depth = len(stack)
+        if old_depth > 1 and stack[-1] == UNROLL and stack[-2] == ptr:
+            del stack[-2:]
+        stack.append(ptr)
+        for observer in self.observers:
+            observer(kMiniTraceMethodEnter, tid, ptr, old_depth, stack)
+
+    def exit(self, tid, ptr):
+        stack = self.get_stack(tid)
+        old_depth = len(stack)
+        if old_depth > 0:
+            i = self._find_exit(stack, ptr)
+            if i is None:
+                self._mismatch(tid, ptr, stack)
+            else:
+                del stack[i:]
+        for observer in self.observers:
+            observer(kMiniTraceMethodExit, tid, ptr, old_depth, stack)
+
+    def _find_exit(self, stack, ptr):
+        # Index of the frame exited by ptr, None on mismatch
+        i = len(stack) - 1
+        compares = 1
+        if stack[i] == UNROLL:
+            i -= 1
+            compares = 2
+        for _ in range(compares):
+            if i < 0:
+                return None
+            if stack[i] == ptr:
+                return i
+            i -= 1
+        skippable = self.skippable
+        while i >= 0 and stack[i] != ptr and stack[i] != UNROLL and stack[i] in skippable:
+            i -= 1
+        if i >= 0 and stack[i] == ptr:
+            return i
+        return None
+
+    def _mismatch(self, tid, ptr, stack):
+        self.mismatches += 1
+        if self.policy == MISMATCH_RAISE:
+            raise StackMismatch(tid, ptr, stack)
+        elif self.policy == MISMATCH_RESYNC:
+            # frames above the innermost ptr lost their exits, and without
+            # ptr the whole stack was entered before the trace started
+            i = len(stack) - 1
+            while i >= 0 and stack[i] != ptr:
+                i -= 1
+            del stack[max(i, 0):]
+
+    def unroll(self, tid, ptr):
+        stack = self.get_stack(tid)
+        old_depth = len(stack)
+        i = len(stack) - 1
+        while i >= 0 and stack[i] != ptr:
+            i -= 1
+        del stack[i + 1:]
+        stack.append(UNROLL)
+        for observer in self.observers:
+            observer(kMiniTraceUnroll, tid, ptr, old_depth, stack)
+
+    def callbacks(self):
+        # parse_data() callbacks
+        return {
+            kMiniTraceMethodEnter: self.enter,
+            kMiniTraceMethodExit: self.exit,
+            kMiniTraceUnroll: self.unroll,
+        }
+
+    def batch(self, records):
+        # Batch callback of mt_blocks.parse_data_batched()
+        enter, exit, unroll = self.enter, self.exit, self.unroll
+        for tid, action, ptr in zip(records['tid'].tolist(), records['action'].tolist(),
+                records['ptr'].tolist()):
+            if action == kMiniTraceMethodEnter:
+                enter(tid, ptr)
+            elif action == kMiniTraceMethodExit:
+                exit(tid, ptr)
+            elif action == kMiniTraceUnroll:
+                unroll(tid, ptr)
@@ -0,0 +1,230 @@
+'''
+Compressed storage of MiniTrace data_N.bin
+
+A trace may be kept as data_N.bin, or compressed as data_N.bin.gz / .xz /
+.zst (zstd with the zstandard package). Readers keep using the data_N.bin
+name: open_trace() opens whichever file exists, with large buffered reads
+over the decompressor, and glob_traces() / trace_exists() see compressed
+traces as well. Compressed streams are sequential, so seeking forward
+decompresses up to the offset, and mt_parallel decodes them serially.
+
+    python mt_storage.py compress mt_output/mt_1234_ --codec gz
+    python mt_storage.py report mt_output/mt_1234_data_0.bin
+'''
+import os, sys
+import io
+import re
+import glob
+import time
+import shutil
+import argparse
+
+CODECS = ['gz', 'xz', 'zst']
+
+# default levels, fast enough to keep up with pulled traces
+LEVELS = {'gz': 6, 'xz': 1, 'zst': 3}
+
+READ_BUFFER = 1 << 22
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+def available_codecs():
+    return [codec for codec in CODECS if codec != 'zst' or _zstandard() is not None]
+
+def codec_of(fname):
+    # Codec of a compressed file name, None for a raw trace
+    for codec in CODECS:
+        if fname.endswith('.' + codec):
+            return codec
+    return None
+
+def open_codec(fname, codec, mode='rb', level=None):
+    if level is None:
+        level = LEVELS[codec]
+    if codec == 'gz':
+        import gzip
+        if 'w' in mode:
+            return gzip.open(fname, mode, compresslevel=level)
+        return gzip.open(fname, mode)
+    elif codec == 'xz':
+        import lzma
+        if 'w' in mode:
+            return lzma.open(fname, mode, preset=level)
+        return lzma.open(fname, mode)
+    elif codec == 'zst':
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise RuntimeError('zstandard is required for {}'.format(fname))
+        if 'w' in mode:
+            return zstandard.open(fname, mode, cctx=zstandard.ZstdCompressor(level=level))
+        return zstandard.open(fname, mode)
+    raise ValueError(codec)
+
+def trace_fname(data_fname):
+    # The stored file of data_fname, raw or compressed, None if there is none
+    if os.path.isfile(data_fname):
+        return data_fname
+    for codec in CODECS:
+        if os.path.isfile(data_fname + '.' + codec):
+            return data_fname + '.' + codec
+    return None
+
+def trace_exists(data_fname):
+    return trace_fname(data_fname) is not None
+
+def is_compressed(data_fname):
+    fname = trace_fname(data_fname)
+    return fname is not None and codec_of(fname) is not None
+
+def trace_size(data_fname):
+    # Size of the stored file, which is the compressed size for compressed traces
+    fname = trace_fname(data_fname)
+    if fname is None:
+        raise FileNotFoundError(data_fname)
+    return os.path.getsize(fname)
+
+def open_trace(data_fname, buffer_size=READ_BUFFER):
+    '''
+    Binary file object of data_fname, or of data_fname.gz / .xz / .zst.
+    data_fname may also name a compressed file itself.
+    '''
+    codec = codec_of(data_fname)
+    if codec is not None:
+        return io.BufferedReader(open_codec(data_fname, codec), buffer_size)
+    try:
+        return open(data_fname, 'rb')
+    except FileNotFoundError:
+        # compressed meanwhile by the storage worker
+        pass
+    for codec in CODECS:
+        try:
+            return io.BufferedReader(open_codec(data_fname + '.' + codec, codec), buffer_size)
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(data_fname)
+
+def glob_traces(prefix):
+    # data_N.bin names of prefix, whether they are stored raw or compressed
+    names = set()
+    for fname in glob.glob(prefix + 'data_*.bin*'):
+        match = re.match(r'(data_.*\.bin)(\.({}))?$'.format('|'.join(CODECS)), fname[len(prefix):])
+        if match is not None:
+            names.add(prefix + match.group(1))
+    return sorted(names)
+
+def trace_number(prefix, data_fname):
+    # N of prefix + data_N.bin, -1 for other names
+    match = re.match(r'data_([0-9]+)\.bin$', data_fname[len(prefix):])
+    return int(match.group(1)) if match is not None else -1
+
+def ordered_traces(prefix):
+    # glob_traces() in the order of writing, data_10.bin after data_9.bin
+    return sorted(glob_traces(prefix), key=lambda fname:(trace_number(prefix, fname), fname))
+
+def discard_trace(data_fname):
+    # Remove raw data_fname once collapsed, compressed copies are kept for later analysis
+    try:
+        os.remove(data_fname)
+    except FileNotFoundError:
+        pass
+
+def compress_trace(data_fname, codec='gz', level=None, remove=True):
+    '''
+    Write data_fname.<codec>, then remove data_fname if remove.
+    The compressed file appears atomically, so readers always find one of both.
+    '''
+    out_fname = data_fname + '.' + codec
+    tmp_fname = out_fname + '.tmp'
+    with open(data_fname, 'rb') as src, open_codec(tmp_fname, codec, 'wb', level) as dst:
+        shutil.copyfileobj(src, dst, READ_BUFFER)
+    os.replace(tmp_fname, out_fname)
+    if remove:
+        try:
+            os.remove(data_fname)
+        except FileNotFoundError:
+            pass
+    return out_fname
+
+def compress_prefix(prefix, codec='gz', level=None):
+    # Compress every raw data_N.bin of prefix, returns compressed file names
+    return [compress_trace(data_fname, codec, level)
+        for data_fname in sorted(glob.glob(prefix + 'data_*.bin'))]
+
+def _decode_seconds(data_fname):
+    # Seconds to decode every record of data_fname with mt_blocks, and record count
+    from mt_blocks import BlockDecoder
+    start = time.perf_counter()
+    num_records = sum(len(block) for block in BlockDecoder(data_fname))
+    return time.perf_counter() - start, num_records
+
+def codec_report(data_fname, codecs=None, level=None, workdir=None):
+    '''
+    Compress a raw trace with every codec into workdir, and compare the size
+    and decoding throughput with the raw trace.
+    Returns list of (codec, size, compress seconds, decode seconds), 'raw' first
+    '''
+    import tempfile
+    if codecs is None:
+        codecs = available_codecs()
+    seconds, num_records = _decode_seconds(data_fname)
+    rows = [('raw', os.path.getsize(data_fname), 0.0, seconds)]
+    tmpdir = tempfile.mkdtemp(prefix='mt_storage_', dir=workdir)
+    try:
+        raw_fname = os.path.join(tmpdir, os.path.basename(data_fname))
+        for codec in codecs:
+            start = time.perf_counter()
+            with open(data_fname, 'rb') as src, open_codec(raw_fname + '.' + codec, codec, 'wb', level) as dst:
+                shutil.copyfileobj(src, dst, READ_BUFFER)
+            compress_seconds = time.perf_counter() - start
+            seconds, _ = _decode_seconds(raw_fname + '.' + codec)
+            rows.append((codec, os.path.getsize(raw_fname + '.' + codec), compress_seconds, seconds))
+            os.remove(raw_fname + '.' + codec)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    raw_size = rows[0][1]
+    print('{} records, {} bytes'.format(num_records, raw_size))
+    print('%-6s %12s %7s %12s %12s %12s %9s' % ('codec', 'bytes', 'ratio', 'compress s',
+        'decode s', 'raw MB/s', 'vs raw'))
+    for codec, size, compress_seconds, seconds in rows:
+        print('%-6s %12d %7.2f %12.3f %12.3f %12.2f %9.2f' % (codec, size, raw_size / size,
+            compress_seconds, seconds, raw_size / seconds / 1e6 if seconds else 0,
+            rows[0][3] / seconds if seconds else 0))
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compressed storage of MiniTrace traces')
+    subparsers = parser.add_subparsers(dest='func')
+
+    compress_parser = subparsers.add_parser('compress',
+        help='Compress raw data_N.bin of prefixes')
+    compress_parser.add_argument('prefixes', nargs='+')
+    compress_parser.add_argument('--codec', default='gz', choices=CODECS)
+    compress_parser.add_argument('--level', default=None)
+
+    report_parser = subparsers.add_parser('report',
+        help='Size and decoding throughput of each codec versus the raw trace')
+    report_parser.add_argument('data_fname')
+    report_parser.add_argument('--codecs', default=None,
+        help='Comma separated codecs, every available one by default')
+    report_parser.add_argument('--level', default=None)
+    report_parser.add_argument('--workdir', default=None,
+        help='Directory of the compressed copies, temporary directory by default')
+
+    args = parser.parse_args()
+    level = None if args.level is None else int(args.level)
+    if args.func == 'compress':
+        for prefix in args.prefixes:
+            for fname in compress_prefix(prefix, args.codec, level):
+                print(fname)
+    elif args.func == 'report':
+        codec_report(args.data_fname, None if args.codecs is None else args.codecs.split(','),
+            level, args.workdir)
+    else:
+        parser.print_help()
+        sys.exit(1)
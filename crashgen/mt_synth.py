@@ -0,0 +1,275 @@
+'''
+Synthetic MiniTrace outputs, for benchmarks and regression checks of
+consumer.py without a device running the patched libart.so
+
+write_trace() makes prefix + data_N.bin (version 3 or 4) with info_m.log,
+info_t.log and info_f.log. Every thread keeps a consistent method stack:
+exits match the innermost frame, exceptions unroll frames from the top, and
+the main thread dispatches messages between idle events like a Looper,
+
+    enter dispatchMessage, message "[id N] ...", ..., exit dispatchMessage
+
+Some frames of ThreadLocal$Values are left without their exit, as MiniTrace
+does, and the tail of the file can be truncated in the middle of a record.
+Threads missing from info_t.log, which lived between two of its dumps, can
+enter and exit one method each.
+
+    python mt_synth.py mt_output/synth_ --records 1000000 --version 4
+'''
+import os
+import random
+import struct
+import argparse
+
+from consumer import HEADER_SIZE
+
+MAGIC = b'MiTr'
+LOG_FLAG = 0x20010107
+START_TIMESTAMP = 1600000000000
+
+_method = struct.Struct('<HI')
+_field = struct.Struct('<HIIIH')
+_timed = struct.Struct('<HQ')
+_u2u4 = struct.Struct('<HI')
+_u2u4u4 = struct.Struct('<HII')
+
+DISPATCH_MESSAGE = ('Landroid/os/Handler;', 'dispatchMessage', '(Landroid/os/Message;)V', 'Handler.java')
+THREADLOCAL_PUT = ('Ljava/lang/ThreadLocal$Values;', 'put', '(Ljava/lang/ThreadLocal;Ljava/lang/Object;)V', 'ThreadLocal.java')
+
+FLUSH_SIZE = 1 << 20
+
+class TraceStats:
+    def __init__(self):
+        self.num_records = 0
+        self.counts = dict() # callback index of parse_data() -> number of records
+        self.size = 0
+
+    def add(self, code):
+        self.num_records += 1
+        self.counts[code] = self.counts.get(code, 0) + 1
+
+def method_table(num_methods, rnd):
+    '''
+    List of (ptr, classname, methodname, signature, sourcefile).
+    Pointers are 8-byte aligned and spread over the boot image range,
+    the first one is Handler.dispatchMessage and the second one is
+    ThreadLocal$Values.put.
+    '''
+    ptrs = rnd.sample(range(0x70000000 >> 3, 0x74000000 >> 3), num_methods)
+    table = [(ptrs[0] << 3, ) + DISPATCH_MESSAGE, (ptrs[1] << 3, ) + THREADLOCAL_PUT]
+    for i, ptr in enumerate(ptrs[2:]):
+        cls = 'Lcom/example/synth/C{};'.format(i % 97)
+        table.append((ptr << 3, cls, 'm{}'.format(i), '()V', 'C{}.java'.format(i % 97)))
+    return table
+
+def write_info(prefix, methods, tids, num_fields):
+    with open(prefix + 'info_m.log', 'wt') as f:
+        for row in methods:
+            f.write('%08x\t%s\t%s\t%s\t%s\n' % row)
+    with open(prefix + 'info_t.log', 'wt') as f:
+        f.write('%d\tmain\n' % tids[0])
+        for tid in tids[1:]:
+            f.write('%d\tThread-%d\n' % (tid, tid))
+    with open(prefix + 'info_f.log', 'wt') as f:
+        for i in range(num_fields):
+            f.write('%08x\t%d\tLcom/example/synth/F%d;\tf%d\tI\n' % (0x71000000 + 8 * i, i, i % 7, i))
+
+def write_trace(prefix, idx=0, num_records=1000000, version=4, num_threads=4, num_methods=1000,
+        num_fields=50, message_rate=0.002, message_length=400, idle_rate=0.1, ping_rate=0.0005,
+        field_rate=0.1, exception_rate=0.001, target_rate=0.01, threadlocal_rate=0.01,
+        short_lived_rate=0.0, truncate=0, seed=0):
+    '''
+    Write about num_records records, returns TraceStats
+        message_rate: chance to dispatch a message at each main thread record out of messages
+        message_length: mean number of records during a message
+        idle_rate: chance of an idle event when the main thread waits for a message
+        short_lived_rate: chance at each step of a thread missing from info_t.log,
+            entering and exiting one method
+        others: chance of each kind of record at each step
+        truncate: bytes cut from the end of data_N.bin
+    '''
+    assert version in (3, 4), version
+    rnd = random.Random(seed)
+    tids = [1000 + i * 7 for i in range(num_threads)]
+    main_tid = tids[0]
+    short_lived_tid = 30000
+    methods = method_table(num_methods, rnd)
+    write_info(prefix, methods, tids, num_fields)
+
+    dispatch_ptr = methods[0][0]
+    threadlocal_ptr = methods[1][0]
+    body_ptrs = [row[0] for row in methods[2:]]
+    # zipf-like popularity of methods
+    cum_weights = []
+    total = 0.0
+    for i in range(len(body_ptrs)):
+        total += 1.0 / (i + 1)
+        cum_weights.append(total)
+    num_targets = 8
+
+    stats = TraceStats()
+    stacks = {tid: [] for tid in tids}
+    timestamp = START_TIMESTAMP
+    msgid = 0
+    msg_left = 0        # records left in the current message, 0 if the main thread waits
+    msg_base = 0        # depth of the main thread stack below dispatchMessage
+    unrolled = dict()   # tid -> depth of the catching frame, while it is on the stack
+
+    data_fname = '{}data_{}.bin'.format(prefix, idx)
+    with open(data_fname, 'wb') as f:
+        out = bytearray()
+        out += MAGIC + struct.pack('<HHIQ', version, HEADER_SIZE, LOG_FLAG, START_TIMESTAMP)
+
+        def enter(tid, ptr):
+            stacks[tid].append(ptr)
+            out.extend(_method.pack(tid, ptr | 0))
+            stats.add(0)
+
+        def exit(tid):
+            ptr = stacks[tid].pop()
+            out.extend(_method.pack(tid, ptr | 1))
+            stats.add(1)
+
+        def message(tid, action, content):
+            content = content.encode() + b'\0'
+            out.extend(_u2u4.pack(tid, ((len(content) + 6) << 3) | action))
+            out.extend(content)
+            stats.add(action)
+
+        while stats.num_records < num_records:
+            if len(out) >= FLUSH_SIZE:
+                f.write(out)
+                out.clear()
+            timestamp += rnd.randrange(0, 3)
+
+            if short_lived_rate and rnd.random() < short_lived_rate:
+                out.extend(_method.pack(short_lived_tid, body_ptrs[0]))
+                out.extend(_method.pack(short_lived_tid, body_ptrs[0] | 1))
+                stats.add(0)
+                stats.add(1)
+                short_lived_tid += 1
+                continue
+
+            # main thread waits for the next message
+            if msg_left == 0:
+                if rnd.random() < message_rate:
+                    msg_base = len(stacks[main_tid])
+                    enter(main_tid, dispatch_ptr)
+                    message(main_tid, 6, '[id {}] {{ when=-1ms what={} target=com.example.Synth }}'.format(
+                        msgid, rnd.randrange(10)))
+                    msgid += 1
+                    msg_left = max(1, int(rnd.expovariate(1.0 / message_length)))
+                    continue
+                if rnd.random() < idle_rate:
+                    out.extend(_timed.pack(0, timestamp))
+                    stats.add(7)
+                    continue
+
+            r = rnd.random()
+            if r < ping_rate:
+                out.extend(_timed.pack(1, timestamp))
+                stats.add(8)
+                continue
+            r -= ping_rate
+            if r < target_rate:
+                tid = rnd.choice(tids)
+                kind = rnd.randrange(3) # target enter / exit / unroll
+                if version >= 4:
+                    out.extend(_u2u4u4.pack(3 + kind, tid, rnd.randrange(num_targets)))
+                    stats.add(13 + kind)
+                else:
+                    out.extend(_u2u4.pack(3 + kind, rnd.randrange(num_targets)))
+                    stats.add(10 + kind)
+                continue
+            r -= target_rate
+
+            if msg_left > 0 and rnd.random() < 0.5:
+                tid = main_tid
+                msg_left -= 1
+                if msg_left == 0:
+                    # finish the message
+                    while len(stacks[main_tid]) > msg_base + 1:
+                        exit(main_tid)
+                    exit(main_tid)
+                    continue
+            else:
+                tid = rnd.choice(tids[1:]) if len(tids) > 1 else main_tid
+            stack = stacks[tid]
+            # frames of the thread which may be exited
+            base = msg_base + 1 if tid == main_tid else 0
+
+            if r < field_rate:
+                fidx = rnd.randrange(num_fields)
+                action = rnd.choice((3, 4))
+                out.extend(_field.pack(tid, (0x71000000 + 8 * fidx) | action,
+                    rnd.randrange(1, 1 << 20) << 4, 0x1000 + fidx, fidx))
+                stats.add(action)
+                continue
+            r -= field_rate
+            # After unrolling, the catching frame exits before anything else unusual
+            # happens on the thread, like inspect_stack() expects
+            if len(stack) < unrolled.get(tid, 0):
+                del unrolled[tid]
+            if r < exception_rate and len(stack) > base + 1 and tid not in unrolled:
+                message(tid, 5, 'java.lang.IllegalStateException: synthetic {}\n\tat com.example.synth.C0.m0(C0.java)'.format(
+                    stats.num_records))
+                # unroll some frames, the catching frame stays
+                for _ in range(rnd.randrange(1, len(stack) - base)):
+                    ptr = stack.pop()
+                    out.extend(_method.pack(tid, ptr | 2))
+                    stats.add(2)
+                unrolled[tid] = len(stack)
+                continue
+
+            if len(stack) > base and (len(stack) > base + 40 or rnd.random() < 0.49):
+                exit(tid)
+            elif rnd.random() < threadlocal_rate and tid not in unrolled:
+                # ThreadLocal$Values without the exit
+                out.extend(_method.pack(tid, threadlocal_ptr))
+                stats.add(0)
+            else:
+                # no direct recursion, unroll() of consumer.py could not tell the frames apart
+                ptr = rnd.choices(body_ptrs, cum_weights=cum_weights)[0]
+                while stack and stack[-1] == ptr:
+                    ptr = rnd.choice(body_ptrs)
+                enter(tid, ptr)
+
+        f.write(out)
+        size = f.tell()
+        if truncate:
+            f.truncate(max(HEADER_SIZE, size - truncate))
+    stats.size = os.path.getsize(data_fname)
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic MiniTrace outputs')
+    parser.add_argument('prefix')
+    parser.add_argument('--idx', default='0')
+    parser.add_argument('--records', default='1000000')
+    parser.add_argument('--version', default='4')
+    parser.add_argument('--threads', default='4')
+    parser.add_argument('--methods', default='1000')
+    parser.add_argument('--message_rate', default='0.002')
+    parser.add_argument('--idle_rate', default='0.1')
+    parser.add_argument('--exception_rate', default='0.001')
+    parser.add_argument('--short_lived_rate', default='0',
+        help='Chance of a thread missing from info_t.log at each step')
+    parser.add_argument('--truncate', default='0',
+        help='Bytes cut from the end of the data file')
+    parser.add_argument('--seed', default='0')
+
+    args = parser.parse_args()
+    stats = write_trace(args.prefix, int(args.idx),
+        num_records = int(args.records),
+        version = int(args.version),
+        num_threads = int(args.threads),
+        num_methods = int(args.methods),
+        message_rate = float(args.message_rate),
+        idle_rate = float(args.idle_rate),
+        exception_rate = float(args.exception_rate),
+        short_lived_rate = float(args.short_lived_rate),
+        truncate = int(args.truncate),
+        seed = int(args.seed))
+    print('{}data_{}.bin: {} records, {} bytes'.format(args.prefix, args.idx, stats.num_records, stats.size))
+    for code in sorted(stats.counts):
+        print('  event {}: {}'.format(code, stats.counts[code]))
@@ -0,0 +1,208 @@
+'''
+Bounded-memory top-K counting of method entries, with Space-Saving
+
+SpaceSaving keeps at most k (key, count, error) counters, whatever the
+number of distinct keys. Counts are over-estimates of the true counts:
+
+    count - error <= true count <= count
+    true count of an unmonitored key <= floor() <= total / k
+
+so every key entered more than total / k times is monitored, and a key is
+surely in the top K when count - error is at least the K+1-th count.
+
+Keys are added in batches (np.unique of a block of records): monitored keys
+take their batch counts, new keys start at the current floor(), and only the
+k largest counters are kept. This gives the same bounds as adding the keys
+one by one, with O(k + batch) numpy work per batch.
+
+    python consumer.py collapse_binary mt_output/mt_*_ --topk 100
+'''
+import sys
+import numpy as np
+
+from consumer import MessageCollapser, kMiniTraceMethodEnter, kMiniTraceMethodExit, kMiniTraceUnroll
+from mt_blocks import BlockDecoder, DEFAULT_BLOCK_SIZE
+
+# single increments are buffered up to this many keys
+PENDING_SIZE = 4096
+
+class SpaceSaving:
+    def __init__(self, k):
+        assert k > 0, k
+        self.k = k
+        # monitored keys sorted, with their counts and errors
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.errors = np.zeros(0, dtype=np.int64)
+        self.total = 0
+        self.pending = []
+
+    def __len__(self):
+        self.flush()
+        return len(self.keys)
+
+    def floor(self):
+        # Upper bound of the true count of every unmonitored key
+        self.flush()
+        if len(self.keys) < self.k:
+            return 0
+        return int(self.counts.min())
+
+    def increment(self, key):
+        self.total += 1
+        self.pending.append(key)
+        if len(self.pending) >= PENDING_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+            self._add(*np.unique(np.array(pending, dtype=np.uint64), return_counts=True))
+
+    def add(self, keys, counts=None):
+        # keys: every occurrence, or distinct keys with their counts
+        if len(keys) == 0:
+            return
+        if counts is None:
+            keys, counts = np.unique(np.asarray(keys, dtype=np.uint64), return_counts=True)
+        else:
+            keys = np.asarray(keys, dtype=np.uint64)
+            order = np.argsort(keys, kind='stable')
+            keys, counts = keys[order], np.asarray(counts, dtype=np.int64)[order]
+        self.total += int(counts.sum())
+        self.flush()
+        self._add(keys, counts)
+
+    def _add(self, keys, counts):
+        # keys sorted and distinct
+        floor = self.floor()
+
+        pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        if len(self.keys):
+            monitored = self.keys[pos] == keys
+        else:
+            monitored = np.zeros(len(keys), dtype=bool)
+        np.add.at(self.counts, pos[monitored], counts[monitored])
+
+        new = ~monitored
+        if not new.any():
+            return
+        keys = np.concatenate([self.keys, keys[new]])
+        counts_ = np.concatenate([self.counts, counts[new] + floor])
+        errors = np.concatenate([self.errors, np.full(int(new.sum()), floor, dtype=np.int64)])
+        if len(keys) > self.k:
+            kept = np.argpartition(-counts_, self.k - 1)[:self.k]
+            keys, counts_, errors = keys[kept], counts_[kept], errors[kept]
+        order = np.argsort(keys)
+        self.keys, self.counts, self.errors = keys[order], counts_[order], errors[order]
+
+    def top(self, n=None):
+        # [(key, count, error)] by descending count
+        self.flush()
+        order = np.argsort(-self.counts, kind='stable')[:n]
+        return list(zip(self.keys[order].tolist(), self.counts[order].tolist(), self.errors[order].tolist()))
+
+    def as_dict(self):
+        # key -> estimated count, by descending count
+        return {key:count for key, count, _ in self.top()}
+
+def count_method_entries_topk(data_fname, k, methods=None, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Bounded counterpart of mt_blocks.count_method_entries()
+    Returns DICT : tid -> SpaceSaving of fptr
+    '''
+    known = None
+    if methods is not None:
+        known = np.array(sorted(methods), dtype=np.uint32)
+    counter = dict()
+    missing = 0
+    for block in BlockDecoder(data_fname, block_size, decode_events=False):
+        records = block.records
+        entered = records[records['action'] == kMiniTraceMethodEnter]
+        if known is not None:
+            found = np.isin(entered['ptr'], known)
+            missing += int((~found).sum())
+            entered = entered[found]
+        if len(entered) == 0:
+            continue
+        keys, counts = np.unique((entered['tid'].astype(np.uint64) << np.uint64(32)) | entered['ptr'],
+            return_counts=True)
+        # keys are sorted, so every tid is one run
+        tids = (keys >> np.uint64(32)).astype(np.int64)
+        bounds = np.flatnonzero(np.diff(tids)) + 1
+        for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [len(keys)]):
+            tid = int(tids[start])
+            try:
+                summary = counter[tid]
+            except KeyError:
+                summary = counter[tid] = SpaceSaving(k)
+            summary.add(keys[start:end] & np.uint64(0xFFFFFFFF), counts[start:end])
+
+    if missing:
+        print("Warning on collapse: %d entries of functions not found" % missing, file=sys.stderr)
+    return counter
+
+def write_report(fname, sections, get_method_info, n=None):
+    '''
+    Text report of summaries, sections being list of (title, SpaceSaving)
+    Lines of a section are ptr, count, error and method info, by descending count
+    '''
+    with open(fname, 'wt') as f:
+        for title, summary in sections:
+            f.write('[{}] total {} floor {}\n'.format(title, summary.total, summary.floor()))
+            for ptr, count, error in summary.top(n):
+                f.write('0x%08X\t%d\t%d\t%s\n' % (ptr, count, error, '\t'.join(get_method_info(ptr))))
+
+class TopKMessageCollapser(MessageCollapser):
+    '''
+    MessageCollapser keeping a SpaceSaving of k methods per message and per idle
+    '''
+    def __init__(self, main_tid, dispatchMessage_ptr, k):
+        MessageCollapser.__init__(self, main_tid, dispatchMessage_ptr)
+        self.k = k
+        self.cur_mtds_per_idle = SpaceSaving(k)
+
+    def message_dispatched(self, tid, msg):
+        MessageCollapser.message_dispatched(self, tid, msg)
+        self.mtds_per_message[self.cur_msg_id] = SpaceSaving(self.k)
+
+    def enter(self, tid, ptr):
+        if tid == self.main_tid and self.cur_msg_id != -1:
+            self.mtds_per_message[self.cur_msg_id].increment(ptr)
+        self.cur_mtds_per_idle.increment(ptr)
+
+    def batch(self, records):
+        action = records['action']
+        ptrs = records['ptr']
+        entered = action == kMiniTraceMethodEnter
+        self.cur_mtds_per_idle.add(ptrs[entered])
+        if self.cur_msg_id != -1:
+            closes = ((action == kMiniTraceMethodExit) | (action == kMiniTraceUnroll)) \
+                & (ptrs == self.dispatchMessage_ptr)
+            end = int(closes.argmax()) if closes.any() else len(records)
+            counted = entered[:end] & (records['tid'][:end] == self.main_tid)
+            self.mtds_per_message[self.cur_msg_id].add(ptrs[:end][counted])
+            if end < len(records):
+                self.cur_msg_id = -1
+
+    def idle(self, timestamp):
+        self.idle_infos.append((timestamp, self.cur_msgs_per_idle, self.cur_mtds_per_idle))
+        self.cur_msgs_per_idle = []
+        self.cur_mtds_per_idle = SpaceSaving(self.k)
+
+    def make_matrix(self, dirname):
+        # estimated counts, error bounds are in the report
+        from mt_matrix import write_matrix
+        return write_matrix(dirname, self.messages,
+            {msgid:summary.as_dict() for msgid, summary in self.mtds_per_message.items()},
+            [(timestamp, msgs, summary.as_dict()) for timestamp, msgs, summary in self.idle_infos],
+            (self.cur_msgs_per_idle, self.cur_mtds_per_idle.as_dict()))
+
+    def write_report(self, fname, get_method_info):
+        sections = [('Message {}'.format(self.messages[msgid]), summary)
+            for msgid, summary in self.mtds_per_message.items()]
+        sections.extend(('Idle {}'.format(timestamp), summary)
+            for timestamp, _, summary in self.idle_infos)
+        sections.append(('Tail', self.cur_mtds_per_idle))
+        write_report(fname, sections, get_method_info)
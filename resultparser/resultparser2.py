@@ -259,19 +259,22 @@ def makeUnit(expname, exptype, directory, printSubsequence, detail, allcrash):
 
     sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../crashgen'))
     from consumer import parse_data, Threads, Methods
+    from mt_storage import ordered_traces
 
     execution_data = {}
     mtdCounter = MtdCounter()
     for mtdata_directory in mtdata_directories:
-        binary_fname = os.path.join(mtdata_directory, 'data_0.bin')
+        # every data_N.bin of the process, not only the first one
+        binary_fnames = ordered_traces(os.path.join(mtdata_directory, ''))
         thread_fname = os.path.join(mtdata_directory, 'info_t.log')
         method_fname = os.path.join(mtdata_directory, 'info_m.log')
 
-        if any(not os.path.isfile(fname) for fname in [binary_fname, thread_fname, method_fname]):
+        if not binary_fnames or any(not os.path.isfile(fname) for fname in [thread_fname, method_fname]):
             continue
         mtdCounter.setTid(Threads(thread_fname).get_main_tid())
-        parse_data(binary_fname, {10: mtdCounter.inc, 11: mtdCounter.inc, 12: mtdCounter.inc,
-            13: mtdCounter.tidInc, 14: mtdCounter.tidInc, 15: mtdCounter.tidInc}, verbose=False)
+        for binary_fname in binary_fnames:
+            parse_data(binary_fname, {10: mtdCounter.inc, 11: mtdCounter.inc, 12: mtdCounter.inc,
+                13: mtdCounter.tidInc, 14: mtdCounter.tidInc, 15: mtdCounter.tidInc}, verbose=False)
 
         methods = Methods(method_fname)
         execf = os.path.join(mtdata_directory, 'exec.txt')